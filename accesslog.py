@@ -0,0 +1,133 @@
+# coding: utf-8
+
+'''
+结构化访问日志 (JSON Lines, 见 `main.access_log`)
+'''
+
+import json
+import atexit
+from logging import getLogger, Formatter, INFO
+from logging.handlers import QueueListener
+from random import random
+from threading import Lock
+from time import time
+import typing as t
+
+import schedule
+
+import utils as u
+from models import ConfigModel
+
+l = getLogger(__name__)
+
+WRITE_ENDPOINTS = {
+    'set_status',
+    'device_set',
+    'device_remove',
+    'device_clear',
+    'device_private_mode',
+    'auth'
+}
+'''会修改数据的路由 (即使使用 GET 方法也始终记录)'''
+
+
+class AccessLog:
+    '''
+    结构化访问日志
+    - 每个请求一行 JSON, 按路由采样 (`main.access_log_sample`)
+    - 写入类请求 / 错误请求始终记录
+    - 未被采样的请求在进程内聚合, 每隔 `main.access_log_summary_interval` 秒输出汇总行
+    '''
+
+    def __init__(self, config: ConfigModel):
+        self._c = config
+        self._rates = config.main.access_log_sample
+        self._default_rate = self._rates.get('*', 1.0)
+        self._lock = Lock()
+        self._summary: dict[str, list] = {}
+        '''路由 -> [请求数, 总耗时 (ms), 最大耗时 (ms), 总字节数]'''
+        self._summary_start = time()
+
+        path = u.get_path(config.main.access_log)
+        fhandler = u.LogFileHandler(
+            path,
+            max_bytes=config.main.log_max_bytes,
+            backup_count=config.main.log_backup_count,
+            daily=config.main.log_rotate_daily,
+            compress=config.main.log_compress,
+            timezone=config.main.timezone
+        )
+        fhandler.setFormatter(Formatter('%(message)s'))
+        self.handler = u.DropQueueHandler(config.main.log_queue_size)
+        self._listener = QueueListener(self.handler.queue, fhandler)
+        self._listener.start()
+
+        self._logger = getLogger('sleepy.access')
+        self._logger.propagate = False
+        self._logger.setLevel(INFO)
+        self._logger.handlers.clear()
+        self._logger.addHandler(self.handler)
+
+        schedule.every(config.main.access_log_summary_interval).seconds.do(self.flush_summary)
+        atexit.register(self.stop)
+        l.info(f'[access_log] Saving access logs to {path}')
+
+    def rate(self, endpoint: str) -> float:
+        '''
+        获取路由的采样率
+        '''
+        return self._rates.get(endpoint, self._default_rate)
+
+    def _write(self, entry: dict[str, t.Any]):
+        self._logger.info(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
+
+    def log(self, entry: dict[str, t.Any], always: bool = False):
+        '''
+        记录一个请求
+
+        :param entry: 日志内容 (需包含 `endpoint`, `ms`, `bytes`)
+        :param always: 是否忽略采样始终记录 (写入 / 错误请求)
+        '''
+        endpoint: str = entry['endpoint']
+        rate = 1.0 if always else self.rate(endpoint)
+        if rate >= 1 or (rate > 0 and random() < rate):
+            entry['sample'] = rate
+            self._write(entry)
+            return
+        # 未采样 -> 聚合
+        ms: float = entry['ms']
+        with self._lock:
+            agg = self._summary.get(endpoint)
+            if agg is None:
+                agg = self._summary[endpoint] = [0, 0.0, 0.0, 0]
+            agg[0] += 1
+            agg[1] += ms
+            agg[2] = max(agg[2], ms)
+            agg[3] += entry['bytes'] or 0
+
+    def flush_summary(self):
+        '''
+        输出未采样请求的汇总行 (每个路由一行)
+        '''
+        with self._lock:
+            summary, self._summary = self._summary, {}
+            start, self._summary_start = self._summary_start, time()
+        now = time()
+        for endpoint, (count, total, max_ms, size) in summary.items():
+            self._write({
+                'type': 'summary',
+                'ts': round(now, 3),
+                'since': round(start, 3),
+                'endpoint': endpoint,
+                'count': count,
+                'ms_avg': round(total / count, 2),
+                'ms_max': max_ms,
+                'bytes': size
+            })
+
+    def stop(self):
+        '''
+        输出剩余汇总并停止后台写入
+        '''
+        self.flush_summary()
+        self._listener.stop()
@@ -0,0 +1,220 @@
+# coding: utf-8
+
+'''
+聚合模式: 同时订阅多个 Sleepy 实例, 合并为一个状态页 (见 `aggregator` 配置项)
+'''
+
+from logging import getLogger
+from threading import Thread
+from time import time, sleep
+import typing as t
+
+import utils as u
+import instrument as ins
+from models import ConfigModel
+from replica import JSONClient, UpstreamError
+
+l = getLogger(__name__)
+
+
+class _Upstream:
+    '''
+    单个上游实例 (在自己的线程中同步, 慢的上游不会影响其他上游 / 页面)
+    - 优先长轮询 `/api/status/wait`, 上游不支持时 (旧版本) 定期请求 `/api/status/query`
+    - 保留最后一次成功获取的状态, 超过 `aggregator.stale_after` 未能更新 / 熔断期间标记为过期
+    - 熔断: 连续失败 `aggregator.breaker_failures` 次后暂停请求 `aggregator.breaker_cooldown` 秒, 之后试探一次
+    '''
+
+    def __init__(self, agg: 'Aggregator', name: str, url: str):
+        self._agg = agg
+        self.name = name
+        self.client = JSONClient(url, agg.timeout, f'aggregator.upstreams.{name}')
+        self.mode = 'wait'
+        '''同步方式: `wait` (长轮询) / `poll` (定期请求)'''
+        self.state: dict[str, t.Any] | None = None
+        '''最后一次成功获取的状态 (`/api/status/query` 的返回)'''
+        self.seq: int | None = None
+        self.last_ok: float | None = None
+        '''最后一次成功请求的时间 (unix)'''
+        self.failures = 0
+        '''连续失败次数'''
+        self.opened_at: float | None = None
+        '''熔断开始时间 (为空则未熔断)'''
+        self.last_error: str | None = None
+        self.stale = True
+        '''已发布的状态是否过期'''
+
+    @property
+    def breaker(self) -> str:
+        '''
+        熔断状态: `closed` (正常) / `open` (熔断中) / `half-open` (等待试探)
+        '''
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if time() - self.opened_at < self._agg.breaker_cooldown else 'half-open'
+
+    def run(self):
+        while True:
+            if not self._agg.data.is_leader:
+                # 由其他进程同步
+                self.client.close()
+                self.seq = None
+                sleep(1)
+                continue
+            if self.breaker == 'open':
+                self._check_stale()
+                sleep(1)
+                continue
+            try:
+                self._fetch()
+            except Exception as e:
+                self._failed(e)
+                self._check_stale()
+                if self.breaker == 'closed':
+                    sleep(min(2 ** self.failures, self._agg.breaker_cooldown))
+            else:
+                if self.opened_at is not None:
+                    l.info(f'[aggregator] Upstream {self.name} recovered')
+                self.failures = 0
+                self.opened_at = None
+                ins.upstream_up.set(1, upstream=self.name)
+                self._check_stale()
+                if self.mode == 'poll':
+                    sleep(self._agg.interval)
+
+    def _fetch(self):
+        '''
+        获取一次状态 (长轮询直到上游有变化 / 超时), 有变化时发布
+        '''
+        if self.mode == 'wait':
+            params = {'seq': self.seq, 'timeout': self._agg.wait} if self.seq is not None else None
+            try:
+                # 获取完整状态时上游立即返回, 不需要加上等待时间
+                resp = self.client.get('/api/status/wait', params, self._agg.timeout + (self._agg.wait if params else 0))
+            except UpstreamError as e:
+                if e.status != 404:
+                    raise
+                l.info(f'[aggregator] Upstream {self.name} does not support long polling, polling /api/status/query every {self._agg.interval}s')
+                self.mode = 'poll'
+                return
+            self.last_ok = time()
+            if 'seq' in resp:
+                self.seq = resp['seq']
+            if resp.get('changed') is False and self.state is not None:
+                return
+        else:
+            resp = self.client.get('/api/status/query')
+            self.last_ok = time()
+        if not isinstance(resp.get('device'), dict) or not isinstance(resp.get('status'), dict):
+            raise UpstreamError('unexpected response (is it a Sleepy server?)')
+        self.state = resp
+        self._publish()
+
+    def _failed(self, e: Exception):
+        self.failures += 1
+        self.last_error = f'{type(e).__name__}: {e}'
+        ins.upstream_errors.inc(upstream=self.name)
+        ins.upstream_up.set(0, upstream=self.name)
+        if self.failures == 1:
+            l.warning(f'[aggregator] Upstream {self.name} failed: {self.last_error}')
+        else:
+            l.debug(f'[aggregator] Upstream {self.name} failed ({self.failures}): {self.last_error}')
+        if self.failures >= self._agg.breaker_failures:
+            if self.opened_at is None:
+                l.warning(f'[aggregator] Upstream {self.name} failed {self.failures} times, pausing for {self._agg.breaker_cooldown}s')
+                ins.upstream_breaker_opens.inc(upstream=self.name)
+            # 试探失败时重新计时
+            self.opened_at = time()
+
+    def _check_stale(self):
+        '''
+        过期状态变化时重新发布
+        '''
+        stale = self.opened_at is not None or self.last_ok is None or time() - self.last_ok > self._agg.stale_after
+        if stale != self.stale and self.state is not None:
+            if stale:
+                l.info(f'[aggregator] Upstream {self.name} is stale (last update: {self.last_ok and round(time() - self.last_ok)}s ago)')
+            self._publish(stale)
+
+    def _publish(self, stale: bool = False):
+        '''
+        将状态写入本地数据库 (只记录有变化的设备)
+        '''
+        self.stale = stale
+        ins.upstream_stale.set(int(stale), upstream=self.name)
+        state = self.state or {}
+        status: dict[str, t.Any] = state.get('status') or {}
+        devices = {
+            self.name: {
+                'show_name': self.name,
+                'using': None,
+                'status': status.get('name'),
+                'fields': {'upstream': self.name, 'kind': 'upstream', 'status': status, 'stale': stale},
+                'last_updated': state.get('last_updated')
+            }
+        }
+        for id, device in (state.get('device') or {}).items():
+            devices[f'{self.name}/{id}'] = {
+                'show_name': f'{self.name} / {device.get("show_name") or id}',
+                'using': device.get('using'),
+                'status': device.get('status'),
+                'fields': {**(device.get('fields') or {}), 'upstream': self.name, 'stale': stale},
+                'last_updated': device.get('last_updated')
+            }
+        changed = self._agg.data.merge_devices(self.name, devices)
+        if changed:
+            l.debug(f'[aggregator] Upstream {self.name}: {changed} device(s) changed')
+
+    def stats(self) -> dict[str, t.Any]:
+        return {
+            'url': self.client.base,
+            'mode': self.mode,
+            'breaker': self.breaker,
+            'stale': self.stale,
+            'since_ok': round(time() - self.last_ok, 3) if self.last_ok else None,
+            'failures': self.failures,
+            'last_error': self.last_error
+        }
+
+
+class Aggregator:
+    '''
+    聚合模式
+    - 每个上游在单独的线程中同步 (复用 keep-alive 连接), 互不影响
+    - 上游的状态写入本地数据库 (设备 id 带上游名称前缀), 本地的 `/api/status/query` / SSE / 长轮询 / WebSocket 订阅即为合并后的数据
+    - 多个 worker 共用数据库时只由执行全局任务的进程同步
+    '''
+
+    def __init__(self, config: ConfigModel, data: t.Any):
+        '''
+        :param config: 配置
+        :param data: `data.Data` 实例
+        '''
+        a = config.aggregator
+        if config.replica.primary:
+            raise u.SleepyException('replica.primary and aggregator.upstreams cannot be used together')
+        self.data = data
+        self.timeout = max(a.timeout, 0.1)
+        self.wait = min(max(a.wait, 0), 60)
+        self.interval = max(a.interval, 0.1)
+        self.stale_after = a.stale_after
+        self.breaker_failures = a.breaker_failures
+        self.breaker_cooldown = a.breaker_cooldown
+        for name in a.upstreams:
+            if not name or '/' in name:
+                raise u.SleepyException(f'Invaild upstream name in aggregator.upstreams: {name!r}, it cannot be empty or contain "/"')
+        self.upstreams = [_Upstream(self, name, url) for name, url in a.upstreams.items()]
+
+    def start(self):
+        '''
+        启动所有上游的同步线程
+        '''
+        for i in self.upstreams:
+            Thread(target=i.run, daemon=True, name=f'upstream-{i.name}').start()
+        l.info(f'[aggregator] Aggregating {len(self.upstreams)} upstream(s): {", ".join(i.name for i in self.upstreams)}')
+
+    def stats(self) -> dict[str, t.Any]:
+        '''
+        各上游的同步状态
+        '''
+        return {i.name: i.stats() for i in self.upstreams}
@@ -0,0 +1,243 @@
+# coding: utf-8
+
+'''
+极简 asyncio HTTP/1.1 客户端, 供 bench/ 下的压测工具使用
+
+- 只依赖标准库, 以便单进程内模拟上千个连接
+- 支持 keep-alive, `Content-Length` / `chunked` / 读到连接关闭 三种响应体
+- 支持 SSE 事件流 (`Connection.events()`)
+'''
+
+import asyncio
+import json
+import ssl
+from urllib.parse import urlsplit
+import typing as t
+
+
+class HTTPError(Exception):
+    '''
+    连接 / 协议错误 (非 HTTP 状态码错误)
+    '''
+
+
+class Response(t.NamedTuple):
+    status: int
+    headers: dict[str, str]
+    '''响应头 (键为小写)'''
+    body: bytes
+
+    def json(self) -> t.Any:
+        return json.loads(self.body)
+
+
+class Event(t.NamedTuple):
+    '''
+    SSE 事件
+    '''
+    event: str
+    data: str
+    id: str | None
+
+
+class Target(t.NamedTuple):
+    '''
+    服务地址 (由 `parse_url` 生成)
+    '''
+    host: str
+    port: int
+    ssl: bool
+    prefix: str
+    '''路径前缀 (如部署在子路径下)'''
+
+    @property
+    def host_header(self) -> str:
+        default = 443 if self.ssl else 80
+        return self.host if self.port == default else f'{self.host}:{self.port}'
+
+
+def parse_url(url: str) -> Target:
+    '''
+    解析服务地址 (`http[s]://host[:port][/prefix]`)
+    '''
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f'invalid server url: {url}')
+    secure = parts.scheme == 'https'
+    return Target(parts.hostname, parts.port or (443 if secure else 80), secure, parts.path.rstrip('/'))
+
+
+class Connection:
+    '''
+    单个 HTTP/1.1 连接 (非并发安全, 同一时间只能进行一个请求)
+    - 连接在首次请求时建立, 服务端关闭后自动重连
+    '''
+
+    def __init__(self, target: Target, timeout: float = 10):
+        '''
+        :param target: 服务地址
+        :param timeout: 连接 / 读取超时 (秒)
+        '''
+        self.target = target
+        self.timeout = timeout
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def _connect(self):
+        ctx = ssl.create_default_context() if self.target.ssl else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.target.host, self.target.port, ssl=ctx),
+            self.timeout
+        )
+
+    async def close(self):
+        '''
+        关闭连接
+        '''
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+    async def _send(self, method: str, path: str, headers: dict[str, str] | None, body: bytes | None):
+        if not self._writer:
+            await self._connect()
+        assert self._writer
+        lines = [
+            f'{method} {self.target.prefix}{path} HTTP/1.1',
+            f'Host: {self.target.host_header}',
+            'User-Agent: sleepy-bench'
+        ]
+        for k, v in (headers or {}).items():
+            lines.append(f'{k}: {v}')
+        if body is not None:
+            lines.append(f'Content-Length: {len(body)}')
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await self._writer.drain()
+
+    async def _read_head(self) -> tuple[int, dict[str, str]]:
+        assert self._reader
+        raw = await self._reader.readuntil(b'\r\n\r\n')
+        lines = raw.decode('latin-1').split('\r\n')
+        try:
+            status = int(lines[0].split(' ', 2)[1])
+        except (IndexError, ValueError):
+            raise HTTPError(f'invalid status line: {lines[0]!r}')
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        return status, headers
+
+    async def _read_chunks(self) -> t.AsyncIterator[bytes]:
+        assert self._reader
+        while True:
+            size_line = await self._reader.readuntil(b'\r\n')
+            size = int(size_line.split(b';', 1)[0], 16)
+            if size == 0:
+                await self._reader.readuntil(b'\r\n')
+                return
+            chunk = await self._reader.readexactly(size + 2)
+            yield chunk[:-2]
+
+    async def request(self, method: str, path: str, headers: dict[str, str] | None = None, body: bytes | None = None, json_body: t.Any = None) -> Response:
+        '''
+        发送请求并读取完整响应
+
+        :param method: 请求方法
+        :param path: 路径 (不含前缀)
+        :param headers: 请求头
+        :param body: 请求体
+        :param json_body: JSON 请求体 (会覆盖 `body`)
+        :raises HTTPError: 连接 / 协议错误
+        '''
+        if json_body is not None:
+            body = json.dumps(json_body, ensure_ascii=False).encode()
+            headers = {**(headers or {}), 'Content-Type': 'application/json'}
+        for attempt in (0, 1):
+            reused = self._writer is not None
+            try:
+                await self._send(method, path, headers, body)
+                return await asyncio.wait_for(self._read_response(), self.timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ssl.SSLError, asyncio.TimeoutError, ValueError) as e:
+                await self.close()
+                if attempt == 0 and reused and not isinstance(e, asyncio.TimeoutError):
+                    # keep-alive 连接已被服务端关闭 -> 重连后重试一次
+                    continue
+                raise HTTPError(f'{type(e).__name__}: {e}') from e
+        raise HTTPError('unreachable')
+
+    async def _read_response(self) -> Response:
+        assert self._reader
+        status, headers = await self._read_head()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''.join([c async for c in self._read_chunks()])
+        elif 'content-length' in headers:
+            body = await self._reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self._reader.read()
+            await self.close()
+            return Response(status, headers, body)
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return Response(status, headers, body)
+
+    async def events(self, path: str, headers: dict[str, str] | None = None) -> t.AsyncIterator[Event]:
+        '''
+        打开 SSE 事件流, 逐个返回事件 (连接在迭代结束后关闭)
+
+        :raises HTTPError: 连接错误 / 状态码不为 200
+        '''
+        try:
+            await self._send('GET', path, {'Accept': 'text/event-stream', **(headers or {})}, None)
+            status, resp_headers = await asyncio.wait_for(self._read_head(), self.timeout)
+        except (OSError, asyncio.IncompleteReadError, ssl.SSLError, asyncio.TimeoutError) as e:
+            await self.close()
+            raise HTTPError(f'{type(e).__name__}: {e}') from e
+        if status != 200:
+            await self.close()
+            raise HTTPError(f'event stream returned {status}')
+
+        assert self._reader
+        reader = self._reader
+        chunked = resp_headers.get('transfer-encoding', '').lower() == 'chunked'
+
+        async def raw() -> t.AsyncIterator[bytes]:
+            if chunked:
+                async for c in self._read_chunks():
+                    yield c
+            else:
+                while data := await reader.read(65536):
+                    yield data
+
+        buf = b''
+        event, data, eid = 'message', [], None
+        try:
+            async for chunk in raw():
+                buf += chunk
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    text = line.rstrip(b'\r').decode('utf-8', errors='replace')
+                    if not text:
+                        if data or event != 'message':
+                            yield Event(event, '\n'.join(data), eid)
+                        event, data = 'message', []
+                    elif text.startswith(':'):
+                        continue
+                    else:
+                        field, _, value = text.partition(':')
+                        value = value[1:] if value.startswith(' ') else value
+                        if field == 'event':
+                            event = value
+                        elif field == 'data':
+                            data.append(value)
+                        elif field == 'id':
+                            eid = value
+        except (OSError, asyncio.IncompleteReadError, ssl.SSLError, ValueError) as e:
+            raise HTTPError(f'{type(e).__name__}: {e}') from e
+        finally:
+            await self.close()
@@ -0,0 +1,162 @@
+# coding: utf-8
+
+'''
+基准测试结果 (统计 / 保存 / 与基线对比), 供 bench/ 下的各脚本共用
+
+结果文件格式:
+```jsonc
+{
+  "meta": {"time": 1752000000.0, "python": "3.13.0", "platform": "...", "commit": "abc1234", ...},
+  "results": {
+    "<场景名>": {"requests": 1000, "errors": 0, "seconds": 1.2, "rps": 833.3, "p50_ms": 1.1, "p90_ms": 1.5, "p99_ms": 3.2, "mean_ms": 1.2, "max_ms": 8.0}
+  }
+}
+```
+'''
+
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+from time import time
+import typing as t
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+'''仓库根目录'''
+
+HIGHER_IS_BETTER = {'rps'}
+'''越高越好的指标 (其他指标越低越好)'''
+
+COMPARE_KEYS = ('rps', 'p50_ms', 'p99_ms')
+'''对比时检查的指标'''
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    '''
+    计算百分位数 (最近秩法)
+
+    :param sorted_values: 已排序的数据
+    :param pct: 百分位 (0 ~ 100)
+    '''
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def summarize(latencies: list[float], seconds: float, errors: int = 0, count: int | None = None, **extra) -> dict[str, t.Any]:
+    '''
+    由单次请求耗时生成统计结果
+
+    :param latencies: 各请求耗时 (秒)
+    :param seconds: 总耗时 (秒, 用于计算吞吐量)
+    :param errors: 出错的请求数
+    :param count: 总请求数 (`latencies` 为抽样时使用, 默认为 `len(latencies)`)
+    :param extra: 附加到结果中的其他字段
+    '''
+    values = sorted(latencies)
+    count = len(values) if count is None else count
+    ret = {
+        'requests': count,
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'rps': round(count / seconds, 2) if seconds > 0 else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p90_ms': round(percentile(values, 90) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0
+    }
+    ret.update(extra)
+    return ret
+
+
+def metadata(**extra) -> dict[str, t.Any]:
+    '''
+    运行环境信息
+    '''
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    ret = {
+        'time': round(time(), 3),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit
+    }
+    ret.update(extra)
+    return ret
+
+
+def save(path: str, meta: dict[str, t.Any], results: dict[str, dict[str, t.Any]]):
+    '''
+    保存结果到 JSON 文件 (`-` 为标准输出)
+    '''
+    content = json.dumps({'meta': meta, 'results': results}, ensure_ascii=False, indent=2)
+    if path == '-':
+        print(content)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content + '\n')
+
+
+def load(path: str) -> dict[str, dict[str, t.Any]]:
+    '''
+    读取结果文件中的 `results`
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('results', {})
+
+
+def compare(baseline: dict[str, dict[str, t.Any]], current: dict[str, dict[str, t.Any]], threshold: float) -> tuple[str, list[str]]:
+    '''
+    与基线对比
+
+    :param baseline: 基线结果
+    :param current: 本次结果
+    :param threshold: 视为退化的变化百分比 (如 `10` 表示变差超过 10%)
+    :return: (可读的对比表格, 退化项列表 `场景:指标`)
+    *只对比本次运行的场景*
+    '''
+    lines = [f'{"scenario":<36} {"metric":<8} {"baseline":>12} {"current":>12} {"change":>9}']
+    regressions: list[str] = []
+    for name in current:
+        if name not in baseline:
+            lines.append(f'{name:<36} (new)')
+            continue
+        for key in COMPARE_KEYS:
+            old, new = baseline[name].get(key), current[name].get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if key in HIGHER_IS_BETTER else change
+            mark = ''
+            if worse > threshold:
+                mark = '  REGRESSION'
+                regressions.append(f'{name}:{key}')
+            elif worse < -threshold:
+                mark = '  improved'
+            lines.append(f'{name:<36} {key:<8} {old:>12.3f} {new:>12.3f} {change:>+8.1f}%{mark}')
+    return '\n'.join(lines), regressions
+
+
+def print_table(results: dict[str, dict[str, t.Any]], file: t.TextIO = sys.stdout):
+    '''
+    输出可读的结果表格
+    '''
+    print(f'{"scenario":<36} {"reqs":>7} {"err":>5} {"rps":>10} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}', file=file)
+    for name, r in results.items():
+        print(
+            f'{name:<36} {r["requests"]:>7} {r["errors"]:>5} {r["rps"]:>10.1f} '
+            f'{r["p50_ms"]:>9.3f} {r["p90_ms"]:>9.3f} {r["p99_ms"]:>9.3f} {r["max_ms"]:>9.3f}',
+            file=file
+        )
@@ -0,0 +1,113 @@
+# coding: utf-8
+
+'''
+启动本地测试服务端 (临时数据库), 供 bench/ 下的压测工具使用
+'''
+
+import os
+import socket
+import subprocess
+import sys
+from time import time, sleep
+from urllib.request import urlopen
+from urllib.error import URLError
+
+from _results import ROOT
+
+SECRET = 'bench-secret'
+'''测试服务端使用的 secret'''
+
+SERVER_MODES: dict[str, list[str]] = {
+    'dev': [sys.executable, 'main.py'],
+    'serve': ['env', 'SLEEPY_SERVER_WORKERS=1', sys.executable, 'serve.py'],
+    'serve-4': ['env', 'SLEEPY_SERVER_WORKERS=4', sys.executable, 'serve.py']
+}
+'''
+内置的服务端启动方式 (在仓库根目录执行, 通过环境变量传入 `main.host` / `main.port` 等配置)
+- `dev`: `python main.py` (Werkzeug 开发服务器, 每个连接一个线程)
+- `serve` / `serve-4`: `python serve.py` (gunicorn, 1 / 4 个 worker, 需要安装 gunicorn)
+'''
+
+
+def free_port() -> int:
+    '''
+    获取一个空闲端口
+    '''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 30):
+    '''
+    等待服务端可以响应 `/api/meta`
+
+    :raises RuntimeError: 超时
+    '''
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            with urlopen(f'{url}/api/meta', timeout=2) as resp:
+                if resp.status == 200:
+                    return
+        except (URLError, OSError):
+            pass
+        sleep(0.2)
+    raise RuntimeError(f'server at {url} is not ready after {timeout}s')
+
+
+class Server:
+    '''
+    本地服务端 (临时数据库, secret 为 `SECRET`)
+    '''
+
+    def __init__(self, cmd: list[str], workdir: str, env: dict[str, str] | None = None):
+        '''
+        :param cmd: 启动命令 (`{port}` 会被替换为端口)
+        :param workdir: 临时目录 (存放数据库和服务端输出)
+        :param env: 额外的环境变量 (如其他配置)
+        '''
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        full_env = os.environ.copy()
+        full_env.update({
+            'SLEEPY_MAIN_HOST': '127.0.0.1',
+            'SLEEPY_MAIN_PORT': str(self.port),
+            'SLEEPY_MAIN_DATABASE': f'sqlite:///{os.path.join(workdir, "bench.db")}',
+            'SLEEPY_MAIN_SECRET': SECRET,
+            'SLEEPY_MAIN_DEBUG': 'false',
+            'SLEEPY_MAIN_LOG_FILE': '',
+            'SLEEPY_MAIN_ACCESS_LOG': '',
+            'SLEEPY_DIAGNOSTICS_CAPTURE_FILE': '',
+            # 压测连接均来自本机
+            'SLEEPY_SERVER_STREAM_IP_LIMIT': '0'
+        })
+        full_env.update(env or {})
+        self.log_path = os.path.join(workdir, 'server.log')
+        self._log = open(self.log_path, 'w', encoding='utf-8')
+        self.proc = subprocess.Popen(
+            [i.replace('{port}', str(self.port)) for i in cmd],
+            cwd=ROOT, env=full_env, stdout=self._log, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_ready(self.url)
+        except RuntimeError:
+            self.stop()
+            with open(self.log_path, 'r', encoding='utf-8', errors='replace') as f:
+                raise RuntimeError(f'server failed to start, output:\n{f.read()[-4000:]}')
+
+    @property
+    def pid(self) -> int:
+        return self.proc.pid
+
+    def stop(self):
+        '''
+        停止服务端 (SIGTERM, 10 秒后 SIGKILL)
+        '''
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self._log.close()
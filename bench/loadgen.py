@@ -0,0 +1,439 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+虚拟设备集群压测 (asyncio + 多进程)
+
+对一个正在运行的服务端模拟:
+- N 个虚拟设备: 按 `client/win_device.py` (每 5 秒检查) / `client/linux_device_kde.py` (每 2 秒检查) 的方式,
+  在窗口切换 / 空闲状态变化时 POST `/api/device/set`
+- M 个 SSE 观众: 连接 `/api/status/events`
+- K 个轮询观众: 定期 GET `/api/status/query`
+
+设备会在扩展字段 `fields.lg_ts` 中附带发送时间, 观众收到更新后计算 `device/set` -> 观众 的端到端传播延迟
+
+```
+python bench/loadgen.py --url http://127.0.0.1:9010 --secret xxx --devices 200 --sse 1000 --pollers 100 --duration 60
+```
+
+*传播延迟使用各进程的系统时间计算, 如在其他机器上运行需保证时钟同步*
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from time import time, perf_counter
+import typing as t
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _results as r  # noqa: E402
+from _http import Connection, HTTPError, Target, parse_url  # noqa: E402
+
+DEVICE_PREFIX = 'lg-'
+'''虚拟设备 id 前缀'''
+
+WINDOW_TITLES = [
+    'main.py - sleepy - Visual Studio Code',
+    'GitHub - sleepy-project/sleepy - Google Chrome',
+    'bilibili - 哔哩哔哩 (゜-゜)つロ 干杯~ - Microsoft Edge',
+    'QQ',
+    '微信',
+    'Windows PowerShell',
+    'Spotify Premium',
+    'Steam',
+    'Minecraft 1.21.4 - 多人游戏 (第三方服务器)',
+    'Discord',
+    'Telegram',
+    '文件资源管理器',
+    'Konsole — ~/projects/sleepy',
+    'Dolphin — Downloads',
+    'Firefox — Mozilla Firefox',
+    'Typora - README.md',
+    'OBS 31.0.0 - 配置文件: 未命名 - 场景: 场景',
+    'Genshin Impact',
+    'Notion - 周报',
+    'JetBrains Rider - Sleepy.sln'
+]
+'''模拟的窗口标题'''
+
+
+class Profile(t.NamedTuple):
+    name: str
+    interval: float
+    '''检查间隔 (秒), 对应客户端的 `CHECK_INTERVAL`'''
+    idle_prob: float
+    '''每次检查时 空闲状态切换 的概率'''
+
+
+PROFILES = {
+    'win': Profile('win', 5, 0.05),
+    'kde': Profile('kde', 2, 0.02)
+}
+
+# region stats
+
+
+class Samples:
+    '''
+    耗时样本 (蓄水池抽样, 限制内存占用)
+    '''
+
+    def __init__(self, cap: int = 100000):
+        self.cap = cap
+        self.count: int = 0
+        self.max: float = 0
+        self.values: list[float] = []
+
+    def add(self, value: float):
+        self.count += 1
+        self.max = max(self.max, value)
+        if len(self.values) < self.cap:
+            self.values.append(value)
+        else:
+            j = random.randrange(self.count)
+            if j < self.cap:
+                self.values[j] = value
+
+    def merge(self, other: 'Samples'):
+        self.count += other.count
+        self.max = max(self.max, other.max)
+        self.values.extend(other.values)
+        if len(self.values) > self.cap:
+            self.values = random.sample(self.values, self.cap)
+
+
+class Stats:
+    '''
+    单个进程的统计数据
+    '''
+
+    def __init__(self):
+        self.measuring = False
+        '''是否已过预热期 (预热期内不记录)'''
+        self.samples: dict[str, Samples] = {}
+        self.errors: Counter[str] = Counter()
+        self.counters: Counter[str] = Counter()
+
+    def sample(self, name: str, value: float):
+        if self.measuring:
+            self.samples.setdefault(name, Samples()).add(value)
+
+    def error(self, name: str):
+        if self.measuring:
+            self.errors[name] += 1
+
+    def count(self, name: str, amount: int = 1):
+        if self.measuring:
+            self.counters[name] += amount
+
+    def merge(self, other: 'Stats'):
+        for name, s in other.samples.items():
+            self.samples.setdefault(name, Samples()).merge(s)
+        self.errors.update(other.errors)
+        self.counters.update(other.counters)
+
+# endregion stats
+
+# region actors
+
+
+class _Context(t.NamedTuple):
+    target: Target
+    args: argparse.Namespace
+    stats: Stats
+    stop: asyncio.Event
+
+
+async def _sleep(ctx: _Context, seconds: float) -> bool:
+    '''
+    等待 (收到停止信号时提前返回)
+
+    :return: 是否应继续运行
+    '''
+    try:
+        await asyncio.wait_for(ctx.stop.wait(), seconds)
+        return False
+    except asyncio.TimeoutError:
+        return True
+
+
+async def device(ctx: _Context, device_id: str, profile: Profile):
+    '''
+    虚拟设备: 仅在状态变化时发送 (同客户端的 `BYPASS_SAME_REQUEST`)
+    '''
+    conn = Connection(ctx.target, ctx.args.timeout)
+    interval = ctx.args.interval or profile.interval
+    window = random.choice(WINDOW_TITLES)
+    idle = False
+    first = True
+    try:
+        while await _sleep(ctx, interval * random.uniform(0.9, 1.1)):
+            changed = first
+            if random.random() < ctx.args.change_prob:
+                window = random.choice([i for i in WINDOW_TITLES if i != window])
+                changed = True
+            if random.random() < profile.idle_prob:
+                idle = not idle
+                changed = True
+            if not changed:
+                continue
+            first = False
+            payload = {
+                'secret': ctx.args.secret,
+                'id': device_id,
+                'show_name': f'LoadGen {profile.name} {device_id[len(DEVICE_PREFIX):]}',
+                'using': not idle,
+                'status': window,
+                'fields': {'lg_ts': time()}
+            }
+            start = perf_counter()
+            try:
+                resp = await conn.request('POST', '/api/device/set', json_body=payload)
+            except HTTPError:
+                ctx.stats.error('device_set:connection')
+                continue
+            ctx.stats.sample('device_set', perf_counter() - start)
+            ctx.stats.count('device_set')
+            if resp.status != 200:
+                ctx.stats.error(f'device_set:{resp.status}')
+    finally:
+        if ctx.args.cleanup:
+            try:
+                await conn.request('GET', f'/api/device/remove?id={device_id}', headers={'Sleepy-Secret': ctx.args.secret})
+            except HTTPError:
+                pass
+        await conn.close()
+
+
+def _observe(ctx: _Context, kind: str, query: dict, seen: dict[str, float], initial: bool):
+    '''
+    记录 `/api/status/query` 数据中虚拟设备更新的传播延迟
+    '''
+    now = time()
+    for device_id, info in (query.get('device') or {}).items():
+        if not device_id.startswith(DEVICE_PREFIX):
+            continue
+        ts = (info.get('fields') or {}).get('lg_ts')
+        if ts is None or seen.get(device_id) == ts:
+            continue
+        seen[device_id] = ts
+        if not initial:
+            # 首次获取到的数据可能早于连接建立, 不计入
+            ctx.stats.sample(f'{kind}_propagation', now - ts)
+
+
+async def sse_viewer(ctx: _Context):
+    '''
+    SSE 观众 (断开后 1 秒重连)
+    '''
+    seen: dict[str, float] = {}
+    while not ctx.stop.is_set():
+        conn = Connection(ctx.target, ctx.args.timeout)
+        initial = True
+        try:
+            async for evt in conn.events('/api/status/events'):
+                ctx.stats.count(f'sse_event:{evt.event}')
+                if evt.event == 'update':
+                    try:
+                        _observe(ctx, 'sse', json.loads(evt.data), seen, initial)
+                    except ValueError:
+                        ctx.stats.error('sse:invalid_json')
+                initial = False
+            if not ctx.stop.is_set():
+                ctx.stats.error('sse:closed')
+        except HTTPError:
+            ctx.stats.error('sse:connection')
+        await _sleep(ctx, 1)
+
+
+async def poller(ctx: _Context):
+    '''
+    轮询观众 (同 `status.refresh_interval` 回退方式)
+    '''
+    conn = Connection(ctx.target, ctx.args.timeout)
+    seen: dict[str, float] = {}
+    initial = True
+    try:
+        while await _sleep(ctx, ctx.args.poll_interval * random.uniform(0.9, 1.1)):
+            start = perf_counter()
+            try:
+                resp = await conn.request('GET', '/api/status/query')
+            except HTTPError:
+                ctx.stats.error('poll:connection')
+                continue
+            ctx.stats.sample('poll', perf_counter() - start)
+            ctx.stats.count('poll')
+            if resp.status != 200:
+                ctx.stats.error(f'poll:{resp.status}')
+                continue
+            try:
+                _observe(ctx, 'poll', resp.json(), seen, initial)
+            except ValueError:
+                ctx.stats.error('poll:invalid_json')
+            initial = False
+    finally:
+        await conn.close()
+
+# endregion actors
+
+# region worker
+
+
+async def _run(worker_id: int, devices: int, sse: int, pollers: int, args: argparse.Namespace) -> Stats:
+    ctx = _Context(parse_url(args.url), args, Stats(), asyncio.Event())
+    profiles = list(PROFILES.values()) if args.profile == 'mix' else [PROFILES[args.profile]]
+
+    async def delayed(coro_func, *a):
+        # 在预热期内均匀启动
+        if await _sleep(ctx, random.uniform(0, args.ramp)):
+            await coro_func(ctx, *a)
+
+    tasks = [
+        asyncio.create_task(delayed(device, f'{DEVICE_PREFIX}{worker_id}-{i}', profiles[i % len(profiles)]))
+        for i in range(devices)
+    ]
+    tasks += [asyncio.create_task(delayed(sse_viewer)) for _ in range(sse)]
+    tasks += [asyncio.create_task(delayed(poller)) for _ in range(pollers)]
+
+    await asyncio.sleep(args.ramp)
+    ctx.stats.measuring = True
+    await asyncio.sleep(args.duration)
+    ctx.stats.measuring = False
+    ctx.stop.set()
+    # 给设备留出清理时间, 其余 (阻塞在 SSE 读取上的) 任务直接取消
+    _, pending = await asyncio.wait(tasks, timeout=args.timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    return ctx.stats
+
+
+def _raise_nofile_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def worker(worker_id: int, devices: int, sse: int, pollers: int, args: argparse.Namespace) -> Stats:
+    '''
+    (子进程) 运行分配到的设备 / 观众
+    '''
+    _raise_nofile_limit()
+    return asyncio.run(_run(worker_id, devices, sse, pollers, args))
+
+
+def _split(total: int, parts: int) -> list[int]:
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+# endregion worker
+
+# region runner
+
+
+def summarize(stats: Stats, args: argparse.Namespace) -> dict[str, dict[str, t.Any]]:
+    '''
+    生成结果 (`loadgen/<指标>`)
+    '''
+    def errors(prefix: str) -> int:
+        return sum(v for k, v in stats.errors.items() if k.startswith(prefix + ':'))
+
+    results = {}
+    for name, kind in (
+        ('device_set', 'device_set'),
+        ('poll', 'poll'),
+        ('sse_propagation', 'sse'),
+        ('poll_propagation', 'poll')
+    ):
+        s = stats.samples.get(name)
+        if not s:
+            continue
+        err = errors(kind)
+        total = stats.counters.get(name, s.count)
+        results[f'loadgen/{name}'] = r.summarize(
+            s.values, args.duration, err, count=s.count,
+            max_ms=round(s.max * 1000, 3),
+            error_rate=round(err / (total + err), 4) if name in ('device_set', 'poll') and total + err else None
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sleepy virtual device fleet load generator')
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:9010', help='server url (default: http://127.0.0.1:9010)')
+    parser.add_argument('-k', '--secret', default=os.environ.get('SLEEPY_MAIN_SECRET', ''), help='server secret (default: $SLEEPY_MAIN_SECRET)')
+    parser.add_argument('-D', '--devices', type=int, default=100, help='virtual devices (default: 100)')
+    parser.add_argument('-S', '--sse', type=int, default=200, help='SSE viewers (default: 200)')
+    parser.add_argument('-P', '--pollers', type=int, default=0, help='polling viewers (default: 0)')
+    parser.add_argument('--profile', choices=['mix', *PROFILES], default='mix', help='device behaviour: win (5s), kde (2s) or mix (default)')
+    parser.add_argument('--interval', type=float, help='override device check interval (seconds)')
+    parser.add_argument('--change-prob', type=float, default=0.3, help='chance of a window switch per check (default: 0.3)')
+    parser.add_argument('--poll-interval', type=float, default=5, help='polling viewer interval in seconds (default: 5, same as status.refresh_interval)')
+    parser.add_argument('-d', '--duration', type=float, default=60, help='measured seconds (default: 60)')
+    parser.add_argument('-r', '--ramp', type=float, default=5, help='ramp-up seconds, not measured (default: 5)')
+    parser.add_argument('-j', '--processes', type=int, default=min(os.cpu_count() or 1, 8), help='worker processes (default: cpu count, max 8)')
+    parser.add_argument('--timeout', type=float, default=10, help='request timeout in seconds (default: 10)')
+    parser.add_argument('--no-cleanup', dest='cleanup', action='store_false', help='keep virtual devices on the server afterwards')
+    parser.add_argument('-o', '--output', help='save results as JSON (`-` for stdout)')
+    parser.add_argument('-c', '--compare', help='baseline JSON to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=10, help='regression threshold in percent (default: 10)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with code 1 if any regression is found')
+    args = parser.parse_args()
+
+    parse_url(args.url)
+    if args.devices and not args.secret:
+        parser.error('--secret is required to update devices')
+    procs = max(1, min(args.processes, args.devices + args.sse + args.pollers))
+    out = sys.stderr if args.output == '-' else sys.stdout
+
+    print(
+        f'[loadgen] {args.devices} devices, {args.sse} SSE viewers, {args.pollers} pollers '
+        f'-> {args.url} ({procs} processes, {args.ramp}s ramp-up + {args.duration}s)',
+        file=sys.stderr, flush=True
+    )
+    stats = Stats()
+    with ProcessPoolExecutor(procs) as pool:
+        futures = [
+            pool.submit(worker, i, d, s, p, args)
+            for i, (d, s, p) in enumerate(zip(_split(args.devices, procs), _split(args.sse, procs), _split(args.pollers, procs)))
+        ]
+        for f in futures:
+            stats.merge(f.result())
+
+    results = summarize(stats, args)
+    r.print_table(results, file=out)
+    if stats.errors:
+        print('\nerrors: ' + ', '.join(f'{k} x{v}' for k, v in stats.errors.most_common()), file=out)
+    print('counters: ' + ', '.join(f'{k} x{v}' for k, v in sorted(stats.counters.items())), file=out)
+
+    if args.output:
+        meta = r.metadata(
+            tool='bench/loadgen.py',
+            **{k: getattr(args, k) for k in ('url', 'devices', 'sse', 'pollers', 'profile', 'interval', 'change_prob', 'poll_interval', 'duration', 'ramp')},
+            processes=procs,
+            errors=dict(stats.errors),
+            counters=dict(stats.counters)
+        )
+        r.save(args.output, meta, results)
+
+    if args.compare:
+        table, regressions = r.compare(r.load(args.compare), results, args.threshold)
+        print(f'\ncompared with {args.compare} (threshold {args.threshold}%):\n{table}', file=out)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s): {", ".join(regressions)}', file=out)
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# endregion runner
@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+流量回放: 按录制时的时间间隔 (或 N 倍速) 对测试实例回放 `diagnostics.capture_file` 录制的请求
+
+- 请求按录制顺序和时间间隔发出 (开环, 不等待上一个请求完成), 结果可重复
+- 字符串按录制的长度 / 哈希生成占位内容 (同一原始字符串 -> 同一占位), secret 替换为测试实例的 secret
+- 录制时鉴权失败的请求会使用错误的 secret 回放
+- SSE 连接 (`/api/status/events`) 会保持 `--sse-hold` 秒 (同样按倍速缩短)
+
+```
+python bench/replay.py data/capture.jsonl --spawn --speed 1
+python bench/replay.py data/capture.jsonl.1.gz data/capture.jsonl --url http://127.0.0.1:9010 --secret xxx --speed 10
+```
+'''
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import tempfile
+from collections import Counter, defaultdict
+from time import perf_counter
+from urllib.parse import urlencode, quote
+import typing as t
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _results as r  # noqa: E402
+from _http import Connection, HTTPError, Target, parse_url  # noqa: E402
+from _server import SECRET, SERVER_MODES, Server  # noqa: E402
+
+WRONG_SECRET = 'sleepy-replay-wrong-secret'
+'''回放录制时鉴权失败的请求使用的 secret'''
+
+# region load
+
+
+def load(paths: list[str], limit: int | None = None) -> list[dict[str, t.Any]]:
+    '''
+    读取录制文件 (支持 `.gz`), 按时间排序
+
+    :param paths: 文件列表
+    :param limit: 最多读取的请求数
+    '''
+    records: list[dict[str, t.Any]] = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if 'type' in rec or 'p' not in rec:
+                    # 文件头 / 其他行
+                    continue
+                records.append(rec)
+    records.sort(key=lambda i: i['t'])
+    return records[:limit] if limit else records
+
+
+def placeholder(shape: dict[str, t.Any]) -> str:
+    '''
+    由 `{"$s": 长度, "h": 哈希}` 生成确定的占位字符串
+    '''
+    length, h = shape['$s'], shape.get('h') or 'x'
+    return (h * (length // len(h) + 1))[:length]
+
+
+def materialize(value: t.Any, secret: str) -> t.Any:
+    '''
+    由录制的结构生成实际数据
+    '''
+    if isinstance(value, dict):
+        if value.get('$secret'):
+            return secret
+        if '$s' in value:
+            return placeholder(value)
+        return {k: materialize(v, secret) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [materialize(i, secret) for i in value]
+    return value
+
+
+class Prepared(t.NamedTuple):
+    offset: float
+    '''相对开始时间 (秒, 录制时间)'''
+    endpoint: str
+    method: str
+    path: str
+    headers: dict[str, str]
+    body: bytes | None
+    status: int
+    '''录制时的状态码'''
+    duration: float
+    '''录制时的处理耗时 (毫秒)'''
+
+
+def prepare(records: list[dict[str, t.Any]], secret: str) -> list[Prepared]:
+    '''
+    生成回放请求
+    '''
+    if not records:
+        return []
+    t0 = records[0]['t']
+    ret = []
+    for rec in records:
+        key = WRONG_SECRET if rec.get('af') else secret
+        path = quote(rec['p'], safe='/%:@!$&\'()*+,;=-._~')
+        if rec.get('a'):
+            path += '?' + urlencode(materialize(rec['a'], key))
+        headers: dict[str, str] = {}
+        cookies: list[str] = []
+        auth = rec.get('au')
+        if auth == 'header':
+            headers['Sleepy-Secret'] = key
+        elif auth == 'bearer':
+            headers['Authorization'] = f'Bearer {key}'
+        elif auth == 'cookie':
+            cookies.append(f'sleepy-secret={key}')
+        if rec.get('th'):
+            cookies.append(f'sleepy-theme={rec["th"]}')
+        if cookies:
+            headers['Cookie'] = '; '.join(cookies)
+        body = None
+        if 'b' in rec:
+            body = json.dumps(materialize(rec['b'], key), ensure_ascii=False).encode()
+            headers['Content-Type'] = 'application/json'
+        elif 'f' in rec:
+            body = urlencode(materialize(rec['f'], key)).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif rec.get('bl'):
+            body = b'x' * rec['bl']
+            headers['Content-Type'] = rec.get('ct') or 'application/octet-stream'
+        ret.append(Prepared(rec['t'] - t0, rec.get('e') or '[none]', rec['m'], path, headers, body, rec['s'], rec.get('d') or 0))
+    return ret
+
+# endregion load
+
+# region replay
+
+
+class _Pool:
+    '''
+    keep-alive 连接池
+    '''
+
+    def __init__(self, target: Target, timeout: float):
+        self.target = target
+        self.timeout = timeout
+        self._idle: list[Connection] = []
+
+    def get(self) -> Connection:
+        return self._idle.pop() if self._idle else Connection(self.target, self.timeout)
+
+    def put(self, conn: Connection):
+        self._idle.append(conn)
+
+    async def close(self):
+        for conn in self._idle:
+            await conn.close()
+        self._idle.clear()
+
+
+async def replay(requests: list[Prepared], url: str, args: argparse.Namespace) -> tuple[dict[str, dict[str, t.Any]], float]:
+    '''
+    回放请求
+
+    :return: (各 endpoint 结果, 总耗时)
+    '''
+    target = parse_url(url)
+    pool = _Pool(target, args.timeout)
+    gate = asyncio.Semaphore(args.concurrency)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    captured: dict[str, list[float]] = defaultdict(list)
+    errors: Counter[str] = Counter()
+    mismatch: Counter[str] = Counter()
+    lags: list[float] = []
+    sse_events = 0
+
+    async def send(req: Prepared):
+        nonlocal sse_events
+        try:
+            if req.endpoint == 'events':
+                if args.skip_sse:
+                    return
+                conn = Connection(target, args.timeout)
+                start = perf_counter()
+                hold = args.sse_hold / args.speed if args.speed > 0 else args.sse_hold
+
+                async def consume():
+                    nonlocal sse_events
+                    async for _ in conn.events(req.path, req.headers):
+                        sse_events += 1
+
+                try:
+                    await asyncio.wait_for(consume(), hold)
+                except asyncio.TimeoutError:
+                    pass
+                except HTTPError:
+                    errors[req.endpoint] += 1
+                    return
+                finally:
+                    await conn.close()
+                latencies[req.endpoint].append(perf_counter() - start)
+                return
+
+            conn = pool.get()
+            start = perf_counter()
+            try:
+                resp = await conn.request(req.method, req.path, req.headers, req.body)
+            except HTTPError:
+                errors[req.endpoint] += 1
+                await conn.close()
+                return
+            latencies[req.endpoint].append(perf_counter() - start)
+            captured[req.endpoint].append(req.duration / 1000)
+            pool.put(conn)
+            if resp.status != req.status:
+                mismatch[f'{req.endpoint}:{req.status}->{resp.status}'] += 1
+        finally:
+            gate.release()
+
+    tasks: list[asyncio.Task] = []
+    begin = perf_counter()
+    for req in requests:
+        due = begin + (req.offset / args.speed if args.speed > 0 else 0)
+        delay = due - perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await gate.acquire()
+        lags.append(max(0.0, perf_counter() - due))
+        tasks.append(asyncio.create_task(send(req)))
+    await asyncio.gather(*tasks)
+    seconds = perf_counter() - begin
+    await pool.close()
+
+    results: dict[str, dict[str, t.Any]] = {}
+    for endpoint in sorted(latencies.keys() | errors.keys()):
+        ms = sorted(captured.get(endpoint, []))
+        results[f'replay/{endpoint}'] = r.summarize(
+            latencies.get(endpoint, []), seconds,
+            errors=errors[endpoint] + sum(v for k, v in mismatch.items() if k.startswith(endpoint + ':')),
+            captured_p50_ms=round(r.percentile(ms, 50) * 1000, 3) if ms else None,
+            captured_p99_ms=round(r.percentile(ms, 99) * 1000, 3) if ms else None
+        )
+    lags.sort()
+    results['replay/all'] = r.summarize(
+        [v for k, v in latencies.items() if k != 'events' for v in v], seconds,
+        errors=sum(errors.values()) + sum(mismatch.values()),
+        schedule_lag_p99_ms=round(r.percentile(lags, 99) * 1000, 3),
+        schedule_lag_max_ms=round(lags[-1] * 1000, 3) if lags else 0.0,
+        status_mismatch=dict(mismatch),
+        sse_events=sse_events
+    )
+    return results, seconds
+
+# endregion replay
+
+# region runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured Sleepy traffic against a test instance')
+    parser.add_argument('files', nargs='+', help='capture files (diagnostics.capture_file, .gz supported), in order')
+    parser.add_argument('--url', help='target server (use --spawn to start a local one)')
+    parser.add_argument('-k', '--secret', help='target server secret (default: bench secret when --spawn)')
+    parser.add_argument('--spawn', action='store_true', help='start a local server with a temporary database')
+    parser.add_argument('-m', '--mode', choices=list(SERVER_MODES), default='dev', help='server mode for --spawn (default: dev)')
+    parser.add_argument('--server-cmd', help='custom server command for --spawn ({port} is replaced)')
+    parser.add_argument('-x', '--speed', type=float, default=1, help='replay speed, e.g. 1 (real time), 10 (10x), 0 (as fast as possible)')
+    parser.add_argument('-l', '--limit', type=int, help='replay at most N requests')
+    parser.add_argument('--concurrency', type=int, default=256, help='max in-flight requests (default: 256)')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout in seconds (default: 30)')
+    parser.add_argument('--sse-hold', type=float, default=30, help='seconds to keep each SSE stream open, scaled by speed (default: 30)')
+    parser.add_argument('--skip-sse', action='store_true', help='do not open SSE streams')
+    parser.add_argument('-o', '--output', help='save results as JSON (`-` for stdout)')
+    parser.add_argument('-c', '--compare', help='baseline JSON to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=10, help='regression threshold in percent (default: 10)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with code 1 if any regression is found')
+    args = parser.parse_args()
+
+    if not args.spawn and not args.url:
+        parser.error('either --url or --spawn is required')
+    secret = args.secret or (SECRET if args.spawn else None)
+    if not secret:
+        parser.error('--secret is required with --url')
+    out = sys.stderr if args.output == '-' else sys.stdout
+
+    records = load(args.files, args.limit)
+    if not records:
+        parser.error('no requests found in capture files')
+    requests = prepare(records, secret)
+    span = requests[-1].offset
+    print(
+        f'[replay] {len(requests)} requests over {span:.1f}s captured, '
+        f'speed {args.speed or "max"}x (~{span / args.speed if args.speed > 0 else 0:.1f}s)',
+        file=sys.stderr, flush=True
+    )
+
+    if args.spawn:
+        with tempfile.TemporaryDirectory(prefix='sleepy-replay-') as tmp:
+            server = Server(args.server_cmd.split() if args.server_cmd else SERVER_MODES[args.mode], tmp)
+            try:
+                results, _ = asyncio.run(replay(requests, server.url, args))
+            finally:
+                server.stop()
+    else:
+        results, _ = asyncio.run(replay(requests, args.url.rstrip('/'), args))
+
+    r.print_table(results, file=out)
+    summary = results['replay/all']
+    print(
+        f'\nschedule lag p99 {summary["schedule_lag_p99_ms"]}ms (max {summary["schedule_lag_max_ms"]}ms), sse events {summary["sse_events"]}'
+        + (f', status mismatches: {summary["status_mismatch"]}' if summary['status_mismatch'] else ''),
+        file=out
+    )
+
+    if args.output:
+        meta = r.metadata(
+            tool='bench/replay.py', files=args.files, speed=args.speed, requests=len(requests),
+            captured_seconds=round(span, 3), target=args.url or 'spawn'
+        )
+        r.save(args.output, meta, results)
+
+    if args.compare:
+        table, regressions = r.compare(r.load(args.compare), results, args.threshold)
+        print(f'\ncompared with {args.compare} (threshold {args.threshold}%):\n{table}', file=out)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s): {", ".join(regressions)}', file=out)
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# endregion runner
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+进程内基准测试 (Flask test client + 临时 SQLite 数据库)
+
+每个配置组合 (variant) 在独立的子进程中启动一次应用, 依次测量各场景的吞吐量和延迟
+
+```
+python bench/run.py                               # 运行全部
+python bench/run.py -v base -s 'query-*'          # 只运行部分
+python bench/run.py -o bench/baseline.json        # 保存结果
+python bench/run.py --compare bench/baseline.json # 与基线对比
+```
+
+*注意: `data/config.*` 仍会被加载 (并覆盖此处通过环境变量设置的配置), 对比结果时请保持一致*
+'''
+
+import argparse
+import fnmatch
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+import typing as t
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _results as r  # noqa: E402
+
+SECRET = 'bench-secret'
+
+VARIANTS: dict[str, dict[str, str]] = {
+    'base': {
+        'SLEEPY_METRICS_ENABLED': 'false',
+        'SLEEPY_PLUGINS_ENABLED': '[]'
+    },
+    'metrics': {
+        'SLEEPY_METRICS_ENABLED': 'true',
+        'SLEEPY_METRICS_PROMETHEUS_ENABLED': 'true',
+        'SLEEPY_PLUGINS_ENABLED': '[]'
+    },
+    'plugins': {
+        'SLEEPY_METRICS_ENABLED': 'false'
+        # plugins_enabled: 使用默认值
+    },
+    'full': {
+        'SLEEPY_METRICS_ENABLED': 'true',
+        'SLEEPY_METRICS_PROMETHEUS_ENABLED': 'true'
+    }
+}
+'''
+配置组合 (环境变量)
+- `base`: 关闭统计 / 插件
+- `metrics`: 启用统计 (`metrics.enabled`) 和运行时指标 (`metrics.prometheus_enabled`)
+- `plugins`: 启用默认插件
+- `full`: 全部启用
+'''
+
+
+class Scenario(t.NamedTuple):
+    name: str
+    method: str
+    path: str | t.Callable[[int], str]
+    '''请求路径 (或 `序号 -> 路径`)'''
+    json: t.Callable[[int], dict] | None = None
+    '''请求体 (`序号 -> 数据`)'''
+    devices: int | None = None
+    '''需要的设备数 (`None` 为不关心)'''
+    auth: bool = False
+    queries: int | None = None
+    '''SQL 语句数上限 (不含统计的语句, 见 `METRICS_QUERIES`; `None` 为不检查)'''
+
+
+METRICS_QUERIES = 2
+'''启用统计 (`metrics.enabled`) 时每个请求额外执行的语句数 (`Data.record_metrics()`)'''
+
+
+SCENARIOS: list[Scenario] = [
+    # 查询 / 上报的语句数不应随设备数增加
+    Scenario('query-1', 'GET', '/api/status/query', devices=1, queries=5),
+    Scenario('query-50', 'GET', '/api/status/query', devices=50, queries=5),
+    Scenario('query-1000', 'GET', '/api/status/query', devices=1000, queries=5),
+    Scenario(
+        'device-set-get', 'GET',
+        lambda i: f'/api/device/set?id=bench-0&show_name=Bench&using={str(i % 2 == 0).lower()}&status=bench+{i % 2}',
+        devices=50, auth=True, queries=5
+    ),
+    Scenario(
+        'device-set-post', 'POST', '/api/device/set',
+        json=lambda i: {'id': 'bench-0', 'show_name': 'Bench', 'using': i % 2 == 0, 'status': f'bench {i % 2}'},
+        devices=50, auth=True, queries=5
+    ),
+    Scenario('index', 'GET', '/'),
+    Scenario('metrics', 'GET', '/api/metrics'),
+    Scenario('static', 'GET', '/static-themed/default/main.css')
+]
+
+# region worker
+
+
+def _seed(d, count: int):
+    '''
+    重置设备列表为 `count` 个设备
+    '''
+    d.device_clear()
+    for i in range(count):
+        d.device_set(
+            id=f'bench-{i}',
+            show_name=f'Bench Device {i}',
+            using=i % 2 == 0,
+            status=f'Benchmarking something with a reasonably long window title #{i}'
+        )
+
+
+def _measure(client, sc: Scenario, requests: int, duration: float, warmup: int, budget: int | None) -> dict[str, t.Any]:
+    import instrument as ins  # noqa
+
+    headers = {'Sleepy-Secret': SECRET} if sc.auth else {}
+
+    def call(i: int) -> int:
+        path = sc.path(i) if callable(sc.path) else sc.path
+        resp = client.open(path, method=sc.method, headers=headers, json=sc.json(i) if sc.json else None)
+        resp.close()
+        return resp.status_code
+
+    for i in range(warmup):
+        code = call(i)
+        if code >= 400:
+            raise RuntimeError(f'{sc.method} {sc.path if isinstance(sc.path, str) else sc.path(i)} returned {code} during warmup')
+
+    if budget is not None:
+        # 超出 SQL 语句数上限时失败 (附带执行的语句)
+        with ins.assert_max_queries(budget):
+            call(warmup)
+
+    latencies: list[float] = []
+    errors = 0
+    start = perf_counter()
+    deadline = start + duration
+    i = 0
+    while i < requests:
+        t0 = perf_counter()
+        code = call(i)
+        t1 = perf_counter()
+        latencies.append(t1 - t0)
+        if code >= 400:
+            errors += 1
+        i += 1
+        if t1 > deadline:
+            break
+    return r.summarize(latencies, perf_counter() - start, errors)
+
+
+def worker(variant: str, scenarios: list[Scenario], args: argparse.Namespace) -> dict[str, dict[str, t.Any]]:
+    '''
+    (子进程) 启动应用并运行场景
+    '''
+    os.chdir(r.ROOT)
+    sys.path.insert(0, r.ROOT)
+    import main  # noqa
+
+    client = main.app.test_client()
+    overhead = METRICS_QUERIES if main.c.metrics.enabled else 0
+    results = {}
+    devices = None
+    for sc in scenarios:
+        if sc.devices is not None and sc.devices != devices:
+            _seed(main.d, sc.devices)
+            devices = sc.devices
+        budget = sc.queries + overhead if sc.queries is not None and not args.no_budget else None
+        results[f'{variant}/{sc.name}'] = _measure(client, sc, args.requests, args.duration, args.warmup, budget)
+        print(f'[bench] {variant}/{sc.name} done', file=sys.stderr, flush=True)
+    return results
+
+# endregion worker
+
+# region runner
+
+
+def run_variant(variant: str, scenarios: list[str], args: argparse.Namespace) -> dict[str, dict[str, t.Any]]:
+    '''
+    在子进程中运行一个配置组合
+    '''
+    with tempfile.TemporaryDirectory(prefix='sleepy-bench-') as tmp:
+        env = os.environ.copy()
+        env.update({
+            'SLEEPY_MAIN_DATABASE': f'sqlite:///{os.path.join(tmp, "bench.db")}',
+            'SLEEPY_MAIN_SECRET': SECRET,
+            'SLEEPY_MAIN_DEBUG': 'false',
+            'SLEEPY_MAIN_LOG_FILE': '',
+            'SLEEPY_MAIN_ACCESS_LOG': ''
+        })
+        env.update(VARIANTS[variant])
+        result_file = os.path.join(tmp, 'result.json')
+        log_file = os.path.join(tmp, 'worker.log')
+        cmd = [
+            sys.executable, os.path.abspath(__file__), '--worker', variant, '--result-file', result_file,
+            '--requests', str(args.requests), '--duration', str(args.duration), '--warmup', str(args.warmup),
+            *(['--no-budget'] if args.no_budget else []),
+            *sum((['-s', s] for s in scenarios), [])
+        ]
+        with open(log_file, 'w', encoding='utf-8') as log:
+            proc = subprocess.run(cmd, env=env, cwd=r.ROOT, stdout=log, stderr=subprocess.STDOUT)
+        if proc.returncode != 0 or not os.path.exists(result_file):
+            with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
+                tail = f.read()[-4000:]
+            raise RuntimeError(f'variant {variant} failed (exit code {proc.returncode}), worker output:\n{tail}')
+        with open(result_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sleepy in-process benchmark (Flask test client)')
+    parser.add_argument('-v', '--variant', action='append', choices=list(VARIANTS), help='config variant to run (repeatable, default: all)')
+    parser.add_argument('-s', '--scenario', action='append', help='scenario name or glob (repeatable, default: all)')
+    parser.add_argument('-n', '--requests', type=int, default=2000, help='max requests per scenario (default: 2000)')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='max seconds per scenario (default: 10)')
+    parser.add_argument('-w', '--warmup', type=int, default=50, help='warmup requests per scenario (default: 50)')
+    parser.add_argument('-o', '--output', help='save results as JSON (`-` for stdout)')
+    parser.add_argument('-c', '--compare', help='baseline JSON to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=10, help='regression threshold in percent (default: 10)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with code 1 if any regression is found')
+    parser.add_argument('--no-budget', action='store_true', help='skip the per-scenario SQL statement budget check')
+    parser.add_argument('--list', action='store_true', help='list variants and scenarios')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    patterns = args.scenario or ['*']
+    scenarios = [sc for sc in SCENARIOS if any(fnmatch.fnmatchcase(sc.name, p) for p in patterns)]
+
+    if args.worker:
+        results = worker(args.worker, scenarios, args)
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+        return
+
+    if args.list:
+        print('variants:  ' + ', '.join(VARIANTS))
+        print('scenarios: ' + ', '.join(sc.name for sc in SCENARIOS))
+        return
+    if not scenarios:
+        parser.error(f'no scenario matches {patterns}')
+
+    results: dict[str, dict[str, t.Any]] = {}
+    for variant in args.variant or list(VARIANTS):
+        print(f'[bench] running variant {variant} ...', file=sys.stderr, flush=True)
+        results.update(run_variant(variant, [sc.name for sc in scenarios], args))
+
+    out = sys.stderr if args.output == '-' else sys.stdout
+    r.print_table(results, file=out)
+    if args.output:
+        r.save(args.output, r.metadata(tool='bench/run.py', requests=args.requests, duration=args.duration, warmup=args.warmup), results)
+
+    if args.compare:
+        table, regressions = r.compare(r.load(args.compare), results, args.threshold)
+        print(f'\ncompared with {args.compare} (threshold {args.threshold}%):\n{table}', file=out)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s): {", ".join(regressions)}', file=out)
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# endregion runner
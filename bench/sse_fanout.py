@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+SSE 扇出压测: 单个服务端能承载多少 `/api/status/events` 连接, 以及一次更新多快送达所有连接
+
+对每个连接数 (`-n`, 可重复):
+1. 启动一个本地服务端 (临时数据库, 见 `--mode` / `--server-cmd`), 或使用已有服务端 (`--url` + `--pid`)
+2. 分多个进程建立 N 个 SSE 连接
+3. 发送 `--updates` 次设备更新 (扩展字段中附带序号 / 发送时间), 统计所有连接的送达延迟 (p50 / p99 / max) 及丢失数
+4. 定期采样服务端进程 (含子进程) 的 RSS / 线程数 / CPU 时间, 计算每连接内存和每次送达的 CPU 开销
+
+```
+python bench/sse_fanout.py -n 100 -n 1000 -n 3000 -o bench/fanout.json
+```
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+from time import time, sleep, perf_counter
+from urllib.request import Request, urlopen
+import typing as t
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _results as r  # noqa: E402
+from _http import Connection, HTTPError, parse_url  # noqa: E402
+from _server import SECRET, SERVER_MODES, Server  # noqa: E402
+
+DEVICE_ID = 'fanout-bench'
+
+# region process stats
+
+
+def _proc_tree(pid: int) -> list[int]:
+    '''
+    进程及其所有子进程 (Linux `/proc`)
+    '''
+    pids, i = [pid], 0
+    while i < len(pids):
+        try:
+            for task in os.listdir(f'/proc/{pids[i]}/task'):
+                with open(f'/proc/{pids[i]}/task/{task}/children', 'r') as f:
+                    pids.extend(int(c) for c in f.read().split())
+        except (OSError, ValueError):
+            pass
+        i += 1
+    return pids
+
+
+def proc_stats(pid: int) -> dict[str, float] | None:
+    '''
+    进程树的 RSS (字节) / 线程数 / CPU 时间 (秒), 不支持时返回 `None`
+    '''
+    rss = threads = cpu = 0
+    found = False
+    page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+    ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    for p in _proc_tree(pid):
+        try:
+            with open(f'/proc/{p}/statm', 'r') as f:
+                rss += int(f.read().split()[1]) * page
+            with open(f'/proc/{p}/stat', 'r') as f:
+                # comm 可能包含空格, 从最后一个 ')' 之后开始解析
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            threads += int(fields[17])
+            found = True
+        except (OSError, ValueError, IndexError):
+            continue
+    return {'rss': rss, 'threads': threads, 'cpu': cpu} if found else None
+
+
+class Sampler(threading.Thread):
+    '''
+    定期采样服务端进程状态, 记录峰值
+    '''
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True, name='fanout-sampler')
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss: int = 0
+        self.peak_threads: int = 0
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            s = proc_stats(self.pid)
+            if s:
+                self.peak_rss = max(self.peak_rss, int(s['rss']))
+                self.peak_threads = max(self.peak_threads, int(s['threads']))
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+# endregion process stats
+
+# region viewers
+
+
+async def _viewers(url: str, count: int, args: dict, stop, connected) -> dict[str, t.Any]:
+    target = parse_url(url)
+    gate = asyncio.Semaphore(args['connect_concurrency'])
+    latencies: list[float] = []
+    errors: Counter[str] = Counter()
+    delivered = 0
+
+    async def viewer():
+        nonlocal delivered
+        last_seq = None
+        for attempt in range(args['retries'] + 1):
+            conn = Connection(target, args['timeout'])
+            stream = conn.events('/api/status/events')
+            try:
+                async with gate:
+                    # 收到首个事件 (连接时推送的当前状态) 视为已连接
+                    evt = await anext(stream)
+            except (HTTPError, StopAsyncIteration) as e:
+                if attempt == args['retries']:
+                    errors[f'connect:{str(e).split(":", 1)[0] or "closed"}'] += 1
+                    return
+                await asyncio.sleep(1)
+                continue
+            break
+        with connected.get_lock():
+            connected.value += 1
+        try:
+            while True:
+                if evt.event == 'update':
+                    try:
+                        fields = json.loads(evt.data)['device'][DEVICE_ID].get('fields') or {}
+                    except (ValueError, KeyError, TypeError):
+                        errors['invalid_data'] += 1
+                        fields = {}
+                    seq = fields.get('fo_seq')
+                    if seq is not None and seq != last_seq:
+                        if last_seq is not None:
+                            latencies.append(time() - fields['fo_ts'])
+                            delivered += 1
+                        last_seq = seq
+                evt = await anext(stream)
+        except StopAsyncIteration:
+            errors['closed'] += 1
+        except HTTPError as e:
+            errors[f'dropped:{str(e).split(":", 1)[0]}'] += 1
+
+    tasks = [asyncio.create_task(viewer()) for _ in range(count)]
+    while not stop.is_set():
+        await asyncio.sleep(0.1)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {'latencies': latencies, 'delivered': delivered, 'errors': dict(errors)}
+
+
+def viewer_process(url: str, count: int, args: dict, stop, connected, results):
+    '''
+    (子进程) 建立 `count` 个 SSE 连接, 结束后把统计放入 `results` 队列
+    '''
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    results.put(asyncio.run(_viewers(url, count, args, stop, connected)))
+
+# endregion viewers
+
+# region runner
+
+
+def _post_update(url: str, seq: int):
+    body = json.dumps({
+        'secret': SECRET,
+        'id': DEVICE_ID,
+        'show_name': 'Fan-out Bench',
+        'using': True,
+        'status': f'update #{seq}',
+        'fields': {'fo_seq': seq, 'fo_ts': time()}
+    }).encode()
+    req = Request(f'{url}/api/device/set', data=body, headers={'Content-Type': 'application/json'}, method='POST')
+    with urlopen(req, timeout=30) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f'device/set returned {resp.status}')
+
+
+def run_step(url: str, pid: int | None, count: int, args: argparse.Namespace) -> dict[str, t.Any]:
+    '''
+    对已启动的服务端运行一轮 (N 个连接)
+    '''
+    _post_update(url, 0)
+    base = proc_stats(pid) if pid else None
+    sampler = Sampler(pid) if pid and base else None
+    if sampler:
+        sampler.start()
+
+    ctx = mp.get_context('spawn')
+    stop, connected, results = ctx.Event(), ctx.Value('i', 0), ctx.Queue()
+    procs = max(1, min(args.processes, count))
+    shares = [count // procs + (1 if i < count % procs else 0) for i in range(procs)]
+    opts = {'timeout': args.timeout, 'connect_concurrency': args.connect_concurrency, 'retries': args.retries}
+    workers = [ctx.Process(target=viewer_process, args=(url, n, opts, stop, connected, results), daemon=True) for n in shares]
+    connect_start = perf_counter()
+    for w in workers:
+        w.start()
+
+    # 等待连接建立
+    deadline = time() + args.connect_timeout
+    last, stalled_since = -1, time()
+    while connected.value < count and time() < deadline:
+        sleep(0.2)
+        if connected.value != last:
+            last, stalled_since = connected.value, time()
+        elif time() - stalled_since > 15:
+            # 15 秒无新连接 -> 视为已达上限
+            break
+    connect_seconds = perf_counter() - connect_start
+    sleep(args.settle)
+    loaded = proc_stats(pid) if pid else None
+
+    # 发送更新
+    update_start = perf_counter()
+    for seq in range(1, args.updates + 1):
+        _post_update(url, seq)
+        sleep(args.update_interval)
+    sleep(args.drain)
+    update_seconds = perf_counter() - update_start
+    after = proc_stats(pid) if pid else None
+
+    stop.set()
+    latencies: list[float] = []
+    delivered = 0
+    errors: Counter[str] = Counter()
+    for _ in workers:
+        res = results.get()
+        latencies.extend(res['latencies'])
+        delivered += res['delivered']
+        errors.update(res['errors'])
+    for w in workers:
+        w.join()
+    if sampler:
+        sampler.stop()
+
+    ok = connected.value
+    expected = ok * args.updates
+    extra: dict[str, t.Any] = {
+        'connections': count,
+        'connected': ok,
+        'connect_seconds': round(connect_seconds, 3),
+        'deliveries_expected': expected,
+        'missed': max(0, expected - delivered),
+        'stream_errors': dict(errors)
+    }
+    if base and loaded and after and sampler:
+        extra.update({
+            'rss_base': int(base['rss']),
+            'rss_loaded': int(loaded['rss']),
+            'rss_peak': sampler.peak_rss,
+            'rss_per_conn_kib': round((loaded['rss'] - base['rss']) / ok / 1024, 2) if ok else None,
+            'threads_base': int(base['threads']),
+            'threads_loaded': int(loaded['threads']),
+            'threads_peak': sampler.peak_threads,
+            'cpu_seconds': round(after['cpu'] - loaded['cpu'], 3),
+            'cpu_us_per_delivery': round((after['cpu'] - loaded['cpu']) / delivered * 1e6, 2) if delivered else None
+        })
+    return r.summarize(latencies, update_seconds, errors=extra['missed'] + count - ok, count=delivered, **extra)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sleepy SSE fan-out stress benchmark')
+    parser.add_argument('-n', '--connections', type=int, action='append', help='SSE connections per step (repeatable, default: 100, 1000)')
+    parser.add_argument('-m', '--mode', choices=list(SERVER_MODES), default='dev', help='how to start the local server (default: dev)')
+    parser.add_argument('--server-cmd', help='custom server command ({port} is replaced), run in repo root')
+    parser.add_argument('--url', help='use an existing server instead of starting one (must use secret "bench-secret")')
+    parser.add_argument('--pid', type=int, help='server pid for RSS / thread / CPU sampling when using --url')
+    parser.add_argument('--label', help='result label (default: mode name)')
+    parser.add_argument('-u', '--updates', type=int, default=10, help='device updates per step (default: 10)')
+    parser.add_argument('-i', '--update-interval', type=float, default=2, help='seconds between updates (default: 2)')
+    parser.add_argument('--drain', type=float, default=3, help='seconds to wait for deliveries after the last update (default: 3)')
+    parser.add_argument('--settle', type=float, default=2, help='seconds to wait after connecting before sampling (default: 2)')
+    parser.add_argument('-j', '--processes', type=int, default=min(os.cpu_count() or 1, 8), help='viewer processes (default: cpu count, max 8)')
+    parser.add_argument('--connect-concurrency', type=int, default=50, help='concurrent connection attempts per process (default: 50)')
+    parser.add_argument('--connect-timeout', type=float, default=120, help='max seconds to establish all connections (default: 120)')
+    parser.add_argument('--timeout', type=float, default=30, help='connect timeout in seconds (default: 30)')
+    parser.add_argument('--retries', type=int, default=2, help='connection retries per viewer, 1s apart (default: 2)')
+    parser.add_argument('-o', '--output', help='save results as JSON (`-` for stdout)')
+    parser.add_argument('-c', '--compare', help='baseline JSON to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=10, help='regression threshold in percent (default: 10)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with code 1 if any regression is found')
+    args = parser.parse_args()
+
+    label = args.label or ('external' if args.url else 'custom' if args.server_cmd else args.mode)
+    cmd = args.server_cmd.split() if args.server_cmd else SERVER_MODES[args.mode]
+    out = sys.stderr if args.output == '-' else sys.stdout
+
+    results: dict[str, dict[str, t.Any]] = {}
+    for count in args.connections or [100, 1000]:
+        print(f'[fanout] {label}: {count} connections ...', file=sys.stderr, flush=True)
+        if args.url:
+            results[f'fanout/{label}/{count}'] = run_step(args.url.rstrip('/'), args.pid, count, args)
+            continue
+        with tempfile.TemporaryDirectory(prefix='sleepy-fanout-') as tmp:
+            server = Server(cmd, tmp)
+            try:
+                results[f'fanout/{label}/{count}'] = run_step(server.url, server.pid, count, args)
+            finally:
+                server.stop()
+
+    r.print_table(results, file=out)
+    print(file=out)
+    for name, res in results.items():
+        print(
+            f'{name}: {res["connected"]}/{res["connections"]} connected in {res["connect_seconds"]}s, '
+            f'missed {res["missed"]}/{res["deliveries_expected"]}'
+            + (f', rss {res["rss_loaded"] / 1048576:.1f} MiB (+{res["rss_per_conn_kib"]} KiB/conn), '
+               f'threads {res["threads_loaded"]}, cpu {res["cpu_us_per_delivery"]} us/delivery' if 'rss_loaded' in res else '')
+            + (f', errors {res["stream_errors"]}' if res['stream_errors'] else ''),
+            file=out
+        )
+
+    if args.output:
+        meta = r.metadata(
+            tool='bench/sse_fanout.py', label=label, server_cmd=cmd if not args.url else None,
+            updates=args.updates, update_interval=args.update_interval
+        )
+        r.save(args.output, meta, results)
+
+    if args.compare:
+        table, regressions = r.compare(r.load(args.compare), results, args.threshold)
+        print(f'\ncompared with {args.compare} (threshold {args.threshold}%):\n{table}', file=out)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s): {", ".join(regressions)}', file=out)
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# endregion runner
@@ -0,0 +1,267 @@
+# coding: utf-8
+
+'''
+数据变更通知 (供 SSE 等需要等待数据变化的连接使用)
+'''
+
+import os
+import socket
+import atexit
+import hashlib
+import tempfile
+from logging import getLogger
+from threading import Condition, Thread, Lock, Timer
+from time import sleep, monotonic
+import typing as t
+
+import instrument as ins
+
+l = getLogger(__name__)
+
+_MISSING = object()
+_TOPIC_MAX = 512
+'''跨进程通知中主题的最大长度 (字节, 超出则按未指定主题通知)'''
+
+
+def peer_dir(key: str) -> str:
+    '''
+    获取跨进程通知使用的 socket 目录 (同一个 key 的进程互相通知)
+
+    :param key: 进程间共享的标识 (如数据库地址)
+    '''
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=6).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f'sleepy-notify-{digest}')
+
+
+class Broadcaster:
+    '''
+    数据变更广播
+    - 进程内: 递增的版本号 + `Condition`, 数据变化时唤醒所有等待者
+    - 跨进程: 每个进程在同一目录下绑定一个 Unix datagram socket, 数据变化时向其他进程的 socket 各发送一个字节, 由接收线程唤醒本进程的等待者
+    - 不支持 Unix socket 时 (如 Windows) / 多台服务器共用数据库时, 由后台线程定期检查数据版本 (`poll`)
+    - 变更可带主题 (如 `status` / `device:<id>`), 等待时指定主题的订阅者只在相关变更时返回 (未指定主题的变更对所有订阅者有效)
+    - 合并窗口: 距上次唤醒超过 `window` 的变更立即唤醒等待者, 窗口内的其他变更合并到窗口结束时唤醒一次 (无论写入频率多高, 每个订阅者每个窗口最多收到一次推送)
+    '''
+
+    def __init__(self, socket_dir: str | None = None, poll: t.Callable[[], t.Any] | None = None, poll_interval: float = 1, window: float = 0):
+        '''
+        :param socket_dir: 跨进程通知的 socket 目录 (为空则不使用 socket)
+        :param poll: socket 不可用时, 用于检查数据是否变化的函数 (返回值变化即视为数据变化, 为空则只在进程内通知)
+        :param poll_interval: 检查间隔 (秒)
+        :param window: 合并窗口 (秒, 0 为不合并)
+        '''
+        self._cond = Condition()
+        self.version: int = 0
+        '''数据版本 (每次唤醒等待者时 +1, 合并窗口内的多次变更只 +1, 仅在本进程内有意义)'''
+        self.window = window
+        self._published_at: float = float('-inf')
+        self._flush_timer: Timer | None = None
+        self.mode: str = 'local'
+        '''跨进程通知方式: `local` (仅进程内) / `socket` / `poll`'''
+        self._topics: dict[str, int] = {}
+        '''主题 -> 最后一次变更所在的版本'''
+        self._untargeted: int = 0
+        '''最后一次未指定主题的变更所在的版本'''
+        self.stopping = False
+        '''服务端是否正在停止 (此后 `wait()` 不再阻塞)'''
+
+        self._dir = socket_dir
+        self._path: str | None = None
+        self._sock: socket.socket | None = None
+        self._sender: socket.socket | None = None
+        self._poll_lock = Lock()
+        self._polled: t.Any = _MISSING
+
+        if socket_dir:
+            if hasattr(socket, 'AF_UNIX'):
+                try:
+                    self._bind(socket_dir)
+                except OSError as e:
+                    l.warning(f'[broadcast] Cannot bind notify socket in {socket_dir}: {e}')
+            else:
+                l.debug('[broadcast] Unix socket is not supported on this platform')
+        if not self._sock and poll:
+            self.mode = 'poll'
+            Thread(target=self._poll_loop, args=(poll, poll_interval), daemon=True, name='broadcast-poll').start()
+        l.debug(f'[broadcast] Change notification mode: {self.mode}')
+
+    # region socket
+
+    def _bind(self, socket_dir: str):
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        path = os.path.join(socket_dir, f'{os.getpid()}.sock')
+        try:
+            # 同 pid 的旧进程遗留
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        self._sock, self._sender, self._path = sock, sender, path
+        self.mode = 'socket'
+        Thread(target=self._recv_loop, daemon=True, name='broadcast-recv').start()
+        atexit.register(self.close)
+
+    def _recv_loop(self):
+        sock = self._sock
+        assert sock
+        while True:
+            try:
+                msg = sock.recv(_TOPIC_MAX)
+            except OSError:
+                # 已关闭
+                return
+            topic = None
+            if msg != b'1' and len(msg) < _TOPIC_MAX:
+                topic = msg.decode('utf-8', errors='replace')
+            self._bump('remote', topic)
+
+    def _send(self, topic: str | None):
+        '''
+        通知其他进程
+
+        :param topic: 变更主题
+        '''
+        assert self._dir and self._sender
+        msg = topic.encode('utf-8') if topic else b'1'
+        if len(msg) >= _TOPIC_MAX:
+            msg = b'1'
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._dir, name)
+            if path == self._path or not name.endswith('.sock'):
+                continue
+            try:
+                self._sender.sendto(msg, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 对应进程已退出
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                # 对方接收缓冲区已满 (已有未处理的通知)
+                pass
+            except OSError as e:
+                l.debug(f'[broadcast] Notify {path} failed: {e}')
+
+    def close(self):
+        '''
+        关闭 socket (进程退出时自动调用)
+        '''
+        for s in (self._sock, self._sender):
+            if s:
+                s.close()
+        self._sock = self._sender = None
+        if self._path:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+            self._path = None
+
+    # endregion socket
+
+    # region poll
+
+    def _poll_loop(self, poll: t.Callable[[], t.Any], interval: float):
+        while True:
+            sleep(interval)
+            try:
+                value = poll()
+            except Exception as e:
+                l.debug(f'[broadcast] Poll failed: {e}')
+                continue
+            with self._poll_lock:
+                changed = self._polled is not _MISSING and value != self._polled
+                self._polled = value
+            if changed:
+                self._bump('poll')
+
+    # endregion poll
+
+    def _bump(self, source: str, topic: str | None = None):
+        with self._cond:
+            # 变更属于下一个版本 (立即发布或等合并窗口结束时发布)
+            if topic is None:
+                self._untargeted = self.version + 1
+            else:
+                self._topics[topic] = self.version + 1
+            if not self._flush_timer:
+                now = monotonic()
+                delay = self._published_at + self.window - now
+                if delay <= 0:
+                    self._publish(now)
+                else:
+                    self._flush_timer = Timer(delay, self._flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+        ins.change_notifications.inc(source=source)
+
+    def _publish(self, now: float):
+        '''
+        (需持有 `_cond`) 发布新版本, 唤醒等待者
+        '''
+        self.version += 1
+        self._published_at = now
+        self._cond.notify_all()
+        ins.change_publishes.inc()
+
+    def _flush(self):
+        with self._cond:
+            self._flush_timer = None
+            self._publish(monotonic())
+
+    def notify(self, stamp: t.Any = _MISSING, topic: str | None = None):
+        '''
+        通知数据已变化 (唤醒本进程及其他进程的等待者)
+
+        :param stamp: 写入后的数据版本 (与 `poll` 返回值对应, 轮询模式下避免本进程的修改被重复通知)
+        :param topic: 变更主题 (为空则对所有订阅者有效)
+        '''
+        if stamp is not _MISSING and self.mode == 'poll':
+            with self._poll_lock:
+                self._polled = stamp
+        self._bump('local', topic)
+        if self._sender:
+            self._send(topic)
+
+    def stop(self):
+        '''
+        停止: 立即发布合并窗口内未发布的变更, 并唤醒所有等待者 (之后的 `wait()` 立即返回, 由调用方检查是否需要退出)
+        '''
+        with self._cond:
+            self.stopping = True
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+                self._publish(monotonic())
+            self._cond.notify_all()
+
+    def _changed(self, version: int, topics: t.Collection[str] | None) -> bool:
+        if self.stopping:
+            return True
+        if self.version == version:
+            return False
+        if topics is None or self._untargeted > version:
+            return True
+        return any(self._topics.get(i, 0) > version for i in topics)
+
+    def wait(self, version: int, timeout: float | None = None, topics: t.Collection[str] | None = None) -> int:
+        '''
+        等待数据版本变化
+
+        :param version: 已知的版本
+        :param timeout: 超时时间 (秒)
+        :param topics: 只等待这些主题的变更 (为空则等待任意变更)
+        :return: 有相关变更 / 正在停止时返回当前版本, 超时返回 `version`
+        '''
+        with self._cond:
+            if self._cond.wait_for(lambda: self._changed(version, topics), timeout):
+                return self.version
+            return version
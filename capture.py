@@ -0,0 +1,169 @@
+# coding: utf-8
+
+'''
+流量录制 (见 `diagnostics.capture_file`, 回放见 `bench/replay.py`)
+'''
+
+import hashlib
+import json
+import atexit
+import os
+import re
+from logging import getLogger, Formatter, INFO
+from logging.handlers import QueueListener
+from random import random
+from time import time
+import typing as t
+
+import flask
+
+import utils as u
+from models import ConfigModel
+
+l = getLogger(__name__)
+
+FORMAT_VERSION = 1
+'''录制文件格式版本 (每次启动时写入一行 `{"type": "start", "v": 版本}`)'''
+
+_keep_value_pattern = re.compile(r'-?\d+(\.\d+)?|true|false|yes|no|on|off', re.IGNORECASE)
+'''保留原值的参数 (数字 / 布尔值)'''
+
+KEEP_ARGS = {'theme', 'meta', 'metrics', 'tracemalloc'}
+'''始终保留原值的参数'''
+
+SECRET_KEYS = {'secret'}
+'''需要脱敏的参数 / 请求体键'''
+
+
+class TrafficCapture:
+    '''
+    流量录制
+    - 每个请求一行 JSON (JSON Lines), 由后台线程写入
+    - 记录 方法 / 路径 / 参数 / 请求体结构 / 鉴权方式 / 耗时 / 状态码
+    - secret 只记录来源 (不记录值); 其他字符串只记录长度和哈希 (回放时生成相同长度的占位字符串, 同一字符串得到同一占位)
+    '''
+
+    def __init__(self, config: ConfigModel):
+        self._rate = config.diagnostics.capture_sample
+        self._salt = os.urandom(16)
+        '''哈希盐 (仅保存在内存中, 录制文件无法还原原始字符串)'''
+
+        path = u.get_path(config.diagnostics.capture_file)
+        fhandler = u.LogFileHandler(
+            path,
+            max_bytes=config.main.log_max_bytes,
+            backup_count=config.main.log_backup_count,
+            compress=config.main.log_compress,
+            timezone=config.main.timezone
+        )
+        fhandler.setFormatter(Formatter('%(message)s'))
+        self.handler = u.DropQueueHandler(config.main.log_queue_size)
+        self._listener = QueueListener(self.handler.queue, fhandler)
+        self._listener.start()
+
+        self._logger = getLogger('sleepy.capture')
+        self._logger.propagate = False
+        self._logger.setLevel(INFO)
+        self._logger.handlers.clear()
+        self._logger.addHandler(self.handler)
+
+        self._write({'v': FORMAT_VERSION, 'type': 'start', 't': round(time(), 3)})
+        atexit.register(self.stop)
+        l.info(f'[capture] Recording traffic to {path} (sample rate: {self._rate})')
+
+    def _write(self, entry: dict[str, t.Any]):
+        self._logger.info(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
+
+    def _hash(self, value: str) -> str:
+        return hashlib.blake2b(value.encode('utf-8', errors='replace'), digest_size=4, key=self._salt).hexdigest()
+
+    def _shape_str(self, value: str) -> dict[str, t.Any]:
+        return {'$s': len(value), 'h': self._hash(value)}
+
+    def shape(self, value: t.Any) -> t.Any:
+        '''
+        生成请求体结构 (字符串 -> `{"$s": 长度, "h": 哈希}`, 其他基础类型保留原值, secret 替换为 `{"$secret": true}`)
+        '''
+        if isinstance(value, dict):
+            return {k: {'$secret': True} if k in SECRET_KEYS else self.shape(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [self.shape(i) for i in value]
+        elif isinstance(value, str):
+            return self._shape_str(value)
+        return value
+
+    def _args(self, args: t.Mapping[str, str]) -> dict[str, t.Any]:
+        ret = {}
+        for k, v in args.items():
+            if k in SECRET_KEYS:
+                ret[k] = {'$secret': True}
+            elif k in KEEP_ARGS or _keep_value_pattern.fullmatch(v):
+                ret[k] = v
+            else:
+                ret[k] = self._shape_str(v)
+        return ret
+
+    @staticmethod
+    def _auth_source(req: flask.Request, body: t.Any) -> str | None:
+        '''
+        请求携带 secret 的方式 (无论是否正确)
+        '''
+        if isinstance(body, dict) and 'secret' in body:
+            return 'body'
+        if 'secret' in req.args:
+            return 'param'
+        if 'Sleepy-Secret' in req.headers:
+            return 'header'
+        if req.headers.get('Authorization', '').startswith('Bearer '):
+            return 'bearer'
+        if 'sleepy-secret' in req.cookies:
+            return 'cookie'
+        return None
+
+    def record(self, resp: flask.Response, endpoint: str, ms: float):
+        '''
+        记录当前请求 (在 after_request 中调用)
+
+        :param resp: 响应
+        :param endpoint: 路由 endpoint 名称
+        :param ms: 处理耗时 (毫秒)
+        '''
+        if self._rate < 1 and random() >= self._rate:
+            return
+        req = flask.request
+        entry: dict[str, t.Any] = {
+            't': round(time() - ms / 1000, 4),
+            'm': req.method,
+            'p': req.path,
+            'e': endpoint,
+            's': resp.status_code,
+            'd': ms
+        }
+        if req.args:
+            entry['a'] = self._args(req.args)
+        body = None
+        if req.is_json:
+            body = req.get_json(silent=True)
+            if body is not None:
+                entry['b'] = self.shape(body)
+        elif req.form:
+            entry['f'] = self._args(req.form)
+        elif req.content_length:
+            entry['bl'] = req.content_length
+        if req.content_type:
+            entry['ct'] = req.content_type.split(';', 1)[0]
+        auth = self._auth_source(req, body)
+        if auth:
+            entry['au'] = auth
+            if flask.g.get('auth') == 'failed':
+                entry['af'] = True
+        if req.cookies.get('sleepy-theme'):
+            entry['th'] = req.cookies['sleepy-theme']
+        self._write(entry)
+
+    def stop(self):
+        '''
+        停止后台写入
+        '''
+        self._listener.stop()
+
@@ -200,10 +200,32 @@ Url = f'{SERVER}/api/device/set'
 last_window = ''
 
 
+_client: httpx.AsyncClient | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+
+
+def get_client() -> httpx.AsyncClient:
+    '''
+    获取复用的 httpx.AsyncClient (保持连接, 不必每次发送都重新建立 TCP / TLS 连接)
+    每个事件循环使用单独的客户端 (关机回调会在新的事件循环中发送)
+    '''
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            proxy=PROXY or None,  # type: ignore
+            headers={
+                'Content-Type': 'application/json'
+            }
+        )
+        _client_loop = loop
+    return _client
+
+
 async def send_status(using: bool = True, status: str = '', id: str = DEVICE_ID, show_name: str = DEVICE_SHOW_NAME, timeout: float = 7.5, **kwargs):
     '''
     httpx.AsyncClient.post 发送设备状态信息
-    设置了 headers 和 proxies
+    使用 `get_client()` 复用连接 (已设置 headers 和 proxies)
     '''
     json_data = {
         'secret': SECRET,
@@ -213,28 +235,12 @@ async def send_status(using: bool = True, status: str = '', id: str = DEVICE_ID,
         'status': status
     }
 
-    if PROXY:
-        async with httpx.AsyncClient(proxy=PROXY, timeout=timeout) as client:  # type: ignore
-            return await client.post(
-                url=Url,
-                json=json_data,
-                headers={
-                    'Content-Type': 'application/json'
-                },
-                timeout=timeout,
-                **kwargs
-            )
-    else:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            return await client.post(
-                url=Url,
-                json=json_data,
-                headers={
-                    'Content-Type': 'application/json'
-                },
-                timeout=timeout,
-                **kwargs
-            )
+    return await get_client().post(
+        url=Url,
+        json=json_data,
+        timeout=timeout,
+        **kwargs
+    )
 
 # ----- Part: Shutdown handler
 
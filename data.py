@@ -2,15 +2,20 @@
 
 from datetime import datetime
 from logging import getLogger
-from threading import Thread
+from threading import Thread, RLock
 from time import sleep, time
-from typing import Any
+from typing import Any, Callable
+from os import getpid
 from io import BytesIO
+from copy import deepcopy
+import atexit
+import hashlib
+import json
 
 from werkzeug.security import safe_join
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import JSON, Integer, Float, String, Boolean, Text
+from sqlalchemy import JSON, Integer, Float, String, Boolean, Text, func, select
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.exc import SQLAlchemyError
 from objtyping import to_primitive
@@ -18,12 +23,16 @@ import pytz
 import schedule
 
 import utils as u
+import instrument as ins
+from broadcast import Broadcaster, peer_dir
 from models import ConfigModel, _StatusItemModel
 
 l = getLogger(__name__)
 
 db = SQLAlchemy()
 LIMIT = 1024
+KEY_LIMIT = 255
+_MISSING = object()
 
 # -----
 
@@ -97,18 +106,84 @@ class _PluginData(db.Model):
     '''插件数据'''
 
 
+class _PluginKVData(db.Model):
+    '''
+    插件键值数据
+    '''
+    __tablename__ = 'plugin_kv'
+    plugin: Mapped[str] = mapped_column(String(KEY_LIMIT), primary_key=True, nullable=False)
+    '''插件 id'''
+    key: Mapped[str] = mapped_column(String(KEY_LIMIT), primary_key=True, nullable=False)
+    '''键'''
+    value: Mapped[Any] = mapped_column(JSON, nullable=True)
+    '''值'''
+    expires: Mapped[float | None] = mapped_column(Float, nullable=True)
+    '''过期时间 (utc timestamp, 为空则永不过期)'''
+
+
+class _ChangeJournalData(db.Model):
+    '''
+    变更日志 (每次修改状态 / 设备 / 隐私模式时追加一条)
+    '''
+    __tablename__ = 'change_journal'
+    __table_args__ = {'sqlite_autoincrement': True}  # 清空后序号也不重复
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    '''序号 (递增)'''
+    time: Mapped[float] = mapped_column(Float, nullable=False, default=time)
+    '''变更时间 (utc timestamp)'''
+    type: Mapped[str] = mapped_column(String(32), nullable=False)
+    '''变更类型: `status` / `private_mode` / `device_set` / `device_remove` / `device_clear`'''
+    device: Mapped[str | None] = mapped_column(String(LIMIT), nullable=True)
+    '''设备 id (设备相关变更)'''
+    data: Mapped[Any] = mapped_column(JSON, nullable=True)
+    '''变更后的数据 (状态 id / 隐私模式 / 设备信息)'''
+
+
 # -----
 
 
+def _memory_database(uri: str) -> bool:
+    '''
+    是否为 SQLite 内存数据库 (每个进程独立, 不与其他 worker 共享)
+    '''
+    return uri.rstrip('/') == 'sqlite:' or (uri.startswith('sqlite:') and ':memory:' in uri)
+
+
+def _database_key(uri: str) -> str:
+    '''
+    数据库地址的短摘要 (用于区分使用不同数据库的实例, 如同一目录下启动的主实例和副本)
+    '''
+    return hashlib.blake2b(uri.encode('utf-8'), digest_size=6).hexdigest()
+
+
 class Data:
     '''
     data 类, 定义 sql 数据表格式
     '''
 
+    workers: int | None = None
+    '''实际的 worker 进程数 (由启动入口在创建实例前设置, 为空则使用 `server.workers` 配置, 如由 uwsgi 等直接导入 `main:app` 时)'''
+
     def __init__(self, config: ConfigModel, app: Flask):
         perf = u.perf_counter()
         self._app = app
         self._c = config
+        workers = self._c.server.workers if self.workers is None else self.workers
+        self._shared = workers != 1 and not _memory_database(self._c.main.database)
+        '''是否与其他 worker 进程共享数据库 (不在进程内缓存插件数据)'''
+        self._leader = u.FileLock(u.get_path(f'data/.schedule-{_database_key(self._c.main.database)}.lock'))
+        '''定时任务锁 (共用同一个数据库的多个 worker 中只由持有锁的进程执行全局任务, 不共享数据库时不使用)'''
+        self._kv_lock = u.FileLock(u.get_path(f'data/.plugin-kv-{_database_key(self._c.main.database)}.lock'))
+        '''插件键值的跨进程锁 (共享数据库时保证 `plugin_kv_incr()` 的读取-修改-写入不被其他 worker 打断)'''
+        self.read_only = bool(self._c.replica.primary or self._c.aggregator.upstreams)
+        '''是否为只读副本 / 聚合模式 (状态只能从主实例 / 上游同步)'''
+        self.changes = Broadcaster(
+            socket_dir=peer_dir(self._c.main.database) if self._shared and self._c.server.notify_socket else None,
+            poll=(lambda: self.last_updated) if self._shared else None,
+            poll_interval=self._c.server.notify_poll,
+            window=self._c.server.notify_window
+        )
+        '''数据变更通知 (设备 / 状态 / 隐私模式变化时触发, 多个 worker 时跨进程通知)'''
         # 配置数据库地址
         app.config['SQLALCHEMY_DATABASE_URI'] = self._c.main.database
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -116,6 +191,7 @@ class Data:
         # 初始化数据库
         db.init_app(app)
         with app.app_context():
+            ins.instrument_engine(db.engine)
             db.create_all()
             main_data = _MainData.query.first()
             if not main_data:
@@ -135,6 +211,9 @@ class Data:
             self._schedule_loop_th = Thread(target=self._schedule_loop, daemon=True)
             self._schedule_loop_th.start()
 
+        # 退出时写回插件数据
+        atexit.register(self.plugin_data_flush)
+
         l.debug(f'[data] init took {perf()}ms')
 
     def _throw(self, e: SQLAlchemyError):
@@ -145,16 +224,59 @@ class Data:
         raise u.APIUnsuccessful(500, 'Database Error')
 
     def _schedule_loop(self):
-        if self._c.metrics.enabled:
-            # 先执行一次
-            self._metrics_refresh()
-            schedule.every().day.at('00:00:00', self._c.main.timezone).do(self._metrics_refresh)  # metrics check
+        # 进程内任务
         schedule.every(self._c.main.cache_age).seconds.do(self._clean_cache)  # cache
+        # 立即写入时 (`plugin_data_flush <= 0` / 多个 worker) 也定期检查, 写回未能立即写入的修改
+        schedule.every(max(self._c.main.plugin_data_flush, 1)).seconds.do(self.plugin_data_flush)  # plugin data write-behind
+        # 全局任务 (共享数据库时只在持有锁的进程中执行)
+        if self._c.metrics.enabled:
+            schedule.every().day.at('00:00:00', self._c.main.timezone).do(self._leader_job, self._metrics_refresh)  # metrics check
+        schedule.every(60).seconds.do(self._leader_job, self._journal_prune)  # change journal retention
 
+        if not self._shared:
+            # 不与其他进程共享数据库, 始终执行全局任务
+            self._leader_start()
         while True:
+            if self._shared and not self._leader.locked:
+                self._elect()
             schedule.run_pending()
             sleep(1)
 
+    def _elect(self):
+        '''
+        尝试成为执行全局任务的进程 (原进程退出后由其他进程接管)
+        '''
+        if not self._leader.acquire(blocking=False):
+            return
+        l.info(f'[data] worker {getpid()} is now running scheduled tasks')
+        self._leader_start()
+
+    def _leader_start(self):
+        '''
+        成为 leader 时先执行一次全局任务 (启动 / 接管时可能错过了定时任务)
+        '''
+        if self._c.metrics.enabled:
+            self._metrics_refresh()
+        self._journal_prune()
+
+    def _check_writable(self):
+        '''
+        只读副本不允许直接修改状态 (包括插件的修改)
+        '''
+        if self.read_only:
+            raise u.APIUnsuccessful(403, 'This is a read-only replica / aggregator, please send writes to the primary / upstream')
+
+    def _leader_job(self, job: Callable[[], Any]):
+        if self.is_leader:
+            job()
+
+    @property
+    def is_leader(self) -> bool:
+        '''
+        当前进程是否负责执行全局任务 (未与其他进程共享数据库时始终为 `True`)
+        '''
+        return not self._shared or self._leader.locked
+
     # --- 主程序数据访问
 
     @property
@@ -171,13 +293,17 @@ class Data:
 
     @status_id.setter
     def status_id(self, value: int):
+        self._check_writable()
         try:
             with self._app.app_context():
                 maindata: _MainData = _MainData.query.first()  # type: ignore
                 maindata.status = value
+                maindata.last_updated = updated = time()
+                self._journal('status', data=value)
                 db.session.commit()
         except SQLAlchemyError as e:
             self._throw(e)
+        self.changes.notify(updated, 'status')
 
     def get_status(self, status_id: int) -> tuple[bool, _StatusItemModel]:
         '''
@@ -231,13 +357,17 @@ class Data:
 
     @private_mode.setter
     def private_mode(self, value: bool):
+        self._check_writable()
         try:
             with self._app.app_context():
                 maindata: _MainData = _MainData.query.first()  # type: ignore
                 maindata.private_mode = value
+                maindata.last_updated = updated = time()
+                self._journal('private_mode', data=value)
                 db.session.commit()
         except SQLAlchemyError as e:
             self._throw(e)
+        self.changes.notify(updated, 'private_mode')
 
     @property
     def last_updated(self) -> float:
@@ -260,6 +390,17 @@ class Data:
                 db.session.commit()
         except SQLAlchemyError as e:
             self._throw(e)
+        self.changes.notify(value)
+
+    def _touch(self) -> float:
+        '''
+        (需在 app context 中, 随当前事务提交) 更新数据最后更新时间 (通知由调用方发送)
+
+        :return: 更新时间
+        '''
+        maindata: _MainData = _MainData.query.first()  # type: ignore
+        maindata.last_updated = updated = time()
+        return updated
 
     # --- 设备状态接口
 
@@ -355,6 +496,7 @@ class Data:
         :param status: 设备状态文本
         :param fields: 扩展字段
         '''
+        self._check_writable()
         try:
             with self._app.app_context():
                 device = _DeviceStatusData.query.filter_by(id=id).first()
@@ -372,10 +514,13 @@ class Data:
                 device.using = using if using is not None else device.using
                 device.status = status or device.status
                 device.fields = u.deep_merge_dict(device.fields, fields)
+                device.last_updated = time()
+                self._journal('device_set', id, self._device_dict(device))
+                updated = self._touch()
                 db.session.commit()
-                self.last_updated = time()
         except SQLAlchemyError as e:
             self._throw(e)
+        self.changes.notify(updated, f'device:{id}')
 
     def device_remove(self, id: str):
         '''
@@ -383,27 +528,278 @@ class Data:
 
         :param id: 设备唯一 id
         '''
+        self._check_writable()
         try:
             with self._app.app_context():
                 device: _DeviceStatusData | None = _DeviceStatusData.query.filter_by(id=id).first()
-                if device:
-                    db.session.delete(device)
-                    db.session.commit()
-                    self.last_updated = time()
+                if not device:
+                    return
+                db.session.delete(device)
+                self._journal('device_remove', id)
+                updated = self._touch()
+                db.session.commit()
         except SQLAlchemyError as e:
             self._throw(e)
+        self.changes.notify(updated, f'device:{id}')
 
     def device_clear(self):
         '''
         清除设备状态
         '''
+        self._check_writable()
         try:
             with self._app.app_context():
                 _DeviceStatusData.query.delete()
+                self._journal('device_clear')
+                updated = self._touch()
+                db.session.commit()
+        except SQLAlchemyError as e:
+            self._throw(e)
+        self.changes.notify(updated, 'device:*')
+
+    # --- 变更日志
+
+    @staticmethod
+    def _device_dict(device: _DeviceStatusData) -> dict[str, Any]:
+        return {
+            'id': device.id,
+            'show_name': device.show_name,
+            'using': device.using,
+            'status': device.status,
+            'fields': deepcopy(device.fields),
+            'last_updated': device.last_updated
+        }
+
+    def _journal(self, type: str, device: str | None = None, data: Any = None):
+        '''
+        (需在 app context 中, 随当前事务提交) 追加一条变更日志
+        '''
+        entry = _ChangeJournalData()
+        entry.time = time()
+        entry.type = type
+        entry.device = device
+        entry.data = data
+        db.session.add(entry)
+
+    @property
+    def journal_latest(self) -> int:
+        '''
+        最新的变更序号 (无记录时为 0)
+        '''
+        try:
+            with self._app.app_context():
+                return db.session.execute(select(func.max(_ChangeJournalData.seq))).scalar() or 0
+        except SQLAlchemyError as e:
+            self._throw(e)
+
+    def journal_since(self, since: int, limit: int = 100) -> dict[str, Any]:
+        '''
+        获取指定序号之后的变更
+
+        :param since: 已知的最后一个序号 (返回大于此序号的变更)
+        :param limit: 最多返回的条数
+        :return: `{"changes": [...], "next": 下次请求使用的序号, "latest": 最新序号, "more": 是否还有更多, "reset": 是否有缺失 (需重新获取完整状态)}`
+        '''
+        try:
+            with self._app.app_context():
+                oldest, latest = db.session.execute(select(func.min(_ChangeJournalData.seq), func.max(_ChangeJournalData.seq))).one()
+                latest = latest or 0
+                if since > latest or (oldest is not None and since < oldest - 1):
+                    # 序号未知 (如数据库已重建) / 中间的记录已被清理
+                    return {'changes': [], 'next': latest, 'latest': latest, 'more': False, 'reset': True}
+                rows: list[_ChangeJournalData] = db.session.execute(
+                    select(_ChangeJournalData).where(_ChangeJournalData.seq > since).order_by(_ChangeJournalData.seq).limit(limit + 1)
+                ).scalars().all()  # type: ignore
+        except SQLAlchemyError as e:
+            self._throw(e)
+        more = len(rows) > limit
+        changes = [self._journal_entry(i) for i in rows[:limit]]
+        return {
+            'changes': changes,
+            'next': changes[-1]['seq'] if changes else since,
+            'latest': latest,
+            'more': more,
+            'reset': False
+        }
+
+    def _journal_entry(self, row: _ChangeJournalData) -> dict[str, Any]:
+        entry: dict[str, Any] = {'seq': row.seq, 'time': row.time, 'type': row.type}
+        if row.device is not None:
+            entry['id'] = row.device
+        if row.data is not None:
+            data = row.data
+            if row.type == 'device_set' and self._c.status.not_using and data.get('using') == False:
+                # 与设备列表相同, 替换未在使用时的状态名
+                data = {**data, 'status': self._c.status.not_using}
+            entry['data'] = data
+        return entry
+
+    def _journal_prune(self):
+        '''
+        按数量 / 时间清理旧的变更日志 (`status.journal_size` / `status.journal_age`)
+        '''
+        size, age = self._c.status.journal_size, self._c.status.journal_age
+        try:
+            with self._app.app_context():
+                deleted = 0
+                if size > 0:
+                    latest = db.session.execute(select(func.max(_ChangeJournalData.seq))).scalar() or 0
+                    deleted += _ChangeJournalData.query.filter(_ChangeJournalData.seq <= latest - size).delete()
+                if age > 0:
+                    deleted += _ChangeJournalData.query.filter(_ChangeJournalData.time < time() - age).delete()
+                db.session.commit()
+        except SQLAlchemyError as e:
+            l.error(f'[_journal_prune] Error: {e}')
+            return
+        if deleted:
+            l.debug(f'[_journal_prune] removed {deleted} entries')
+
+    # --- 副本同步
+
+    def apply_changes(self, changes: list[dict[str, Any]]) -> bool:
+        '''
+        (副本) 在一个事务中应用主实例的变更 (格式同 `journal_since()` 的 `changes`), 并写入本地变更日志
+
+        :param changes: 变更列表
+        :return: 是否全部应用 (为 `False` 时有无法应用的变更, 如隐私模式下隐藏了设备信息, 需重新同步完整状态)
+        '''
+        topics: set[str | None] = set()
+        complete = True
+        try:
+            with self._app.app_context():
+                maindata: _MainData = _MainData.query.first()  # type: ignore
+                for entry in changes:
+                    type, id, data = entry.get('type'), entry.get('id'), entry.get('data')
+                    if type == 'status' and isinstance(data, int):
+                        maindata.status = data
+                        topics.add('status')
+                    elif type == 'private_mode' and isinstance(data, bool):
+                        maindata.private_mode = data
+                        topics.add('private_mode')
+                    elif type == 'device_set' and id and isinstance(data, dict):
+                        data = self._replica_device(id, data)
+                        topics.add(f'device:{id}')
+                    elif type == 'device_remove' and id:
+                        _DeviceStatusData.query.filter_by(id=id).delete()
+                        topics.add(f'device:{id}')
+                    elif type == 'device_clear':
+                        _DeviceStatusData.query.delete()
+                        topics.add('device:*')
+                    else:
+                        complete = False
+                        continue
+                    self._journal(type, id, data)
+                    maindata.last_updated = updated = entry.get('time') or time()
                 db.session.commit()
-                self.last_updated = time()
         except SQLAlchemyError as e:
             self._throw(e)
+        for topic in topics:
+            self.changes.notify(updated, topic)
+        return complete
+
+    def load_state(self, status_id: int, devices: dict[str, dict[str, Any]], last_updated: float) -> int:
+        '''
+        (副本) 用主实例的完整状态替换本地状态, 差异写入本地变更日志 (本地的订阅者只收到有变化的部分)
+
+        :param status_id: 状态 id
+        :param devices: 设备列表 (同 `/api/status/query` 的 `device`)
+        :param last_updated: 数据最后更新时间
+        :return: 有变化的条目数
+        '''
+        topics: set[str | None] = set()
+        try:
+            with self._app.app_context():
+                maindata: _MainData = _MainData.query.first()  # type: ignore
+                if maindata.status != status_id:
+                    maindata.status = status_id
+                    self._journal('status', data=status_id)
+                    topics.add('status')
+                if maindata.private_mode:
+                    # 主实例在隐私模式下返回的设备列表为空, 与本地开启隐私模式效果相同
+                    maindata.private_mode = False
+                    self._journal('private_mode', data=False)
+                    topics.add('private_mode')
+                local: list[_DeviceStatusData] = _DeviceStatusData.query.all()
+                topics |= self._replace_devices(local, devices)
+                maindata.last_updated = last_updated
+                db.session.commit()
+        except SQLAlchemyError as e:
+            self._throw(e)
+        self._notify_topics(topics, last_updated)
+        return len(topics)
+
+    def merge_devices(self, namespace: str, devices: dict[str, dict[str, Any]]) -> int:
+        '''
+        (聚合模式) 替换一个上游实例的设备 (id 为 `namespace` 或以 `namespace/` 开头的设备), 差异写入本地变更日志
+
+        :param namespace: 上游名称
+        :param devices: 该上游的全部设备 (id 需已加上前缀)
+        :return: 有变化的设备数
+        '''
+        updated = time()
+        try:
+            with self._app.app_context():
+                local: list[_DeviceStatusData] = _DeviceStatusData.query.filter(
+                    (_DeviceStatusData.id == namespace) | _DeviceStatusData.id.startswith(f'{namespace}/', autoescape=True)
+                ).all()
+                topics = self._replace_devices(local, devices)
+                if topics:
+                    maindata: _MainData = _MainData.query.first()  # type: ignore
+                    maindata.last_updated = updated
+                db.session.commit()
+        except SQLAlchemyError as e:
+            self._throw(e)
+        self._notify_topics(topics, updated)
+        return len(topics)
+
+    def _replace_devices(self, local: list[_DeviceStatusData], devices: dict[str, dict[str, Any]]) -> set[str | None]:
+        '''
+        (需在 app context 中) 用 `devices` 替换 `local` 中的设备, 只记录有变化的设备
+
+        :return: 变更主题
+        '''
+        topics: set[str | None] = set()
+        existing = {i.id: i for i in local}
+        for id, device in existing.items():
+            if id not in devices:
+                db.session.delete(device)
+                self._journal('device_remove', id)
+                topics.add(f'device:{id}')
+        for id, data in devices.items():
+            device = existing.get(id)
+            if device and self._device_dict(device) == {**data, 'id': id}:
+                continue
+            self._journal('device_set', id, self._replica_device(id, data))
+            topics.add(f'device:{id}')
+        return topics
+
+    def _notify_topics(self, topics: set[str | None], stamp: float):
+        '''
+        按主题发送变更通知 (主题较多时合并为一次未指定主题的通知)
+        '''
+        if len(topics) > 10:
+            self.changes.notify(stamp)
+        else:
+            for topic in topics:
+                self.changes.notify(stamp, topic)
+
+    def _replica_device(self, id: str, data: dict[str, Any]) -> dict[str, Any]:
+        '''
+        (需在 app context 中) 按主实例 / 上游的数据写入设备 (完整替换, 不合并 `fields`)
+
+        :return: 写入后的设备数据
+        '''
+        device = _DeviceStatusData.query.filter_by(id=id).first()
+        if not device:
+            device = _DeviceStatusData()
+            device.id = id
+            db.session.add(device)
+        device.show_name = data.get('show_name') or id
+        device.using = data.get('using')
+        device.status = data.get('status')
+        device.fields = data.get('fields') or {}
+        device.last_updated = data.get('last_updated')
+        return self._device_dict(device)
 
     # --- 统计数据访问
 
@@ -560,38 +956,236 @@ class Data:
 
     # --- 插件数据访问
 
-    def get_plugin_data(self, id: str) -> dict:
+    # 插件数据先写入内存缓存, 再由 schedule loop 定期写回 (`main.plugin_data_flush`)
+    _plugin_lock = RLock()
+    _plugin_data_cache: dict[str, dict] = {}
+    '''插件数据缓存 (插件 id -> 数据)'''
+    _plugin_data_dirty: set[str] = set()
+    '''待写回的插件数据'''
+    _plugin_kv_cache: dict[tuple[str, str], tuple[Any, float | None]] = {}
+    '''插件键值缓存 ((插件 id, 键) -> (值, 过期时间)), 值为 `_MISSING` 表示不存在'''
+    _plugin_kv_dirty: set[tuple[str, str]] = set()
+    '''待写回的插件键值'''
+
+    @property
+    def _write_through(self) -> bool:
         '''
-        获取插件数据 (没有则会创建)
+        插件数据的修改是否立即写入数据库
         '''
-        try:
-            with self._app.app_context():
-                plugin: _PluginData | None = _PluginData.query.filter_by(id=id).first()
-                if plugin is None:
-                    plugin = _PluginData()
-                    plugin.id = id
-                    db.session.add(plugin)
-                    db.session.commit()
-                return plugin.data
-        except SQLAlchemyError as e:
-            self._throw(e)
+        return self._c.main.plugin_data_flush <= 0 or self._shared
+
+    def get_plugin_data(self, id: str, copy: bool = True) -> dict:
+        '''
+        获取插件数据 (经过缓存)
+
+        :param copy: 是否返回副本 (为 False 时返回缓存中的对象, 调用方不能修改)
+        '''
+        with self._plugin_lock:
+            data = None if self._shared else self._plugin_data_cache.get(id)
+            ins.cache_requests.inc(cache='plugin_data', result='miss' if data is None else 'hit')
+            if data is None:
+                try:
+                    with self._app.app_context():
+                        plugin: _PluginData | None = _PluginData.query.filter_by(id=id).first()
+                        data = plugin.data if plugin else {}
+                except SQLAlchemyError as e:
+                    self._throw(e)
+                if not self._shared:
+                    self._plugin_data_cache[id] = data
+            return deepcopy(data) if copy else data
 
     def set_plugin_data(self, id: str, data: dict):
         '''
         设置插件数据
         '''
+        with self._plugin_lock:
+            self._plugin_data_cache[id] = deepcopy(data)
+            self._plugin_data_dirty.add(id)
+        if self._write_through:
+            self.plugin_data_flush(discard=True)
+
+    def _plugin_kv_load(self, plugin: str, key: str) -> tuple[Any, float | None]:
+        '''
+        (需持有 `_plugin_lock`) 从缓存 / 数据库加载键值, 并处理过期
+        '''
+        ck = (plugin, key)
+        cached = None if self._shared else self._plugin_kv_cache.get(ck)
+        ins.cache_requests.inc(cache='plugin_kv', result='miss' if cached is None else 'hit')
+        if cached is None:
+            try:
+                with self._app.app_context():
+                    row: _PluginKVData | None = _PluginKVData.query.filter_by(plugin=plugin, key=key).first()
+                    cached = (row.value, row.expires) if row else (_MISSING, None)
+            except SQLAlchemyError as e:
+                self._throw(e)
+            if not self._shared:
+                self._plugin_kv_cache[ck] = cached
+        value, expires = cached
+        if value is not _MISSING and expires is not None and expires <= time():
+            # 已过期 -> 删除
+            cached = (_MISSING, None)
+            if self._shared:
+                # 不排队等待写回 (之后写回时可能覆盖其他 worker 新设置的值), 立即删除
+                self._plugin_kv_expire(plugin, key)
+            else:
+                self._plugin_kv_cache[ck] = cached
+                self._plugin_kv_dirty.add(ck)
+        return cached
+
+    def _plugin_kv_expire(self, plugin: str, key: str):
+        '''
+        从数据库中删除已过期的键值 (只删除仍已过期的记录, 其他 worker 刚设置的值不受影响)
+        - 失败时只记录, 下次读取时重试
+        '''
         try:
             with self._app.app_context():
-                plugin: _PluginData | None = _PluginData.query.filter_by(id=id).first()
-                if plugin is None:
-                    plugin = _PluginData()
-                    plugin.id = id
-                    plugin.data = {}
-                    db.session.add(plugin)
-                plugin.data = data
+                _PluginKVData.query.filter(
+                    _PluginKVData.plugin == plugin,
+                    _PluginKVData.key == key,
+                    _PluginKVData.expires <= time()
+                ).delete()
                 db.session.commit()
         except SQLAlchemyError as e:
-            self._throw(e)
+            l.warning(f'[plugin_kv] Delete expired key {plugin}/{key} failed: {e}')
+
+    def plugin_kv_get(self, plugin: str, key: str, default: Any = None) -> Any:
+        '''
+        获取插件键值 (经过缓存)
+
+        :param plugin: 插件 id
+        :param key: 键
+        :param default: 不存在 / 已过期时返回的默认值
+        '''
+        with self._plugin_lock:
+            value = self._plugin_kv_load(plugin, key)[0]
+            return default if value is _MISSING else deepcopy(value)
+
+    def plugin_kv_set(self, plugin: str, key: str, value: Any, ttl: float | None = None):
+        '''
+        设置插件键值
+
+        :param plugin: 插件 id
+        :param key: 键
+        :param value: 值 (需可被 json 序列化)
+        :param ttl: 过期时间 (秒, 为空则永不过期)
+        '''
+        with self._plugin_lock:
+            ck = (plugin, key)
+            self._plugin_kv_cache[ck] = (deepcopy(value), time() + ttl if ttl is not None else None)
+            self._plugin_kv_dirty.add(ck)
+        if self._write_through:
+            self.plugin_data_flush(discard=True)
+
+    def plugin_kv_incr(self, plugin: str, key: str, amount: int | float = 1, ttl: float | None = None) -> int | float:
+        '''
+        原子地增加插件键值 (不存在则视为 0)
+        - 多个 worker 共享数据库时, 在跨进程锁内从数据库读取并立即写回, 并发的增加不会丢失
+
+        :param plugin: 插件 id
+        :param key: 键
+        :param amount: 增加量
+        :param ttl: 过期时间 (秒, 为空则保留原过期时间)
+        :return: 增加后的值
+        '''
+        with self._plugin_lock:
+            if self._shared:
+                # 先持有进程内锁 (`FileLock` 不区分线程), 再获取跨进程锁
+                with self._kv_lock:
+                    value = self._plugin_kv_add(plugin, key, amount, ttl)
+                    # 写入失败时放弃本次增加 (不能在锁外重试, 否则会覆盖其他 worker 的增加)
+                    self.plugin_data_flush(discard=True)
+                return value
+            value = self._plugin_kv_add(plugin, key, amount, ttl)
+        if self._write_through:
+            self.plugin_data_flush(discard=True)
+        return value
+
+    def _plugin_kv_add(self, plugin: str, key: str, amount: int | float, ttl: float | None) -> int | float:
+        '''
+        (需持有 `_plugin_lock`) 读取键值并增加, 标记为待写回
+        '''
+        ck = (plugin, key)
+        value, expires = self._plugin_kv_load(plugin, key)
+        if value is _MISSING:
+            value = 0
+        elif not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise TypeError(f'plugin kv {plugin}/{key} is not a number: {value!r}')
+        value += amount
+        if ttl is not None:
+            expires = time() + ttl
+        self._plugin_kv_cache[ck] = (value, expires)
+        self._plugin_kv_dirty.add(ck)
+        return value
+
+    def plugin_kv_delete(self, plugin: str, key: str):
+        '''
+        删除插件键值
+
+        :param plugin: 插件 id
+        :param key: 键
+        '''
+        with self._plugin_lock:
+            ck = (plugin, key)
+            self._plugin_kv_cache[ck] = (_MISSING, None)
+            self._plugin_kv_dirty.add(ck)
+        if self._write_through:
+            self.plugin_data_flush(discard=True)
+
+    def plugin_data_flush(self, discard: bool = False):
+        '''
+        将缓存中修改过的插件数据 / 键值写回数据库
+
+        :param discard: 写入失败时放弃这些修改并抛出 `APIUnsuccessful` (立即写入时使用, 否则保留脏标记等待下次重试)
+        '''
+        with self._plugin_lock:
+            if not (self._plugin_data_dirty or self._plugin_kv_dirty):
+                return
+            perf = u.perf_counter()
+            data_dirty = {i: self._plugin_data_cache[i] for i in self._plugin_data_dirty}
+            kv_dirty = {ck: self._plugin_kv_cache[ck] for ck in self._plugin_kv_dirty}
+            try:
+                with self._app.app_context():
+                    for id, data in data_dirty.items():
+                        plugin: _PluginData | None = _PluginData.query.filter_by(id=id).first()
+                        if plugin is None:
+                            plugin = _PluginData()
+                            plugin.id = id
+                            db.session.add(plugin)
+                        plugin.data = deepcopy(data)
+                    for (plugin_id, key), (value, expires) in kv_dirty.items():
+                        row: _PluginKVData | None = _PluginKVData.query.filter_by(plugin=plugin_id, key=key).first()
+                        if value is _MISSING:
+                            if row:
+                                db.session.delete(row)
+                            continue
+                        if row is None:
+                            row = _PluginKVData()
+                            row.plugin = plugin_id
+                            row.key = key
+                            db.session.add(row)
+                        row.value = deepcopy(value)
+                        row.expires = expires
+                    db.session.commit()
+            except SQLAlchemyError as e:
+                if not discard:
+                    # 保留脏标记, 下次重试
+                    l.error(f'[plugin_data_flush] Error: {e}')
+                    return
+                # 放弃未写入的修改, 缓存中的值也一并丢弃 (下次从数据库重新读取)
+                for id in data_dirty:
+                    self._plugin_data_dirty.discard(id)
+                    self._plugin_data_cache.pop(id, None)
+                for ck in kv_dirty:
+                    self._plugin_kv_dirty.discard(ck)
+                    self._plugin_kv_cache.pop(ck, None)
+                self._throw(e)
+            self._plugin_data_dirty.clear()
+            self._plugin_kv_dirty.clear()
+            if self._shared:
+                # 多进程时缓存只用于暂存待写入的数据
+                self._plugin_data_cache.clear()
+                self._plugin_kv_cache.clear()
+            l.debug(f'[plugin_data_flush] flushed {len(data_dirty)} data, {len(kv_dirty)} kv, took {perf()}ms')
 
     # --- 缓存系统
 
@@ -613,6 +1207,7 @@ class Data:
         try:
             if self._c.main.debug:
                 # debug -> load directly
+                ins.cache_requests.inc(cache='file', result='bypass')
                 with open(filepath, 'rb') as f:
                     return BytesIO(f.read())
             else:
@@ -622,9 +1217,11 @@ class Data:
                 cached = self._cache.get(cache_key)
                 if cached and now - cached[0] < self._c.main.cache_age:
                     # has cache, and not expired
+                    ins.cache_requests.inc(cache='file', result='hit')
                     return cached[1]
                 else:
                     # no cache, or expired
+                    ins.cache_requests.inc(cache='file', result='miss')
                     with open(filepath, 'rb') as f:
                         ret = BytesIO(f.read())
                     self._cache[cache_key] = (now, ret)
@@ -655,11 +1252,64 @@ class Data:
         '''
         清理过期缓存
         '''
+        now = time()
+        with self._plugin_lock:
+            for ck, (value, expires) in list(self._plugin_kv_cache.items()):
+                if ck in self._plugin_kv_dirty:
+                    continue
+                if value is _MISSING or (expires is not None and expires <= now):
+                    # 不存在 / 已过期 (且已写回) 的键值无需保留
+                    self._plugin_kv_cache.pop(ck, None)
         if self._c.main.debug:
             return
-        now = time()
         for name in self._cache.keys():
             if now - self._cache.get(name, (now, ''))[0] > self._c.main.cache_age:
                 f = self._cache.pop(name, (0, None))[1]
                 if f:
                     f.close()
+
+    # --- 运行时统计
+
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        '''
+        各缓存的条目数 / 大小 (字节, 插件数据为 JSON 序列化后的近似值)
+        '''
+        def _size(value: Any) -> int:
+            try:
+                return len(json.dumps(value, ensure_ascii=False, default=str).encode())
+            except (TypeError, ValueError):
+                return 0
+
+        files = list(self._cache.values())
+        with self._plugin_lock:
+            plugin_data = list(self._plugin_data_cache.values())
+            plugin_kv = [v for v, _ in self._plugin_kv_cache.values()]
+            dirty = len(self._plugin_data_dirty) + len(self._plugin_kv_dirty)
+        return {
+            'file': {
+                'entries': len(files),
+                'bytes': sum(f.getbuffer().nbytes for _, f in files if not f.closed)
+            },
+            'plugin_data': {
+                'entries': len(plugin_data),
+                'bytes': sum(_size(v) for v in plugin_data),
+                'dirty': dirty
+            },
+            'plugin_kv': {
+                'entries': len(plugin_kv),
+                'bytes': sum(_size(v) for v in plugin_kv if v is not _MISSING)
+            }
+        }
+
+    def table_counts(self) -> dict[str, int]:
+        '''
+        各数据表的行数
+        '''
+        try:
+            with self._app.app_context():
+                return {
+                    name: db.session.execute(select(func.count()).select_from(table)).scalar() or 0
+                    for name, table in db.metadata.tables.items()
+                }
+        except SQLAlchemyError as e:
+            self._throw(e)
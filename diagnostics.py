@@ -0,0 +1,436 @@
+# coding: utf-8
+
+'''
+诊断工具 (按需请求分析 / 慢请求看门狗 / 运行时统计)
+'''
+
+import os
+import io
+import sys
+import gc
+import cProfile
+import pstats
+import threading
+import tracemalloc
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+from logging import getLogger
+from threading import Thread, Event, Lock, get_ident
+from time import time
+from types import FrameType
+import typing as t
+
+import pytz
+from markupsafe import escape
+
+import utils as u
+
+l = getLogger(__name__)
+
+# region profiler
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f'{u.relative_path(code.co_filename)}:{code.co_name}'
+
+
+class RequestProfiler:
+    '''
+    单个请求的分析器
+    - `cProfile`: 函数级耗时统计 (pstats)
+    - 采样线程: 定时抓取请求线程的调用栈, 生成 collapsed stacks (可用于 flamegraph)
+    '''
+
+    _lock = Lock()
+    '''同一时间只允许分析一个请求 (cProfile 无法并发启用)'''
+
+    def __init__(self, interval: float = 0.001):
+        '''
+        :param interval: 调用栈采样间隔 (秒)
+        '''
+        self.interval = interval
+        self._profile = cProfile.Profile()
+        self._stacks: Counter[str] = Counter()
+        self._stop = Event()
+        self._thread_id = get_ident()
+        self._sampler = Thread(target=self._sample_loop, daemon=True, name='sleepy-profiler')
+        self.started: float = 0
+        self.duration: float = 0
+        self.stopped: bool = False
+
+    @classmethod
+    def start(cls, interval: float = 0.001) -> 'RequestProfiler | None':
+        '''
+        开始分析当前线程
+
+        :return: 分析器, 如已有请求正在被分析则返回 `None`
+        '''
+        if not cls._lock.acquire(blocking=False):
+            return None
+        try:
+            self = cls(interval)
+            self.started = time()
+            self._sampler.start()
+            self._profile.enable()
+            return self
+        except Exception:
+            cls._lock.release()
+            raise
+
+    def stop(self):
+        '''
+        结束分析 (可重复调用)
+        '''
+        if self.stopped:
+            return
+        self.stopped = True
+        try:
+            self._profile.disable()
+        finally:
+            self._stop.set()
+            self._sampler.join()
+            self.duration = time() - self.started
+            RequestProfiler._lock.release()
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            self._stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        '''
+        collapsed stacks 格式 (`frame;frame;frame count`)
+        '''
+        return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+    def stats_text(self, sort: str = 'cumulative', limit: int = 60) -> str:
+        '''
+        可读的 pstats 报告
+        '''
+        buf = io.StringIO()
+        pstats.Stats(self._profile, stream=buf).strip_dirs().sort_stats(sort).print_stats(limit)
+        return buf.getvalue()
+
+    def save(self, dirname: str, name: str, keep: int) -> str:
+        '''
+        保存 `<name>.pstats` 和 `<name>.collapsed` 到目录, 并清理旧文件
+
+        :param dirname: 保存目录 (相对主程序目录)
+        :param name: 文件名 (不含扩展名)
+        :param keep: 最多保留的分析结果数
+        :return: 保存的文件路径 (不含扩展名)
+        '''
+        dirpath = u.get_path(dirname, is_dir=True)
+        base = os.path.join(dirpath, name)
+        self._profile.dump_stats(base + '.pstats')
+        with open(base + '.collapsed', 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+        # 清理旧文件
+        saved = sorted(i[:-7] for i in os.listdir(dirpath) if i.endswith('.pstats'))
+        for old in saved[:-keep] if keep > 0 else []:
+            for ext in ('.pstats', '.collapsed'):
+                try:
+                    os.remove(os.path.join(dirpath, old + ext))
+                except FileNotFoundError:
+                    pass
+        return base
+
+# endregion profiler
+
+# region watchdog
+
+
+class Watchdog:
+    '''
+    慢请求看门狗
+    - 记录正在处理的请求 (由 before_request / teardown_request 调用 `begin` / `end`)
+    - 后台线程定期检查, 请求超过阈值时抓取处理线程的调用栈并记录日志 (有频率限制)
+    - 保留最近 N 个慢请求, 供管理面板查看
+    '''
+
+    def __init__(self, threshold: float, interval: float = 0.5, history: int = 50, log_limit: int = 10, timezone: str | None = None):
+        '''
+        :param threshold: 慢请求阈值 (秒)
+        :param interval: 检查间隔 (秒)
+        :param history: 保留的慢请求数量
+        :param log_limit: 每分钟最多输出的调用栈日志数
+        :param timezone: 面板中显示时间使用的时区
+        '''
+        self.threshold = threshold
+        self._tz = pytz.timezone(timezone) if timezone else None
+        self.interval = interval
+        self.log_limit = log_limit
+        self._lock = Lock()
+        self._inflight: dict[int, dict[str, t.Any]] = {}
+        '''线程 id -> 请求信息'''
+        self.recent: deque[dict[str, t.Any]] = deque(maxlen=history)
+        '''最近的慢请求 (新的在后)'''
+        self._log_window: float = 0
+        self._log_count: int = 0
+        self._suppressed: int = 0
+        self._thread = Thread(target=self._loop, daemon=True, name='sleepy-watchdog')
+        self._thread.start()
+
+    def begin(self, request_id: str, method: str, path: str, ip: str):
+        '''
+        开始跟踪当前线程处理的请求
+        '''
+        self._inflight[get_ident()] = {
+            'id': request_id,
+            'method': method,
+            'path': path,
+            'ip': ip,
+            'start': time(),
+            'duration': None,
+            'stack': None
+        }
+
+    def end(self):
+        '''
+        结束跟踪当前线程处理的请求
+        '''
+        info = self._inflight.pop(get_ident(), None)
+        if not info:
+            return
+        duration = time() - info['start']
+        if duration < self.threshold:
+            return
+        with self._lock:
+            info['duration'] = round(duration, 3)
+            if info['stack'] is None:
+                # 在两次检查之间完成, 未能抓取调用栈
+                self.recent.append(info)
+        l.warning(f'[watchdog] Slow request {info["method"]} {info["path"]} ({info["id"]}) took {duration * 1000:.2f}ms')
+
+    def ignore(self):
+        '''
+        停止跟踪当前线程处理的请求 (用于长轮询 / WebSocket 等本就会长时间保持的请求)
+        '''
+        self._inflight.pop(get_ident(), None)
+
+    def _allow_log(self) -> bool:
+        '''
+        日志频率限制 (每分钟 `log_limit` 条)
+        '''
+        now = time()
+        if now - self._log_window >= 60:
+            if self._suppressed:
+                l.warning(f'[watchdog] {self._suppressed} slow request stacks suppressed in the last minute')
+            self._log_window, self._log_count, self._suppressed = now, 0, 0
+        if self._log_count < self.log_limit:
+            self._log_count += 1
+            return True
+        self._suppressed += 1
+        return False
+
+    def _loop(self):
+        while True:
+            sleep_until = time() + self.interval
+            try:
+                self._check()
+            except Exception as e:
+                l.warning(f'[watchdog] Error when checking requests: {e}')
+            Event().wait(max(0, sleep_until - time()))
+
+    def _check(self):
+        now = time()
+        frames = None
+        for tid, info in list(self._inflight.items()):
+            if info['stack'] is not None or now - info['start'] < self.threshold:
+                continue
+            if frames is None:
+                frames = sys._current_frames()
+            frame = frames.get(tid)
+            if frame is None:
+                continue
+            info['stack'] = ''.join(traceback.format_stack(frame))
+            with self._lock:
+                self.recent.append(info)
+            if self._allow_log():
+                l.warning(f'[watchdog] Request {info["method"]} {info["path"]} ({info["id"]}) running for {(now - info["start"]) * 1000:.0f}ms, stack:\n{info["stack"]}')
+
+    def snapshot(self) -> list[dict[str, t.Any]]:
+        '''
+        获取最近的慢请求 (新的在前)
+        '''
+        now = time()
+        with self._lock:
+            items = [i.copy() for i in reversed(self.recent)]
+        for i in items:
+            if i['duration'] is None:
+                i['running'] = round(now - i['start'], 3)
+        return items
+
+    def panel_html(self) -> str:
+        '''
+        管理面板卡片内容
+        '''
+        items = self.snapshot()
+        if not items:
+            return f'<p>最近没有超过 {self.threshold}s 的请求</p>'
+        rows = []
+        for i in items:
+            started = datetime.fromtimestamp(i['start'], self._tz).strftime('%Y-%m-%d %H:%M:%S')
+            duration = f'{i["duration"]}s' if i['duration'] is not None else f'{i["running"]}s (进行中)'
+            stack = f'<details><summary>调用栈</summary><pre>{escape(i["stack"])}</pre></details>' if i['stack'] else ''
+            rows.append(
+                f'<li><code>{escape(i["method"])} {escape(i["path"])}</code> {duration}'
+                f' <small>{escape(i["id"])} | {escape(i["ip"])} | {started}</small>{stack}</li>'
+            )
+        return f'<ul>{"".join(rows)}</ul>'
+
+# endregion watchdog
+
+# region stats
+
+
+def memory_rss() -> int | None:
+    '''
+    当前进程的常驻内存 (RSS, 字节)
+    - Linux: `/proc/self/statm`
+    - 其他 Unix: `resource` (峰值 RSS)
+    - 无法获取时返回 `None`
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 单位为字节, 其他为 KiB
+        return rss if sys.platform == 'darwin' else rss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def gc_stats() -> dict[str, t.Any]:
+    '''
+    垃圾回收统计
+    '''
+    return {
+        'enabled': gc.isenabled(),
+        'counts': gc.get_count(),
+        'thresholds': gc.get_threshold(),
+        'objects': len(gc.get_objects()),
+        'generations': gc.get_stats()
+    }
+
+
+def thread_stats() -> dict[str, t.Any]:
+    '''
+    线程统计 (按名称前缀分组, 如 `Thread-12 (process_request_thread)` -> `Thread (process_request_thread)`)
+    '''
+    groups: Counter[str] = Counter()
+    for th in threading.enumerate():
+        name = th.name
+        head, _, tail = name.partition(' ')
+        if head.startswith('Thread-'):
+            name = f'Thread {tail}'.strip()
+        groups[name] += 1
+    return {
+        'count': threading.active_count(),
+        'groups': dict(groups.most_common())
+    }
+
+
+def tracemalloc_top(limit: int = 10) -> dict[str, t.Any]:
+    '''
+    tracemalloc 内存分配统计 (按代码行)
+    - 如未开启追踪, 则开启并返回空列表 (开启后分配的内存才会被记录, 请稍后再次获取)
+
+    :param limit: 返回的条目数
+    '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        l.info('[diagnostics] tracemalloc started')
+        return {'tracing': True, 'started': True, 'top': []}
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>')
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'tracing': True,
+        'started': False,
+        'current': current,
+        'peak': peak,
+        'top': [
+            {
+                'line': f'{u.relative_path(s.traceback[0].filename)}:{s.traceback[0].lineno}',
+                'size': s.size,
+                'count': s.count
+            }
+            for s in snapshot.statistics('lineno')[:limit]
+        ]
+    }
+
+
+def tracemalloc_stop():
+    '''
+    停止 tracemalloc 追踪 (追踪本身有明显的性能 / 内存开销)
+    '''
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        l.info('[diagnostics] tracemalloc stopped')
+
+
+def _format_bytes(size: int | None) -> str:
+    if size is None:
+        return '-'
+    value = float(size)
+    for unit in ('B', 'KiB', 'MiB'):
+        if value < 1024:
+            return f'{value:.1f} {unit}'
+        value /= 1024
+    return f'{value:.1f} GiB'
+
+
+def stats_html(stats: dict[str, t.Any]) -> str:
+    '''
+    管理面板卡片内容 (运行时统计摘要)
+
+    :param stats: `/api/debug/stats` 的返回内容
+    '''
+    sse: dict[str, int] = stats['sse']['clients']
+    rows = [
+        ('线程数', stats['threads']['count']),
+        ('内存 (RSS)', _format_bytes(stats['memory']['rss'])),
+        ('GC 对象数', stats['gc']['objects']),
+        ('SSE 连接', f'{stats["sse"]["total"]} ({len(sse)} 个客户端, 变更通知: {stats["sse"]["notify"]})')
+    ]
+    if stats['ws']['enabled']:
+        rows.append(('WebSocket 连接', f'{stats["ws"]["total"]} ({len(stats["ws"]["clients"])} 个客户端, {len(stats["ws"]["devices"])} 个设备)'))
+    streams = stats['streams']
+    rows.append(('长连接上限', f'{streams["total"]} / {streams["limit"] or "不限"} (每个客户端 {streams["ip_limit"] or "不限"})'))
+    replica = stats.get('replica')
+    if replica:
+        lag = f'{replica["lag"]:.3f}s' if replica['lag'] is not None else '-'
+        since = f'{replica["since_sync"]:.0f}s 前' if replica['since_sync'] is not None else '从未'
+        rows.append(('只读副本', f'{"已连接" if replica["connected"] else "未连接"} {replica["primary"]} (延迟 {lag}, 上次同步 {since}, 重新同步 {replica["resyncs"]} 次)'))
+    for name, upstream in (stats.get('aggregator') or {}).items():
+        since = f'{upstream["since_ok"]:.0f}s 前' if upstream['since_ok'] is not None else '从未'
+        state = '熔断中' if upstream['breaker'] == 'open' else ('已过期' if upstream['stale'] else '正常')
+        rows.append((f'上游 {name}', f'{state} {upstream["url"]} (上次成功 {since}, 连续失败 {upstream["failures"]} 次)'))
+    publish = stats.get('publish')
+    if publish:
+        last = f'{publish["duration"] * 1000:.1f}ms' if publish['duration'] is not None else '-'
+        rows.append(('静态发布', f'{publish["dir"]} (已生成 {publish["published"]} 次, 上次耗时 {last}, 失败 {publish["errors"]} 次)'))
+    for name, cache in stats['cache'].items():
+        rows.append((f'缓存 {name}', f'{cache["entries"]} 条 / {_format_bytes(cache["bytes"])}'))
+    for name, count in stats['tables'].items():
+        rows.append((f'数据表 {name}', f'{count} 行'))
+    body = ''.join(f'<tr><td>{escape(k)}</td><td>{escape(v)}</td></tr>' for k, v in rows)
+    return f'<table>{body}</table><p><small>完整数据: <code>/api/debug/stats</code></small></p>'
+
+# endregion stats
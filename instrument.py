@@ -0,0 +1,351 @@
+# coding: utf-8
+
+'''
+轻量运行时指标 (Prometheus 文本格式, 见 `/api/metrics/prometheus`)
+'''
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from time import perf_counter, time
+import typing as t
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+l = getLogger(__name__)
+
+enabled: bool = False
+'''是否记录指标 (由 `metrics.prometheus_enabled` 控制, 关闭时各记录函数直接返回)'''
+
+_registry: list['_Metric'] = []
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+'''默认直方图分桶 (秒)'''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    items = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    '''
+    指标基类
+    '''
+    type: str = 'untyped'
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labels
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict[str, t.Any]) -> tuple:
+        return tuple(labels.get(n, '') for n in self.labelnames)
+
+    def _samples(self) -> t.Iterable[str]:
+        return ()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    '''
+    计数器 (只增不减)
+    '''
+    type = 'counter'
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Gauge(_Metric):
+    '''
+    仪表 (可增可减, 或在抓取时通过 `func` 计算)
+    '''
+    type = 'gauge'
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), func: t.Callable[[], float] | None = None):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+        self._func = func
+
+    def inc(self, amount: float = 1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def get(self, **labels) -> float:
+        if self._func:
+            return self._func()
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        if self._func:
+            try:
+                yield f'{self.name} {_format_value(self._func())}'
+            except Exception as e:
+                l.warning(f'[instrument] Error when collecting {self.name}: {e}')
+            return
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    '''
+    直方图 (固定分桶)
+    '''
+    type = 'histogram'
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}
+        '''标签 -> [各分桶计数..., 总和, 总数]'''
+
+    def observe(self, value: float, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                counts[idx] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(k, v.copy()) for k, v in self._values.items()]
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}'
+            le = 'le="+Inf"'
+            yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {counts[-1]}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(counts[-2])}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}'
+
+
+def render() -> str:
+    '''
+    生成 Prometheus 文本格式 (text/plain; version=0.0.4)
+    '''
+    return '\n'.join(m.render() for m in _registry) + '\n'
+
+# region metrics
+
+
+_start_time = time()
+
+http_requests = Counter('sleepy_http_requests_total', 'HTTP requests handled', ('endpoint', 'method', 'code'))
+http_duration = Histogram('sleepy_http_request_duration_seconds', 'HTTP request latency by route endpoint', ('endpoint',))
+http_in_flight = Gauge('sleepy_http_requests_in_flight', 'HTTP requests currently being handled')
+sse_connections = Gauge('sleepy_sse_connections', 'Open /api/status/events streams')
+long_poll_waiting = Gauge('sleepy_long_poll_waiting', 'Requests waiting in /api/status/wait')
+ws_connections = Gauge('sleepy_ws_connections', 'Open /api/ws connections')
+stream_rejections = Counter('sleepy_stream_rejections_total', 'SSE / WebSocket connections rejected by connection limits', ('kind', 'reason'))
+stream_stalls = Counter('sleepy_stream_stalls_total', 'Times a stream send buffer was full (updates skipped until writable)', ('kind',))
+stream_evictions = Counter('sleepy_stream_evictions_total', 'Slow SSE / WebSocket clients closed by the server', ('kind', 'reason'))
+change_notifications = Counter('sleepy_change_notifications_total', 'Data change notifications by origin (local write / other worker / poll)', ('source',))
+change_publishes = Counter('sleepy_change_publishes_total', 'Wake-ups sent to SSE / long-poll / WebSocket subscribers (after coalescing)')
+replica_changes = Counter('sleepy_replica_changes_total', 'Primary changes applied by this replica')
+replica_resyncs = Counter('sleepy_replica_resyncs_total', 'Full state resyncs from the primary', ('reason',))
+replica_errors = Counter('sleepy_replica_errors_total', 'Failed requests to the primary')
+replica_lag = Gauge('sleepy_replica_lag_seconds', 'Delay between the latest change on the primary and it being applied here')
+replica_last_sync = Gauge('sleepy_replica_last_sync_timestamp_seconds', 'Last successful response from the primary (unix time)')
+upstream_up = Gauge('sleepy_upstream_up', 'Whether the last request to an aggregator upstream succeeded', ('upstream',))
+upstream_stale = Gauge('sleepy_upstream_stale', 'Whether an aggregator upstream is shown with stale data', ('upstream',))
+upstream_errors = Counter('sleepy_upstream_errors_total', 'Failed requests to aggregator upstreams', ('upstream',))
+upstream_breaker_opens = Counter('sleepy_upstream_breaker_opens_total', 'Times an aggregator upstream was paused after repeated failures', ('upstream',))
+publish_runs = Counter('sleepy_publish_total', 'Static page publishes by result', ('result',))
+publish_duration = Histogram('sleepy_publish_duration_seconds', 'Time spent rendering and writing static pages')
+db_queries = Counter('sleepy_db_queries_total', 'SQL statements executed', ('operation',))
+db_duration = Histogram('sleepy_db_query_duration_seconds', 'SQL statement execution time', ('operation',))
+cache_requests = Counter('sleepy_cache_requests_total', 'Cache lookups', ('cache', 'result'))
+plugin_event_duration = Histogram('sleepy_plugin_event_duration_seconds', 'Time spent dispatching plugin events', ('event',))
+plugin_event_errors = Counter('sleepy_plugin_event_errors_total', 'Plugin event handlers that raised', ('event',))
+threads = Gauge('sleepy_threads', 'Live Python threads', func=threading.active_count)
+uptime = Gauge('sleepy_uptime_seconds', 'Seconds since process start', func=lambda: round(time() - _start_time, 3))
+
+# endregion metrics
+
+# region sql
+
+
+class QueryStats:
+    '''
+    一段时间内 (如单个请求) 执行的 SQL 语句统计
+    '''
+
+    def __init__(self, record: bool = False):
+        '''
+        :param record: 是否记录语句内容 (用于调试 / 测试)
+        '''
+        self.count: int = 0
+        '''语句数'''
+        self.duration: float = 0
+        '''总耗时 (秒)'''
+        self.statements: list[str] | None = [] if record else None
+        '''语句内容 (仅 `record=True` 时记录)'''
+
+    def __repr__(self):
+        return f'<QueryStats count={self.count} duration={self.duration * 1000:.2f}ms>'
+
+
+_collectors: ContextVar[tuple[QueryStats, ...]] = ContextVar('sleepy_sql_collectors', default=())
+'''当前上下文中正在统计的 `QueryStats` (可嵌套)'''
+
+
+@contextmanager
+def track_queries(record: bool = False) -> t.Iterator[QueryStats]:
+    '''
+    统计代码块中执行的 SQL 语句
+
+    ```
+    with track_queries() as stats:
+        d.device_list
+    print(stats.count, stats.duration)
+    ```
+
+    :param record: 是否记录语句内容
+    '''
+    stats = QueryStats(record)
+    token = _collectors.set(_collectors.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _collectors.reset(token)
+
+
+def start_tracking() -> tuple[QueryStats, t.Any]:
+    '''
+    开始统计 SQL 语句 (用于无法使用 `with` 的场景, 如 before_request / teardown_request)
+
+    :return: (统计对象, 用于 `stop_tracking` 的 token)
+    '''
+    stats = QueryStats()
+    return stats, (stats, _collectors.set(_collectors.get() + (stats,)))
+
+
+def stop_tracking(token: t.Any):
+    '''
+    结束 `start_tracking` 开始的统计
+    '''
+    stats, var_token = token
+    try:
+        _collectors.reset(var_token)
+    except ValueError:
+        # 在其他上下文中创建的 token (如流式响应), 只移除本次的统计对象, 保留外层的统计
+        _collectors.set(tuple(i for i in _collectors.get() if i is not stats))
+
+
+@contextmanager
+def assert_max_queries(limit: int):
+    '''
+    (测试辅助) 断言代码块中执行的 SQL 语句数不超过 `limit`
+
+    ```
+    with assert_max_queries(3):
+        client.get('/api/status/query')
+    ```
+
+    :param limit: 允许的最大语句数
+    :raises AssertionError: 超出限制时 (附带执行的语句)
+    '''
+    with track_queries(record=True) as stats:
+        yield stats
+    if stats.count > limit:
+        statements = '\n'.join(f'  {i + 1}. {s}' for i, s in enumerate(stats.statements or []))
+        raise AssertionError(f'Expected at most {limit} SQL statements, got {stats.count}:\n{statements}')
+
+
+def _on_before_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None or not (enabled or _collectors.get()):
+        return
+    # 记录在每次执行的 context 上 (出错的语句不会触发 after_cursor_execute, 不能用连接上的栈)
+    context._sleepy_query_start = perf_counter()
+
+
+def _on_after_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_sleepy_query_start', None)
+    if start is None:
+        return
+    elapsed = perf_counter() - start
+    for stats in _collectors.get():
+        stats.count += 1
+        stats.duration += elapsed
+        if stats.statements is not None:
+            stats.statements.append(statement)
+    if enabled:
+        operation = statement.lstrip().split(' ', 1)[0].upper() or 'OTHER'
+        db_queries.inc(operation=operation)
+        db_duration.observe(elapsed, operation=operation)
+
+
+def instrument_engine(engine: Engine):
+    '''
+    为 SQLAlchemy engine 注册 SQL 计时监听器
+
+    :param engine: `db.engine`
+    '''
+    if event.contains(engine, 'before_cursor_execute', _on_before_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', _on_before_execute)
+    event.listen(engine, 'after_cursor_execute', _on_after_execute)
+
+# endregion sql
@@ -18,12 +18,20 @@ Security Report: https://sleepy.wss.moe/security
 try:
     # built-in
     import logging
+    from logging.handlers import QueueListener
+    import atexit
     from datetime import datetime, timedelta, timezone
     import time
     from urllib.parse import urlparse, parse_qs, urlunparse
     import json
     from traceback import format_exc
     from mimetypes import guess_type
+    from uuid import uuid4
+    import re
+    import signal
+    from collections import Counter
+    from threading import Lock, Thread
+    import typing as t
 
     # 3rd-party
     import flask
@@ -31,10 +39,24 @@ try:
     from markupsafe import escape
     from werkzeug.exceptions import NotFound, HTTPException
     from toml import load as load_toml
+    try:
+        # optional: WebSocket (/api/ws)
+        from flask_sock import Sock
+        from simple_websocket import ConnectionClosed
+    except ImportError:
+        Sock = None
 
     # local modules
     from config import Config as config_init
     import utils as u
+    import instrument as ins
+    import diagnostics as dg
+    from accesslog import AccessLog, WRITE_ENDPOINTS
+    from capture import TrafficCapture
+    from streams import StreamLimiter, Stream
+    from replica import Replicator
+    from aggregator import Aggregator
+    from publish import StaticPublisher
     from data import Data as data_init
     import plugin as pl
 except:
@@ -78,18 +100,33 @@ try:
 
     # continue init logger
     root_logger.level = logging.DEBUG if c.main.debug else logging.INFO  # set log level
-    # reset stream handler
-    root_logger.handlers.clear()
+    # stream handler
+    log_handlers: list[logging.Handler] = []
     shandler = logging.StreamHandler()
     shandler.setFormatter(u.CustomFormatter(colorful=c.main.colorful_log, timezone=c.main.timezone))
-    root_logger.addHandler(shandler)
-    # set file handler
+    log_handlers.append(shandler)
+    # file handler
     if c.main.log_file:
         log_file_path = u.get_path(c.main.log_file)
-        l.info(f'Saving logs to {log_file_path}')
-        fhandler = logging.FileHandler(log_file_path, encoding='utf-8', errors='ignore')
+        fhandler = u.LogFileHandler(
+            log_file_path,
+            max_bytes=c.main.log_max_bytes,
+            backup_count=c.main.log_backup_count,
+            daily=c.main.log_rotate_daily,
+            compress=c.main.log_compress,
+            timezone=c.main.timezone
+        )
         fhandler.setFormatter(u.CustomFormatter(colorful=False, timezone=c.main.timezone))
-        root_logger.addHandler(fhandler)
+        log_handlers.append(fhandler)
+    # reset root handler -> queue (handlers run in background listener thread)
+    root_logger.handlers.clear()
+    qhandler = u.DropQueueHandler(c.main.log_queue_size)
+    root_logger.addHandler(qhandler)
+    log_listener = QueueListener(qhandler.queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    if c.main.log_file:
+        l.info(f'Saving logs to {log_file_path}')
 
     l.info(f'{"="*15} Application Startup {"="*15}')
     l.info(f'Sleepy Server version {version_str} ({".".join(str(i) for i in version)})')
@@ -100,17 +137,61 @@ try:
     else:
         app.config['SEND_FILE_MAX_AGE_DEFAULT'] = timedelta(seconds=c.main.cache_age)
 
+    # request body limit
+    if c.server.max_body_size > 0:
+        app.config['MAX_CONTENT_LENGTH'] = c.server.max_body_size
+
     # disable flask access log
     logging.getLogger('werkzeug').disabled = True
     from flask import cli
     cli.show_server_banner = lambda *_: None
 
+    # init instrument (before data, to hook sql engine)
+    ins.enabled = c.metrics.prometheus_enabled
+    ins.Gauge('sleepy_log_records_dropped', 'Log records dropped because the log queue was full', func=lambda: qhandler.dropped)
+    if ins.enabled:
+        l.info('[metrics] prometheus metrics enabled, scrape /api/metrics/prometheus to collect.')
+
     # init data
+    if __name__ == '__main__':
+        # main.py 始终为单进程 (忽略 `server.workers`)
+        data_init.workers = 1
     d = data_init(
         config=c,
         app=app
     )
 
+    # init access log if enabled
+    access_log = AccessLog(c) if c.main.access_log else None
+
+    # init traffic capture if enabled
+    capture = TrafficCapture(c) if c.diagnostics.capture_file else None
+
+    # init slow request watchdog if enabled
+    watchdog = dg.Watchdog(
+        threshold=c.diagnostics.slow_threshold,
+        interval=c.diagnostics.watchdog_interval,
+        history=c.diagnostics.slow_history,
+        log_limit=c.diagnostics.slow_log_limit,
+        timezone=c.main.timezone
+    ) if c.diagnostics.watchdog_enabled else None
+
+    # init long-lived connection (SSE / WebSocket) limits
+    streams = StreamLimiter(c)
+
+    # init read-only replica if enabled
+    replica = Replicator(c, d) if c.replica.primary else None
+    if replica:
+        replica.start()
+
+    # init aggregator if enabled
+    aggregator = Aggregator(c, d) if c.aggregator.upstreams else None
+    if aggregator:
+        aggregator.start()
+
+    # init static publisher if enabled (started after routes are defined)
+    publisher = StaticPublisher(c, d) if c.publish.dir else None
+
     # init metrics if enabled
     if c.metrics.enabled:
         l.info('[metrics] metrics enabled, open /api/metrics to see the count.')
@@ -262,17 +343,27 @@ def error_handler(e: Exception):
 # region inject
 
 
+_request_id_pattern = re.compile(r'[\w.:-]{1,64}')
+
+
 @app.before_request
 def before_request():
     '''
     before_request:
-    - 性能计数器
+    - 性能计数器 / SQL 语句统计 / 请求 id
     - 检测主题参数, 设置 cookie & 去除参数
     - 设置会话变量 (theme, secret)
     '''
     flask.g.perf = u.perf_counter()
+    flask.g.sql, flask.g.sql_token = ins.start_tracking()
+    ins.http_in_flight.inc()
+    # 请求 id (可由反代通过 X-Request-ID 传入)
+    rid = flask.request.headers.get('X-Request-ID', '')
+    flask.g.request_id = rid if _request_id_pattern.fullmatch(rid) else uuid4().hex[:16]
     fip = flask.request.headers.get('X-Real-IP') or flask.request.headers.get('X-Forwarded-For')
     flask.g.ipstr = ((flask.request.remote_addr or '') + (f' / {fip}' if fip else ''))
+    if watchdog:
+        watchdog.begin(flask.g.request_id, flask.request.method, flask.request.full_path.rstrip('?'), flask.g.ipstr)
 
     # --- get theme arg
     if flask.request.args.get('theme'):
@@ -312,6 +403,21 @@ def before_request():
         flask.g.theme = c.page.theme
     flask.g.secret = c.main.secret
 
+    # --- read-only replica: redirect writes to the primary (`replica.writes`, 拒绝写入由 data 层处理)
+    if replica and replica.writes == 'redirect' and flask.request.endpoint in WRITE_ENDPOINTS and flask.request.endpoint != 'auth':
+        return u.no_cache_response(flask.redirect(replica.primary + flask.request.full_path.rstrip('?'), 307))
+
+    # --- on-demand profiler (?__profile=1 / Sleepy-Profile: 1)
+    profile_mode = flask.request.args.get('__profile') or flask.request.headers.get('Sleepy-Profile')
+    if profile_mode and c.diagnostics.profiler:
+        if not u.verify_secret():
+            raise u.APIUnsuccessful(401, 'Wrong Secret')
+        profiler = dg.RequestProfiler.start(c.diagnostics.profile_interval)
+        if not profiler:
+            raise u.APIUnsuccessful(409, 'Another request is being profiled, please retry later')
+        flask.g.profiler = profiler
+        flask.g.profile_mode = profile_mode
+
     evt = p.trigger_event(pl.BeforeRequestHook())
     if evt and evt.interception:
         return evt.interception
@@ -322,21 +428,105 @@ def after_request(resp: flask.Response):
     '''
     after_request:
     - 记录 metrics 信息
-    - 显示访问日志
+    - 显示访问日志 / 记录结构化访问日志 / 流量录制
+    - 检查 SQL 语句数 (`metrics.query_budget`), 调试模式下添加 `Server-Timing` 标头
     '''
     # --- metrics
     path = flask.request.path
     if c.metrics.enabled:
         d.record_metrics(path)
     # --- access log
-    l.info(f'[Request] {flask.g.ipstr} | {path} -> {resp.status_code} ({flask.g.perf()}ms)')
+    perf = flask.g.perf()
+    (l.debug if access_log else l.info)(f'[Request] {flask.g.ipstr} | {path} -> {resp.status_code} ({perf}ms)')
+    # --- instrument
+    endpoint = flask.request.endpoint or '[none]'
+    ins.http_requests.inc(endpoint=endpoint, method=flask.request.method, code=resp.status_code)
+    ins.http_duration.observe(perf / 1000, endpoint=endpoint)
+    # --- query budget
+    sql: ins.QueryStats = flask.g.sql
+    budget = c.metrics.query_budget.get(endpoint, c.metrics.query_budget.get('*'))
+    if budget is not None and sql.count > budget:
+        l.warning(f'[Request] {path} ({endpoint}) executed {sql.count} SQL statements ({sql.duration * 1000:.2f}ms), over budget {budget}')
+    if c.main.debug:
+        resp.headers.add('Server-Timing', f'db;dur={sql.duration * 1000:.2f};desc="{sql.count} queries", total;dur={perf}')
     evt = p.trigger_event(pl.AfterRequestHook(resp))
     if evt.interception:
         evt.response = flask.Response(evt.interception[0], evt.interception[1])
     evt.response.headers.add('X-Powered-By', 'Sleepy-Project (https://github.com/sleepy-project)')
     evt.response.headers.add('Sleepy-Version', f'{version_str} ({".".join(str(i) for i in version)})')
+    evt.response.headers['X-Request-ID'] = flask.g.request_id
+    # --- structured access log
+    if access_log:
+        code = evt.response.status_code
+        method = flask.request.method
+        access_log.log({
+            'type': 'request',
+            'ts': round(time.time(), 3),
+            'id': flask.g.request_id,
+            'ip': flask.g.ipstr,
+            'method': method,
+            'path': path,
+            'endpoint': endpoint,
+            'status': code,
+            'ms': perf,
+            'bytes': evt.response.content_length,
+            'auth': flask.g.get('auth'),
+            'intercepted': flask.g.get('intercepted'),
+            'db_ms': round(sql.duration * 1000, 2),
+            'db_queries': sql.count
+        }, always=code >= 400 or method not in ('GET', 'HEAD', 'OPTIONS') or endpoint in WRITE_ENDPOINTS)
+    # --- traffic capture
+    if capture:
+        capture.record(evt.response, endpoint, perf)
+    # --- profiler
+    profiler: dg.RequestProfiler | None = flask.g.get('profiler')
+    if profiler:
+        return _finish_profile(profiler, evt.response)
     return evt.response
 
+
+def _finish_profile(profiler: dg.RequestProfiler, resp: flask.Response) -> flask.Response:
+    '''
+    结束请求分析, 保存或直接返回结果
+    '''
+    profiler.stop()
+    mode: str = flask.g.profile_mode
+    name = f'{datetime.now().strftime("%Y%m%d-%H%M%S")}-{flask.g.request_id}'
+    l.info(f'[profiler] {flask.request.path} profiled ({profiler.duration * 1000:.2f}ms), mode: {mode}')
+    if mode == 'text':
+        resp = u.no_cache_response(profiler.stats_text(), 200, {'Content-Type': 'text/plain; charset=utf-8'})
+    elif mode == 'collapsed':
+        resp = u.no_cache_response(profiler.collapsed(), 200, {'Content-Type': 'text/plain; charset=utf-8'})
+    else:
+        path = profiler.save(c.diagnostics.profile_dir, name, c.diagnostics.profile_keep)
+        l.info(f'[profiler] saved to {path}.pstats / .collapsed')
+    resp.headers['Sleepy-Profile'] = name
+    resp.headers['X-Request-ID'] = flask.g.request_id
+    return resp
+
+
+@app.teardown_request
+def teardown_request(e: BaseException | None):
+    '''
+    teardown_request:
+    - 结束请求计数 / SQL 语句统计 / 慢请求跟踪
+    - 确保请求分析器已停止
+    - 出错时释放已登记的长连接 (如 after_request 出错, SSE 响应被替换为错误页)
+    '''
+    if 'sql_token' not in flask.g:
+        # 未经过 before_request (如静态发布生成页面时的请求上下文)
+        return
+    ins.http_in_flight.dec()
+    if watchdog:
+        watchdog.end()
+    ins.stop_tracking(flask.g.sql_token)
+    profiler: dg.RequestProfiler | None = flask.g.get('profiler')
+    if profiler:
+        profiler.stop()
+    stream: Stream | None = flask.g.get('stream')
+    if stream and e is not None:
+        stream.close()
+
 # endregion inject
 
 # ========== Routes ==========
@@ -388,22 +578,10 @@ def index():
         'main': main_card,
         'more-info': more_info_card
     }
-    for name, values in p.index_cards.items():
-        value = ''
-        for v in values:
-            if hasattr(v, '__call__'):
-                value += f'{v()}<br/>\n'  # type: ignore - pylance 不太行啊 (?
-            else:
-                value += f'{v}<br/>\n'
-        cards[name] = value
+    cards.update(p.render_index_cards())
 
     # 处理主页注入
-    injects: list[str] = []
-    for i in p.index_injects:
-        if hasattr(i, '__call__'):
-            injects.append(str(i()))  # type: ignore
-        else:
-            injects.append(str(i))
+    injects: list[str] = p.render_index_injects()
 
     evt = p.trigger_event(pl.IndexAccessEvent(page_title=c.page.title, page_desc=c.page.desc, page_favicon=c.page.favicon, page_background=c.page.background, cards=cards, injects=injects))
 
@@ -502,6 +680,91 @@ def metrics():
         return evt.interception
     return evt.metrics_response
 
+
+@app.route('/api/metrics/prometheus')
+def metrics_prometheus():
+    '''
+    获取运行时指标 (Prometheus 文本格式)
+    - 需直接来自 `metrics.prometheus_allow_ips` (经过反向代理的请求不算), 或提供 secret
+    - Method: **GET**
+    '''
+    if not c.metrics.prometheus_enabled:
+        raise u.APIUnsuccessful(404, 'prometheus metrics is disabled')
+    # 经过反向代理时 remote_addr 为代理的地址, 不能据此免除 secret
+    proxied = 'X-Forwarded-For' in flask.request.headers or 'X-Real-IP' in flask.request.headers
+    allowed = not proxied and u.ip_allowed(flask.request.remote_addr, c.metrics.prometheus_allow_ips)
+    if not (allowed or u.verify_secret()):
+        raise u.APIUnsuccessful(401, 'Wrong Secret')
+    return flask.Response(ins.render(), mimetype='text/plain; version=0.0.4')
+
+
+def debug_stats(tracemalloc: int = 0) -> dict:
+    '''
+    收集运行时统计
+
+    :param tracemalloc: tracemalloc 统计条目数 (0 为不获取)
+    '''
+    with _sse_clients_lock:
+        clients = dict(sse_clients)
+    with _ws_lock:
+        ws_clients_snapshot = dict(ws_clients)
+        ws_devices_snapshot = dict(ws_devices)
+    ret = {
+        'success': True,
+        'time': datetime.now().timestamp(),
+        'uptime': ins.uptime.get(),
+        'threads': dg.thread_stats(),
+        'memory': {
+            'rss': dg.memory_rss()
+        },
+        'gc': dg.gc_stats(),
+        'sse': {
+            'total': sum(clients.values()),
+            'clients': clients,
+            'notify': d.changes.mode,
+            'version': d.changes.version
+        },
+        'ws': {
+            'enabled': Sock is not None,
+            'total': sum(ws_clients_snapshot.values()),
+            'clients': ws_clients_snapshot,
+            'devices': ws_devices_snapshot
+        },
+        'streams': streams.stats(),
+        'replica': replica.stats() if replica else None,
+        'aggregator': aggregator.stats() if aggregator else None,
+        'publish': publisher.stats() if publisher else None,
+        'cache': d.cache_stats(),
+        'tables': d.table_counts(),
+        'log_dropped': qhandler.dropped + (access_log.handler.dropped if access_log else 0)
+    }
+    if tracemalloc > 0:
+        ret['tracemalloc'] = dg.tracemalloc_top(tracemalloc)
+    return ret
+
+
+@app.route('/api/debug/stats')
+@u.require_secret()
+def debug_stats_route():
+    '''
+    获取运行时统计 (线程 / 内存 / SSE 连接 / 缓存 / 数据表行数)
+    - `?tracemalloc=<n>`: 附带 tracemalloc 前 n 项内存分配 (首次请求时开启追踪)
+    - `?tracemalloc=stop`: 停止 tracemalloc 追踪
+    - Method: **GET**
+    '''
+    if not c.diagnostics.stats_enabled:
+        raise u.APIUnsuccessful(404, 'debug stats is disabled')
+    arg = flask.request.args.get('tracemalloc', '0')
+    if arg == 'stop':
+        dg.tracemalloc_stop()
+        limit = 0
+    else:
+        try:
+            limit = min(int(arg), 100)
+        except ValueError:
+            raise u.APIUnsuccessful(400, 'argument \'tracemalloc\' must be int or \'stop\'')
+    return u.no_cache_response(debug_stats(limit))
+
 # endregion routes-special
 
 # ----- Status -----
@@ -513,11 +776,13 @@ def metrics():
 def query_route():
     return query()
 
-def query():
+def query(extra: bool = True):
     '''
     获取当前状态
     - 无需鉴权
     - Method: **GET**
+
+    :param extra: 是否按请求参数 (`meta` / `metrics`) 附带其他数据
     '''
     # 获取手动状态
     st: int = d.status_id
@@ -540,42 +805,271 @@ def query():
         'last_updated': d.last_updated
     }
     # 如同时包含 metadata / metrics 返回
-    if u.tobool(flask.request.args.get('meta', False)) if flask.request else False:
-        ret['meta'] = metadata()
-    if u.tobool(flask.request.args.get('metrics', False)) if flask.request else False:
-        ret['metrics'] = d.metrics_resp
+    if extra and flask.has_request_context():
+        if u.tobool(flask.request.args.get('meta', False)):
+            ret['meta'] = metadata()
+        if u.tobool(flask.request.args.get('metrics', False)):
+            ret['metrics'] = d.metrics_resp
     evt = p.trigger_event(pl.QueryAccessEvent(ret))
     return evt.query_response
 
 
-def _event_stream(event_id: int, ipstr: str):
-    last_updated = None
-    last_heartbeat = time.time()
+sse_clients: Counter[str] = Counter()
+'''当前打开的 SSE 连接 (客户端 ip -> 连接数)'''
+_sse_clients_lock = Lock()
 
-    l.info(f'[SSE] Event stream connected: {ipstr}')
-    while True:
-        current_time = time.time()
-        # 检查数据是否已更新
-        current_updated = d.last_updated
 
-        # 如果数据有更新, 发送更新事件并重置心跳计时器
-        if last_updated != current_updated:
-            last_updated = current_updated
-            # 重置心跳计时器
-            last_heartbeat = current_time
+_update_payload: tuple[int | None, int, dict, str] = (None, 0, {}, '')
+'''状态推送数据缓存 (数据版本, 变更序号, query 返回, json), 同一版本只生成一次'''
+_update_payload_lock = Lock()
+
+SSE_REPLAY_LIMIT = 500
+'''SSE 重连时最多补发的变更数 (超出则发送完整状态)'''
+
+
+def _update_data(version: int, min_seq: int = 0) -> tuple[int, dict, str]:
+    '''
+    获取指定数据版本的状态推送数据 (数据变化时所有 SSE / 长轮询连接共用一次 `query()`)
+
+    :param version: 数据版本 (`d.changes.version`)
+    :param min_seq: 缓存数据至少需包含到的变更序号 (未收到通知的变更, 如其他服务器的修改)
+    :return: (变更序号, query 返回 (不可修改), json)
+    '''
+    global _update_payload
+    payload = _update_payload
+    if payload[0] == version and payload[1] >= min_seq:
+        return payload[1:]
+    with _update_payload_lock:
+        if _update_payload[0] == version and _update_payload[1] >= min_seq:
+            return _update_payload[1:]
+        # 先取序号再取数据, 数据至少包含到该序号的变更
+        seq = d.journal_latest
+        data = query(extra=False)
+        _update_payload = (version, seq, data, json.dumps(data, ensure_ascii=False))
+        return _update_payload[1:]
+
+
+def _public_changes(changes: list[dict]) -> list[dict]:
+    '''
+    隐私模式下隐藏变更日志中的设备信息
+    '''
+    if not d.private_mode:
+        return changes
+    return [{k: v for k, v in i.items() if k not in ('id', 'data')} if i['type'].startswith('device_') else i for i in changes]
+
 
-            # 获取 /query 返回数据
-            update_data = json.dumps(query(), ensure_ascii=False)
-            event_id += 1
-            yield f'id: {event_id}\nevent: update\ndata: {update_data}\n\n'
+class _StatusFilter:
+    '''
+    订阅过滤 (SSE / 长轮询 / WebSocket 订阅只获取需要的部分, 如只显示某个设备的小组件)
+    '''
+
+    DEVICE_FIELDS = ('id', 'show_name', 'using', 'status', 'fields', 'last_updated')
+    '''可选的设备字段'''
+
+    def __init__(self, devices: list[str] | None = None, fields: list[str] | None = None, status_only: bool = False):
+        '''
+        :param devices: 只包含这些设备
+        :param fields: 设备只包含这些字段
+        :param status_only: 只包含状态 (不包含设备)
+        '''
+        self.devices = set(devices) if devices else None
+        self.fields = tuple(fields) if fields else None
+        self.status_only = status_only
+        self.topics: set[str] | None
+        '''相关的变更通知主题 (为空则所有变更都相关)'''
+        if status_only:
+            self.topics = {'status'}
+        elif self.devices is not None:
+            self.topics = {'status', 'private_mode', 'device:*', *(f'device:{i}' for i in self.devices)}
+        else:
+            self.topics = None
+
+    @classmethod
+    def parse(cls, source: t.Mapping[str, t.Any]) -> '_StatusFilter | None':
+        '''
+        从请求参数 / WebSocket 消息解析 (无过滤条件时返回 `None`)
+        - `devices`: 设备 id (逗号分隔或列表)
+        - `fields`: 设备字段 (逗号分隔或列表)
+        - `status_only`: 只获取状态
+
+        :raises u.APIUnsuccessful: 参数无效 (400)
+        '''
+        def split(name: str) -> list[str] | None:
+            value = source.get(name)
+            if isinstance(value, str):
+                return [i.strip() for i in value.split(',') if i.strip()] or None
+            elif value is None or (isinstance(value, list) and all(isinstance(i, str) for i in value)):
+                return value or None
+            raise u.APIUnsuccessful(400, f'\'{name}\' must be comma-separated string or list of string')
+
+        devices = split('devices')
+        fields = split('fields')
+        status_only = u.tobool(source.get('status_only', False))
+        if status_only is None:
+            raise u.APIUnsuccessful(400, '\'status_only\' must be boolean')
+        if fields:
+            unknown = [i for i in fields if i not in cls.DEVICE_FIELDS]
+            if unknown:
+                raise u.APIUnsuccessful(400, f'unknown device field(s): {", ".join(unknown)}')
+        if not (devices or fields or status_only):
+            return None
+        return cls(devices, fields, status_only)
+
+    def apply(self, data: dict) -> dict:
+        '''
+        过滤状态数据 (`query()` 的返回)
+        '''
+        ret = {k: v for k, v in data.items() if k != 'device'}
+        if not self.status_only:
+            devices: dict[str, dict] = data.get('device', {})
+            if self.devices is not None:
+                devices = {k: v for k, v in devices.items() if k in self.devices}
+            if self.fields is not None:
+                devices = {k: {f: v[f] for f in self.fields if f in v} for k, v in devices.items()}
+            ret['device'] = devices
+        return ret
+
+    @staticmethod
+    def view_key(view: dict) -> str:
+        '''
+        过滤后数据的比较键 (忽略每次都会变化的时间), 相同则无需推送
+        '''
+        return json.dumps({k: v for k, v in view.items() if k not in ('time', 'last_updated')}, ensure_ascii=False)
+
+    def change(self, entry: dict) -> dict | None:
+        '''
+        过滤变更日志中的一项 (不相关则返回 `None`)
+        '''
+        if entry['type'] == 'status':
+            return entry
+        elif self.status_only:
+            return None
+        elif entry['type'] in ('private_mode', 'device_clear'):
+            return entry
+        if self.devices is not None and entry.get('id') not in self.devices:
+            return None
+        if self.fields is not None and isinstance(entry.get('data'), dict):
+            entry = {**entry, 'data': {f: entry['data'][f] for f in self.fields if f in entry['data']}}
+        return entry
+
+    def changes(self, entries: list[dict]) -> list[dict]:
+        '''
+        过滤变更日志
+        '''
+        return [i for i in map(self.change, entries) if i is not None]
+
+
+def _filtered_update(flt: _StatusFilter | None, seq: int, data: dict, update_json: str, last_key: str | None) -> tuple[str | None, str | None]:
+    '''
+    按订阅过滤生成推送数据
+
+    :param seq: `_update_data()` 返回的变更序号
+    :param data: `_update_data()` 返回的 query 数据
+    :param update_json: `_update_data()` 返回的 json
+    :param last_key: 上次推送的比较键
+    :return: (推送的 json (数据未变化时为 `None`), 比较键)
+    '''
+    if not flt:
+        # 变更序号相同即数据相同 (如上次唤醒时已读取到合并窗口内的后续变更)
+        key = str(seq)
+        return (update_json if key != last_key else None), key
+    view = flt.apply(data)
+    key = flt.view_key(view)
+    if key == last_key:
+        return None, key
+    return json.dumps(view, ensure_ascii=False), key
+
+
+def _relevant_since(since: int, flt: _StatusFilter | None) -> bool:
+    '''
+    检查变更序号 `since` 之后是否有 (过滤后) 相关的变更
+    '''
+    if not flt:
+        return True
+    missed = d.journal_since(since, 1000)
+    return missed['reset'] or missed['more'] or bool(flt.changes(_public_changes(missed['changes'])))
 
-        # 只有在没有数据更新的情况下才检查是否需要发送心跳
-        elif current_time - last_heartbeat >= 30:
-            event_id += 1
-            yield f'id: {event_id}\nevent: heartbeat\ndata:\n\n'
-            last_heartbeat = current_time
 
-        time.sleep(1)  # 每秒检查一次更新
+def _event_stream(event_id: int, ipstr: str, stream: Stream, flt: _StatusFilter | None = None):
+    last_version = None
+    last_view = None
+    last_heartbeat = time.time()
+    topics = flt.topics if flt else None
+
+    l.info(f'[SSE] Event stream connected: {ipstr}')
+    ins.sse_connections.inc()
+    with _sse_clients_lock:
+        sse_clients[ipstr] += 1
+    try:
+        if event_id > 0:
+            # 断线重连: 从变更日志补发缺失的变更 (而不是完整状态)
+            version = d.changes.version
+            missed = d.journal_since(event_id, SSE_REPLAY_LIMIT)
+            if not (missed['reset'] or missed['more'] or d.private_mode):
+                last_version = version
+                for entry in missed['changes']:
+                    if not stream.writable():
+                        # 客户端接收缓慢: 放弃补发, 之后发送完整状态
+                        last_version = None
+                        break
+                    event_id = entry['seq']
+                    if flt:
+                        entry = flt.change(entry)
+                        if entry is None:
+                            continue
+                    stream.sending()
+                    yield f'id: {event_id}\nevent: change\ndata: {json.dumps(entry, ensure_ascii=False)}\n\n'
+                    stream.sent()
+                l.debug(f'[SSE] Replayed {len(missed["changes"])} change(s) to {ipstr}')
+
+        while True:
+            if stream.reconnect is not None:
+                # 服务端正在停止: 通知客户端稍后重连 (随机延迟, 分散重连)
+                if stream.writable():
+                    retry = round(stream.reconnect * 1000)
+                    yield f'id: {event_id}\nretry: {retry}\nevent: reconnect\ndata: {{"retry": {retry}}}\n\n'
+                return
+            if not stream.writable(1):
+                # 客户端接收缓慢 (之前的事件仍在发送缓冲区中): 不生成新事件, 中间的更新会被跳过, 可写后直接发送最新状态
+                if stream.evicted:
+                    return
+                continue
+            current_time = time.time()
+            # 检查数据是否已更新 (先取版本再取数据, 取数据期间的更新会在下一轮发送)
+            version = d.changes.version
+
+            # 如果数据有更新, 发送更新事件并重置心跳计时器
+            update_data = None
+            if last_version != version:
+                last_version = version
+
+                # 获取 /query 返回数据 (数据 / 过滤后的数据未变化则不发送)
+                event_id, data, update_data = _update_data(version)
+                update_data, last_view = _filtered_update(flt, event_id, data, update_data, last_view)
+
+            if update_data is not None:
+                # 重置心跳计时器
+                last_heartbeat = current_time
+                stream.sending()
+                yield f'id: {event_id}\nevent: update\ndata: {update_data}\n\n'
+                stream.sent()
+
+            # 只有在没有数据更新的情况下才检查是否需要发送心跳
+            elif current_time - last_heartbeat >= 30:
+                stream.sending()
+                yield f'id: {event_id}\nevent: heartbeat\ndata:\n\n'
+                stream.sent()
+                last_heartbeat = current_time
+
+            # 等待 (相关的) 数据变化 (最多等到下一次心跳)
+            d.changes.wait(last_version, max(0, 30 - (time.time() - last_heartbeat)), topics)
+    finally:
+        stream.close()
+        ins.sse_connections.dec()
+        with _sse_clients_lock:
+            sse_clients[ipstr] -= 1
+            if sse_clients[ipstr] <= 0:
+                del sse_clients[ipstr]
 
 
 @app.route('/api/status/events')
@@ -584,27 +1078,140 @@ def events():
     '''
     SSE 事件流，用于推送状态更新
     - Method: **GET**
+    - 事件 id 为变更序号, 带 `Last-Event-ID` 重连时只补发缺失的变更 (`change` 事件), 无法补发时发送完整状态 (`update` 事件)
+    - `?devices=<id,...>` / `?fields=<field,...>` / `?status_only=true`: 订阅过滤 (见 `_StatusFilter`)
     '''
     try:
         last_event_id = int(flask.request.headers.get('Last-Event-ID', '0'))
     except ValueError:
         raise u.APIUnsuccessful(400, 'Invaild Last-Event-ID header, it must be int!')
+    flt = _StatusFilter.parse(flask.request.args)
 
     evt = p.trigger_event(pl.StreamConnectedEvent(last_event_id))
     if evt.interception:
         return evt.interception
     ipstr: str = flask.g.ipstr
 
-    response = flask.Response(_event_stream(last_event_id, ipstr), mimetype='text/event-stream', status=200)
+    # 连接数限制
+    stream = streams.open('sse', ipstr, flask.request.environ)
+    if not stream:
+        return _stream_rejected()
+
+    response = flask.Response(_event_stream(last_event_id, ipstr, stream, flt), mimetype='text/event-stream', status=200)
     response.headers['Cache-Control'] = 'no-cache'  # 禁用缓存
     response.headers['X-Accel-Buffering'] = 'no'  # 禁用 Nginx 缓冲
     response.call_on_close(lambda: (
+        stream.close(),  # 生成器未开始就断开时不会执行其 finally
         l.info(f'[SSE] Event stream disconnected: {ipstr}'),
         p.trigger_event(pl.StreamDisconnectedEvent())
     ))
+    flask.g.stream = stream
     return response
 
 
+def _stream_rejected() -> flask.Response:
+    '''
+    长连接数超出上限时的返回 (503 + `Retry-After`)
+    '''
+    resp = u.no_cache_response({
+        'success': False,
+        'code': 503,
+        'details': 'Service Unavailable',
+        'message': 'Server is stopping, please retry later' if streams.draining else 'Too many connections, please retry later'
+    }, 503)
+    resp.headers['Retry-After'] = str(streams.retry_after)
+    return resp
+
+
+WAIT_TIMEOUT_MAX = 60
+'''长轮询最长等待时间 (秒)'''
+
+
+@app.route('/api/status/wait')
+@cross_origin(c.main.cors_origins)
+def status_wait():
+    '''
+    长轮询: 等待状态变化后返回 (用于无法使用 SSE 的网络环境)
+    - Method: **GET**
+    - `?seq=<seq>`: 已知的变更序号 (为空则立即返回当前状态)
+    - `?timeout=<s>`: 最长等待时间 (秒, 默认 30, 最大 60)
+    - `?delta=true`: 只返回变更 (格式同 `/api/changes`), 无法获取时仍返回完整状态
+    - `?devices=<id,...>` / `?fields=<field,...>` / `?status_only=true`: 订阅过滤 (见 `_StatusFilter`), 只在相关数据变化时返回
+    '''
+    args = flask.request.args
+    try:
+        seq = int(args['seq']) if 'seq' in args else None
+        timeout = min(max(float(args.get('timeout', 30)), 0), WAIT_TIMEOUT_MAX)
+    except ValueError:
+        raise u.APIUnsuccessful(400, 'argument \'seq\' must be int and \'timeout\' must be number')
+    flt = _StatusFilter.parse(args)
+
+    version = d.changes.version
+    latest = d.journal_latest
+    if seq is not None and (seq == latest or not _relevant_since(seq, flt)):
+        if watchdog:
+            # 长轮询不计入慢请求
+            watchdog.ignore()
+        # 等待 (相关的) 变化 (与 SSE 共用变更通知)
+        deadline = time.monotonic() + timeout
+        checked = latest
+        ins.long_poll_waiting.inc()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return u.no_cache_response({'success': True, 'changed': False, 'seq': checked})
+                version = d.changes.wait(version, remaining, flt.topics if flt else None)
+                if d.changes.stopping:
+                    # 服务端正在停止: 立即返回, 由客户端重新发起请求
+                    return u.no_cache_response({'success': True, 'changed': False, 'seq': checked})
+                latest = d.journal_latest
+                if latest != checked:
+                    if _relevant_since(checked, flt):
+                        break
+                    checked = latest
+        finally:
+            ins.long_poll_waiting.dec()
+
+    if seq is not None and u.tobool(args.get('delta', False)):
+        ret = d.journal_since(seq, 1000)
+        if not ret['reset']:
+            changes = _public_changes(ret['changes'])
+            return u.no_cache_response({
+                'success': True,
+                'changed': True,
+                'seq': ret['next'],
+                'changes': flt.changes(changes) if flt else changes,
+                'more': ret['more']
+            })
+
+    seq, data, _ = _update_data(d.changes.version, latest)
+    if flt:
+        data = flt.apply(data)
+    return u.no_cache_response({**data, 'changed': True, 'seq': seq})
+
+
+@app.route('/api/changes')
+@cross_origin(c.main.cors_origins)
+def changes():
+    '''
+    获取变更日志
+    - Method: **GET**
+    - `?since=<seq>`: 返回此序号之后的变更
+    - `?limit=<n>`: 最多返回的条数 (默认 100, 最大 1000)
+    '''
+    try:
+        since = int(flask.request.args.get('since', 0))
+        limit = int(flask.request.args.get('limit', 100))
+    except ValueError:
+        raise u.APIUnsuccessful(400, 'argument \'since\' and \'limit\' must be int')
+    if since < 0 or limit <= 0:
+        raise u.APIUnsuccessful(400, 'argument \'since\' must be >= 0 and \'limit\' must be > 0')
+    ret = d.journal_since(since, min(limit, 1000))
+    ret['changes'] = _public_changes(ret['changes'])
+    return u.no_cache_response({'success': True, **ret})
+
+
 @app.route('/api/status/set')
 @cross_origin(c.main.cors_origins)
 @u.require_secret()
@@ -819,6 +1426,292 @@ def device_private_mode():
 
 # endregion routes-device
 
+# ----- WebSocket -----
+
+# region routes-ws
+
+WS_PING_INTERVAL = 25
+'''WebSocket 心跳间隔 (秒), 超过一个间隔未收到客户端回应的连接会被关闭'''
+WS_MAX_MESSAGE = 64 * 1024
+'''WebSocket 单条消息最大长度 (字节)'''
+
+ws_clients: Counter[str] = Counter()
+'''当前打开的 WebSocket 连接 (客户端 ip -> 连接数)'''
+ws_devices: Counter[str] = Counter()
+'''通过 WebSocket 上报的设备 (设备 id -> 连接数), 所有连接都断开后标记为未在使用'''
+_ws_lock = Lock()
+
+
+class _WSChannel:
+    '''
+    单个 WebSocket 连接
+    - 客户端消息在请求线程中处理
+    - 订阅后由单独的线程推送状态更新 (与 SSE 共用变更通知 / 推送数据缓存)
+    '''
+
+    def __init__(self, ws, stream: Stream, ipstr: str, authed: bool):
+        '''
+        :param ws: `simple_websocket.Server`
+        :param stream: 连接限制 / 慢客户端检测
+        :param ipstr: 客户端 ip
+        :param authed: 握手时是否已通过鉴权
+        '''
+        self.ws = ws
+        self.stream = stream
+        self.ipstr = ipstr
+        self.authed = authed
+        self.devices: set[str] = set()
+        '''本连接上报的设备 (断开时标记为未在使用)'''
+        self.closed = False
+        self._send_lock = Lock()
+        self._pusher: Thread | None = None
+        stream.on_drain = self._reconnect
+
+    def send(self, msg: dict | str):
+        '''
+        发送消息 (可在多个线程中调用)
+
+        :param msg: 消息 (dict 会被序列化为 json)
+        '''
+        if not isinstance(msg, str):
+            msg = json.dumps(msg, ensure_ascii=False)
+        with self._send_lock:
+            self.stream.sending()
+            try:
+                self.ws.send(msg)
+            finally:
+                self.stream.sent()
+
+    def run(self):
+        '''
+        处理连接直到断开
+        '''
+        l.info(f'[ws] Connected: {self.ipstr} (auth: {self.authed})')
+        ins.ws_connections.inc()
+        with _ws_lock:
+            ws_clients[self.ipstr] += 1
+        try:
+            self.send({
+                'type': 'hello',
+                'auth': self.authed,
+                'seq': d.journal_latest,
+                'ping_interval': WS_PING_INTERVAL
+            })
+            while True:
+                raw = self.ws.receive()
+                try:
+                    msg = json.loads(raw)
+                except ValueError:
+                    msg = None
+                if not isinstance(msg, dict):
+                    self.send({'type': 'error', 'ref': None, 'code': 400, 'message': 'message must be a JSON object'})
+                    continue
+                ref = msg.get('ref')
+                try:
+                    self.handle(msg, ref)
+                except u.APIUnsuccessful as e:
+                    l.debug(f'[ws] {self.ipstr} {msg.get("type")} failed: {e}')
+                    self.send({'type': 'error', 'ref': ref, 'code': e.code, 'message': e.message})
+        except ConnectionClosed:
+            pass
+        finally:
+            self.closed = True
+            self.stream.close()
+            ins.ws_connections.dec()
+            offline = []
+            with _ws_lock:
+                ws_clients[self.ipstr] -= 1
+                if ws_clients[self.ipstr] <= 0:
+                    del ws_clients[self.ipstr]
+                for i in self.devices:
+                    ws_devices[i] -= 1
+                    if ws_devices[i] <= 0:
+                        del ws_devices[i]
+                        offline.append(i)
+            for i in offline:
+                self._offline(i)
+            l.info(f'[ws] Disconnected: {self.ipstr}' + (f', marked offline: {", ".join(offline)}' if offline else ''))
+
+    def handle(self, msg: dict, ref: t.Any):
+        '''
+        处理单条客户端消息
+
+        :param msg: 消息内容
+        :param ref: 客户端传入的消息标识 (原样返回)
+        '''
+        msg_type = msg.get('type')
+        if msg_type == 'ping':
+            self.send({'type': 'pong', 'ref': ref, 'time': time.time()})
+        elif msg_type == 'auth':
+            self.authed = msg.get('secret') == flask.g.secret
+            if not self.authed:
+                raise u.APIUnsuccessful(401, 'Wrong Secret')
+            self.send({'type': 'result', 'ref': ref, 'success': True})
+        elif msg_type == 'device_set':
+            if not self.authed:
+                raise u.APIUnsuccessful(401, 'Wrong Secret')
+            self.device_set(msg, ref)
+        elif msg_type == 'subscribe':
+            seq = msg.get('seq')
+            if seq is not None and (not isinstance(seq, int) or isinstance(seq, bool)):
+                raise u.APIUnsuccessful(400, '\'seq\' must be int')
+            flt = _StatusFilter.parse(msg)
+            if self._pusher:
+                raise u.APIUnsuccessful(409, 'Already subscribed')
+            self.send({'type': 'result', 'ref': ref, 'success': True})
+            self._pusher = Thread(target=self._push_loop, args=(seq, flt), daemon=True, name='ws-push')
+            self._pusher.start()
+        else:
+            raise u.APIUnsuccessful(400, f'Unknown message type: {msg_type}')
+
+    def device_set(self, msg: dict, ref: t.Any):
+        '''
+        设置设备状态 (参数同 `/api/device/set` 的 POST body)
+        - `offline_on_close`: 连接断开时是否将设备标记为未在使用 (默认 `true`)
+        '''
+        fields = msg.get('fields') or {}
+        if not isinstance(fields, dict):
+            raise u.APIUnsuccessful(400, '\'fields\' must be object')
+        evt = p.trigger_event(pl.DeviceSetEvent(
+            device_id=msg.get('id'),
+            show_name=msg.get('show_name'),
+            using=msg.get('using'),
+            status=msg.get('status') or msg.get('app_name'),  # 兼容旧版名称
+            fields=fields
+        ))
+        if evt.interception:
+            self.send({'type': 'result', 'ref': ref, 'success': False, 'intercepted': True, 'code': evt.interception[1]})
+            return
+
+        d.device_set(
+            id=evt.device_id,
+            show_name=evt.show_name,
+            using=evt.using,
+            status=evt.status,
+            fields=evt.fields
+        )
+
+        device_id = evt.device_id
+        watch = u.tobool(msg.get('offline_on_close', True)) is not False
+        if device_id and watch != (device_id in self.devices):
+            with _ws_lock:
+                if watch:
+                    self.devices.add(device_id)
+                    ws_devices[device_id] += 1
+                else:
+                    self.devices.discard(device_id)
+                    ws_devices[device_id] -= 1
+                    if ws_devices[device_id] <= 0:
+                        del ws_devices[device_id]
+        self.send({'type': 'result', 'ref': ref, 'success': True})
+
+    def _reconnect(self, retry: float):
+        '''
+        服务端正在停止: 通知客户端稍后重连, 并关闭连接 (1012: Service Restart)
+
+        :param retry: 建议的重连延迟 (秒)
+        '''
+        try:
+            self.send({'type': 'reconnect', 'retry': round(retry * 1000)})
+            self.ws.close(1012, 'Server is restarting')
+        except ConnectionClosed:
+            pass
+
+    def _offline(self, device_id: str):
+        '''
+        连接断开后将设备标记为未在使用
+        '''
+        evt = p.trigger_event(pl.DeviceSetEvent(
+            device_id=device_id,
+            show_name=None,
+            using=False,
+            status=None,
+            fields={}
+        ))
+        if evt.interception:
+            return
+        try:
+            d.device_set(
+                id=evt.device_id,
+                show_name=evt.show_name,
+                using=evt.using,
+                status=evt.status,
+                fields=evt.fields
+            )
+        except u.APIUnsuccessful as e:
+            # 设备已被移除等
+            l.debug(f'[ws] Mark {device_id} offline failed: {e}')
+
+    def _push_loop(self, since: int | None, flt: _StatusFilter | None):
+        '''
+        推送状态更新 (格式同 SSE: 重连时先补发缺失的变更, 之后每次变化推送完整状态)
+
+        :param since: 客户端已知的变更序号
+        :param flt: 订阅过滤
+        '''
+        last_version = None
+        last_view = None
+        try:
+            if since:
+                version = d.changes.version
+                missed = d.journal_since(since, SSE_REPLAY_LIMIT)
+                if not (missed['reset'] or missed['more'] or d.private_mode):
+                    last_version = version
+                    for entry in flt.changes(missed['changes']) if flt else missed['changes']:
+                        self.send({'type': 'change', 'seq': entry['seq'], 'data': entry})
+            while not (self.closed or d.changes.stopping):
+                version = d.changes.version
+                if last_version != version:
+                    if not self.stream.writable(1):
+                        # 客户端接收缓慢: 跳过中间的更新, 可写后直接发送最新状态
+                        if self.stream.evicted:
+                            return
+                        continue
+                    last_version = version
+                    seq, data, update_data = _update_data(version)
+                    update_data, last_view = _filtered_update(flt, seq, data, update_data, last_view)
+                    if update_data is not None:
+                        self.send(f'{{"type": "update", "seq": {seq}, "data": {update_data}}}')
+                # 定期检查连接是否已关闭
+                d.changes.wait(last_version, 5, flt.topics if flt else None)
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            l.warning(f'[ws] Push to {self.ipstr} failed: {e}')
+
+
+def ws_channel(ws):
+    '''
+    WebSocket 通道, 设备上报状态 / 订阅状态更新 (消息格式见 doc/api.md)
+    - 需要安装 flask-sock
+    - 可在握手时鉴权 (同其他接口, 如 `?secret=` / `Authorization` 请求头), 也可连接后发送 `auth` 消息
+    '''
+    if watchdog:
+        # 长连接不计入慢请求
+        watchdog.ignore()
+    ipstr: str = flask.g.ipstr
+    stream = streams.open('ws', ipstr, flask.request.environ)
+    if not stream:
+        if streams.draining:
+            ws.close(1012, 'Server is restarting')
+        else:
+            # 1013: Try Again Later
+            ws.close(1013, f'Too many connections, retry after {streams.retry_after}s')
+        return
+    _WSChannel(ws, stream, ipstr, bool(u.verify_secret())).run()
+
+
+if Sock:
+    app.config['SOCK_SERVER_OPTIONS'] = {
+        'ping_interval': WS_PING_INTERVAL,
+        'max_message_size': WS_MAX_MESSAGE
+    }
+    Sock(app).route('/api/ws')(ws_channel)
+else:
+    l.debug('[ws] flask-sock is not installed, /api/ws is disabled')
+
+# endregion routes-ws
+
 # ----- Panel (Admin) -----
 
 # region routes-panel
@@ -833,21 +1726,22 @@ def admin_panel():
     '''
 
     # 加载管理面板卡片
-    cards = {}
-    for name, card in p.panel_cards.items():
-        if hasattr(card['content'], '__call__'):
-            cards[name] = card.copy()
-            cards[name]['content'] = card['content']()  # type: ignore
-        else:
-            cards[name] = card
+    cards = p.render_panel_cards()
+    if watchdog:
+        cards['sleepy-slow-requests'] = {
+            'plugin': 'sleepy',
+            'title': f'慢请求 (> {c.diagnostics.slow_threshold}s)',
+            'content': watchdog.panel_html()
+        }
+    if c.diagnostics.stats_enabled:
+        cards['sleepy-runtime-stats'] = {
+            'plugin': 'sleepy',
+            'title': '运行状态',
+            'content': dg.stats_html(debug_stats())
+        }
 
     # 处理管理面板注入
-    inject = ''
-    for i in p.panel_injects:
-        if hasattr(i, '__call__'):
-            inject += str(i()) + '\n'  # type: ignore
-        else:
-            inject += str(i) + '\n'
+    inject = p.render_panel_inject()
 
     return render_template(
         'panel.html',
@@ -959,15 +1853,118 @@ def serve_public(path_name: str):
 
 # endregion routes
 
+# ========== Publish ==========
+
+# region publish
+
+
+def _publish_index(theme: str) -> str | None:
+    '''
+    生成指定主题的主页 (供静态发布使用)
+
+    :param theme: 主题
+    :return: html (插件拦截了主页且未返回 200 时为空)
+    '''
+    with app.test_request_context('/'):
+        flask.g.theme = theme
+        resp = index()
+        if isinstance(resp, flask.Response):
+            if resp.status_code != 200:
+                return None
+            resp = resp.get_data(as_text=True)
+    # `/static/` 按访客 cookie 中的主题重定向, 静态页面中改为明确的主题路径
+    return resp.replace('"/static/', f'"/static-themed/{theme}/')
+
+
+def _publish_json(view: t.Callable[[], t.Any]) -> t.Callable[[], str]:
+    '''
+    将接口的返回生成为 json 文本 (供静态发布使用)
+
+    :param view: 接口函数 (如 `query`)
+    '''
+    def render() -> str:
+        with app.test_request_context('/'):
+            resp = view()
+            if isinstance(resp, flask.Response):
+                return resp.get_data(as_text=True)
+            return app.json.dumps(resp)
+    return render
+
+
+if publisher:
+    publisher.start(_publish_index, {
+        'query.json': _publish_json(lambda: query(extra=False)),
+        'meta.json': _publish_json(metadata)
+    })
+
+# endregion publish
+
 # ========== End ==========
 
 # region run
 
+_shutdown_lock = Lock()
+_shutdown_deadline: float | None = None
+_stopped = False
+
+
+def begin_shutdown():
+    '''
+    开始停止 (可重复调用, 不阻塞)
+    - 拒绝新的长连接
+    - 通知所有 SSE / WebSocket 客户端在随机延迟后重连 (SSE: `reconnect` 事件 + `retry`, WebSocket: `reconnect` 消息 + 1012 关闭)
+    - 立即发布合并窗口内的变更, 结束等待中的长轮询
+    '''
+    global _shutdown_deadline
+    with _shutdown_lock:
+        if _shutdown_deadline is not None:
+            return
+        _shutdown_deadline = time.monotonic() + c.server.graceful_timeout
+    l.info(f'Shutting down (timeout: {c.server.graceful_timeout}s)...')
+    streams.drain()
+    d.changes.stop()
+
+
+def shutdown(code: int = 0):
+    '''
+    停止流程 (从 `begin_shutdown()` 开始计时, 在 `server.graceful_timeout` 内完成)
+    1. `begin_shutdown()`
+    2. 等待长连接关闭 (超时后剩余的连接随进程退出断开)
+    3. 写回缓冲的数据 (插件数据 / 访问日志汇总)
+    4. 触发 `AppStoppedEvent`
+
+    :param code: 退出码 (传给 `AppStoppedEvent`)
+    '''
+    global _stopped
+    begin_shutdown()
+    with _shutdown_lock:
+        if _stopped:
+            return
+        _stopped = True
+    assert _shutdown_deadline is not None
+    remaining = streams.wait_closed(max(_shutdown_deadline - time.monotonic(), 0))
+    if remaining:
+        l.warning(f'{remaining} stream(s) still open after {c.server.graceful_timeout}s, closing anyway')
+    d.plugin_data_flush()
+    if access_log:
+        access_log.flush_summary()
+    p.trigger_event(pl.AppStoppedEvent(code))
+
+
+def _on_sigterm(signum, frame):
+    '''
+    SIGTERM: 同 Ctrl+C, 停止监听后执行 `shutdown()` (再次发送 SIGTERM 会立即退出)
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    raise KeyboardInterrupt
+
 
 p.trigger_event(pl.AppStartedEvent())
 
 if __name__ == '__main__':
     l.info(f'Hi {c.page.name}!')
+    if c.server.workers != 1:
+        l.warning(f'server.workers is set to {c.server.workers}, but main.py always runs a single process, use serve.py to start multiple workers')
     listening = f'{f"[{c.main.host}]" if ":" in c.main.host else c.main.host}:{c.main.port}'
     if c.main.https:
         ssl_context = (c.main.ssl_cert, c.main.ssl_key)
@@ -976,6 +1973,7 @@ if __name__ == '__main__':
     else:
         ssl_context = None
         l.info(f'Listening service on: http://{listening}{" (debug enabled)" if c.main.debug else ""}')
+    signal.signal(signal.SIGTERM, _on_sigterm)
     try:
         app.run(  # 启↗动↘
             host=c.main.host,
@@ -987,11 +1985,11 @@ if __name__ == '__main__':
         )
     except Exception as e:
         l.critical(f'Critical error when running server: {e}\n{format_exc()}')
-        p.trigger_event(pl.AppStoppedEvent(1))
+        shutdown(1)
         exit(1)
     else:
         print()
-        p.trigger_event(pl.AppStoppedEvent(0))
+        shutdown(0)
         l.info('Bye.')
         exit(0)
 
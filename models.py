@@ -78,7 +78,69 @@ class _MainConfigModel(BaseModel):
     `main.log_file`
     保存日志文件目录 (留空禁用) \n
     如: `data/running.log` \n
-    **注意: 不会自动切割日志**
+    *切割规则见 `main.log_max_bytes` / `main.log_rotate_daily` / `main.log_backup_count`*
+    '''
+
+    log_max_bytes: int = 10485760
+    '''
+    `main.log_max_bytes`
+    单个日志文件的最大大小 (字节), 超出后切割
+    - *默认 10 MiB, 设置为 0 禁用按大小切割*
+    '''
+
+    log_rotate_daily: bool = True
+    '''
+    `main.log_rotate_daily`
+    是否在每天 0 点 (基于 `main.timezone`) 切割日志
+    '''
+
+    log_backup_count: int = 7
+    '''
+    `main.log_backup_count`
+    保留的旧日志文件数量 (`running.log.1`, `running.log.2`, ...)
+    - *设置为 0 则切割时直接清空*
+    '''
+
+    log_compress: bool = True
+    '''
+    `main.log_compress`
+    是否使用 gzip 压缩旧日志文件 (`running.log.1.gz`)
+    '''
+
+    log_queue_size: int = 10000
+    '''
+    `main.log_queue_size`
+    日志队列长度 \n
+    日志由后台线程写入 控制台 / 文件, 队列满时 (如磁盘过慢) 将丢弃新日志而不是阻塞请求
+    '''
+
+    access_log: str = ''
+    '''
+    `main.access_log`
+    结构化访问日志文件 (JSON Lines, 留空禁用) \n
+    如: `data/access.jsonl` \n
+    每行包含请求 id / 路由 / 状态码 / 耗时 / 字节数 / 鉴权结果 / 插件拦截 / 数据库耗时等信息
+    - *切割规则与 `main.log_file` 相同*
+    - *启用后控制台中的 `[Request]` 访问日志降为 DEBUG 等级*
+    '''
+
+    access_log_sample: dict[str, float] = {
+        'query_route': 0.01,
+        'events': 1.0,
+        '*': 1.0
+    }
+    '''
+    `main.access_log_sample`
+    各路由的访问日志采样率 (0 ~ 1)
+    - 键: 路由 endpoint 名称, `*` 表示其他所有路由
+    - 写入类请求 (如 `/api/device/set`) 和出错的请求 (状态码 >= 400) 始终记录
+    - 未被采样的请求会聚合为定期输出的汇总行 (`"type": "summary"`)
+    '''
+
+    access_log_summary_interval: PositiveInt = 60
+    '''
+    `main.access_log_summary_interval`
+    访问日志汇总行的输出间隔 (秒)
     '''
 
     colorful_log: bool = True
@@ -109,6 +171,15 @@ class _MainConfigModel(BaseModel):
     - *建议设置为 20 分钟 (1200s)*
     '''
 
+    plugin_data_flush: int = 5
+    '''
+    `main.plugin_data_flush`
+    插件数据 (及键值存储) 写回数据库的间隔 (秒)
+    - 插件数据的修改会先缓存在内存中, 再定期批量写入数据库
+    - *设置为 0 则每次修改都立即写入*
+    - 立即写入 (包括多个 worker 时) 失败的修改会被放弃, 并向调用方返回 500 错误
+    '''
+
     cors_origins: list[str] | str = '*'
     '''
     `main.cors_origins`
@@ -240,6 +311,19 @@ class _StatusConfigModel(BaseModel):
     - 顺序: 在线 (正在使用 -> 未在使用) -> 离线 -> 未知
     '''
 
+    journal_size: int = 1000
+    '''
+    `status.journal_size`
+    变更日志 (`/api/changes`) 最多保留的条数 (0 为不限制)
+    '''
+
+    journal_age: int = 86400
+    '''
+    `status.journal_age`
+    变更日志最多保留的时间 (秒, 0 为不限制) \n
+    客户端断开超过此时间后重连, 需重新获取完整状态
+    '''
+
     status_list: list[_StatusItemModel] = [
         _StatusItemModel(
             name='活着',
@@ -293,6 +377,361 @@ class _MetricsConfigModel(BaseModel):
     *其中的 `[static]` 为特殊值, 匹配 static 目录中的所有文件*
     '''
 
+    prometheus_enabled: bool = False
+    '''
+    `metrics.prometheus_enabled`
+    是否启用运行时指标 (请求延迟 / SSE 连接数 / 数据库耗时 / 缓存命中等) \n
+    启用后可通过 `/api/metrics/prometheus` 以 Prometheus 文本格式抓取
+    '''
+
+    query_budget: dict[str, int] = {}
+    '''
+    `metrics.query_budget`
+    单个请求允许执行的 SQL 语句数, 超出时记录警告日志
+    - 键: 路由 endpoint 名称 (如 `query_route`, `device_set`), `*` 表示其他所有路由
+    - 值: 最大语句数
+    - *例: `{"query_route": 3, "*": 10}`*
+    '''
+
+    prometheus_allow_ips: list[str] = []
+    '''
+    `metrics.prometheus_allow_ips`
+    允许无需 secret 访问 `/api/metrics/prometheus` 的 IP / 网段 (如 `['127.0.0.1', '10.0.0.0/8']`, 默认为空, 即始终需要 secret) \n
+    - *判断的是直接连接的地址: 经过反向代理 (nginx / Caddy 等) 的请求都来自代理的地址, 如将 `127.0.0.1` 加入列表, 所有经过本机代理的访问者都可以无需 secret 获取指标*
+    - *因此带有 `X-Forwarded-For` / `X-Real-IP` 头的请求 (经过代理) 始终需要 secret, 只有 Prometheus 直接访问时免除*
+    '''
+
+
+class _DiagnosticsConfigModel(BaseModel):
+    '''
+    诊断工具配置 (`diagnostics`)
+    '''
+
+    profiler: bool = True
+    '''
+    `diagnostics.profiler`
+    是否允许按需分析请求 \n
+    在任意请求中加入 `?__profile=1` 参数 (或 `Sleepy-Profile: 1` 请求头) 并提供 secret, 即可分析该请求:
+    - `1`: 保存分析结果到 `diagnostics.profile_dir` (文件名见响应头 `Sleepy-Profile`)
+    - `text`: 直接返回 pstats 报告
+    - `collapsed`: 直接返回 collapsed stacks (可用于生成火焰图)
+    '''
+
+    profile_dir: str = 'data/profiles'
+    '''
+    `diagnostics.profile_dir`
+    分析结果保存目录 (`<时间>-<请求id>.pstats` / `.collapsed`)
+    '''
+
+    profile_keep: int = 20
+    '''
+    `diagnostics.profile_keep`
+    最多保留的分析结果数量
+    '''
+
+    profile_interval: float = 0.001
+    '''
+    `diagnostics.profile_interval`
+    分析时调用栈的采样间隔 (秒)
+    '''
+
+    watchdog_enabled: bool = True
+    '''
+    `diagnostics.watchdog_enabled`
+    是否启用慢请求看门狗 \n
+    请求处理时间超过 `diagnostics.slow_threshold` 时, 记录处理线程的调用栈到日志, 并在管理面板中显示最近的慢请求
+    '''
+
+    slow_threshold: float = 3
+    '''
+    `diagnostics.slow_threshold`
+    慢请求阈值 (秒)
+    '''
+
+    watchdog_interval: float = 0.5
+    '''
+    `diagnostics.watchdog_interval`
+    看门狗检查间隔 (秒)
+    '''
+
+    slow_history: int = 50
+    '''
+    `diagnostics.slow_history`
+    管理面板中保留的慢请求数量
+    '''
+
+    slow_log_limit: int = 10
+    '''
+    `diagnostics.slow_log_limit`
+    每分钟最多输出的慢请求调用栈日志数 (超出部分只计数)
+    '''
+
+    stats_enabled: bool = True
+    '''
+    `diagnostics.stats_enabled`
+    是否启用运行时统计 (`/api/debug/stats`, 需要 secret) 及管理面板中的运行状态卡片 \n
+    包含 线程数 / 内存 / GC / 各客户端的 SSE 连接数 / 缓存大小 / 数据表行数, 可选附带 tracemalloc 统计
+    '''
+
+    capture_file: str = ''
+    '''
+    `diagnostics.capture_file`
+    流量录制文件 (JSON Lines, 留空禁用) \n
+    如: `data/capture.jsonl` \n
+    记录每个请求的 方法 / 路径 / 参数 / 请求体结构 / 鉴权方式 / 耗时, 可使用 `bench/replay.py` 对测试实例回放
+    - secret 不会被记录; 其他字符串只记录长度和哈希 (无法还原原文)
+    - *切割规则与 `main.log_file` 相同 (不按天切割)*
+    '''
+
+    capture_sample: float = 1.0
+    '''
+    `diagnostics.capture_sample`
+    流量录制的采样率 (0 ~ 1)
+    '''
+
+
+class _ServerConfigModel(BaseModel):
+    '''
+    生产服务器配置 (`server`, 仅对 `python serve.py` 启动生效)
+    '''
+
+    workers: int = 1
+    '''
+    `server.workers`
+    worker 进程数 (0 为 CPU 核心数) \n
+    多个 worker 时:
+    - 定时任务 (如每日 metrics 刷新) 通过文件锁选出一个进程执行, 该进程退出后由其他进程接管
+    - 插件数据 / 键值不再在进程内缓存, 每次修改立即写入数据库 (`main.plugin_data_flush` 不生效)
+    - 运行时统计 / Prometheus 指标 / SSE 连接数等均为单个进程的数据
+    - *使用 SQLite 时不建议设置过多 worker*
+    - 使用 `main.py` 启动时始终为单进程, 此项不生效; 由 uwsgi 等直接导入 `main:app` 时请设置为实际的进程数
+    '''
+
+    threads: PositiveInt = 32
+    '''
+    `server.threads`
+    每个 worker 的线程数 (即同时处理的请求数) \n
+    *每个 SSE (`/api/status/events`) / WebSocket (`/api/ws`) 连接会占用一个线程, 可通过 `server.stream_limit` 限制*
+    '''
+
+    keepalive: int = 5
+    '''
+    `server.keepalive`
+    keep-alive 连接的空闲超时 (秒, 0 为禁用 keep-alive)
+    '''
+
+    worker_timeout: int = 60
+    '''
+    `server.worker_timeout`
+    worker 无响应多久后被重启 (秒)
+    '''
+
+    graceful_timeout: int = 30
+    '''
+    `server.graceful_timeout`
+    重启 / 停止时等待正在处理的请求完成的时间 (秒)
+    - 期间会通知 SSE / WebSocket 客户端稍后重连, 并写回缓冲的数据 (`main.py` 同样适用)
+    '''
+
+    max_requests: int = 0
+    '''
+    `server.max_requests`
+    每个 worker 处理多少个请求后自动重启 (0 为不重启, 可用于缓解内存增长)
+    '''
+
+    requests_jitter: int = 0
+    '''
+    `server.requests_jitter`
+    `server.max_requests` 的随机偏移量, 避免所有 worker 同时重启
+    '''
+
+    backlog: PositiveInt = 2048
+    '''
+    `server.backlog`
+    等待接受的连接队列长度
+    '''
+
+    max_body_size: int = 0
+    '''
+    `server.max_body_size`
+    请求体大小上限 (字节, 0 为不限制), 超出返回 413 \n
+    *对 `python main.py` 启动同样生效*
+    '''
+
+    notify_socket: bool = True
+    '''
+    `server.notify_socket`
+    多个 worker 时, 是否通过 Unix socket 互相通知数据变化 (SSE 等可在数毫秒内收到其他 worker 处理的更新) \n
+    - 不支持 Unix socket 的系统 (Windows) 或设置为 `false` 时, 改为由每个进程定期检查数据库 (见 `server.notify_poll`)
+    - *多台服务器共用一个数据库时, 请设置为 `false`*
+    '''
+
+    notify_poll: float = 1
+    '''
+    `server.notify_poll`
+    不使用 Unix socket 通知时, 每个进程检查数据库是否变化的间隔 (秒)
+    '''
+
+    notify_window: float = 0.1
+    '''
+    `server.notify_window`
+    变更推送合并窗口 (秒, 0 为不合并) \n
+    距上次推送超过此时间的变更立即推送, 窗口内的其他变更 (如多个设备同时更新) 合并为一次推送, 每个 SSE / WebSocket 订阅者每个窗口最多收到一次更新 \n
+    *对 `python main.py` 启动同样生效*
+    '''
+
+    stream_limit: int = 0
+    '''
+    `server.stream_limit`
+    每个 worker 同时打开的长连接 (SSE / WebSocket) 数上限 (0 为不限制) \n
+    超出时 SSE 返回 `503` (带 `Retry-After`), WebSocket 以 `1013` 关闭 \n
+    *建议小于 `server.threads`, 为普通请求保留线程; `server.stream_*` 对 `python main.py` 启动同样生效*
+    '''
+
+    stream_ip_limit: int = 0
+    '''
+    `server.stream_ip_limit`
+    每个客户端 (ip) 同时打开的长连接数上限 (0 为不限制, 默认不限制) \n
+    *同一 NAT / 运营商级 NAT 后的访客共用一个 ip; 经过反向代理且未传递真实 ip 时, 所有访客都是代理的 ip. 启用前请确认 ip 能区分访客, 并留出足够余量*
+    '''
+
+    stream_send_timeout: float = 30
+    '''
+    `server.stream_send_timeout`
+    长连接的发送阻塞 / 发送缓冲区持续已满多久后断开该连接 (秒, 0 为不断开) \n
+    缓冲区已满时不会继续积压更新, 可写后直接发送最新的完整状态
+    '''
+
+    stream_send_buffer: int = 65536
+    '''
+    `server.stream_send_buffer`
+    每个长连接的 socket 发送缓冲区大小 (字节, 0 为系统默认)
+    '''
+
+    stream_retry_after: int = 10
+    '''
+    `server.stream_retry_after`
+    长连接数超出上限时, 建议客户端重试的等待时间 (秒)
+    - 服务端停止时, 通知客户端在 1 ~ 此时间内随机延迟后重连
+    '''
+
+
+class _ReplicaConfigModel(BaseModel):
+    '''
+    只读副本配置 (`replica`) \n
+    副本从主实例同步状态, 在本地提供状态页 / `/api/status/query` / `/api/meta` / SSE 等只读接口, 设备仍向主实例上报
+    '''
+
+    primary: str = ''
+    '''
+    `replica.primary`
+    主实例地址 (如 `https://sleepy.example.com`, 为空则不作为副本运行) \n
+    - *副本的 `status.status_list` 请与主实例保持一致*
+    - *建议副本使用内存数据库 (`main.database` 设置为 `sqlite://`), 重启后会自动从主实例重新同步*
+    '''
+
+    writes: str = 'reject'
+    '''
+    `replica.writes`
+    收到写入请求 (设置状态 / 设备等) 时的处理方式
+    - `reject`: 返回 `403`
+    - `redirect`: 返回 `307` 重定向到主实例的同一地址 (客户端需支持跟随重定向)
+    '''
+
+    timeout: PositiveInt = 30
+    '''
+    `replica.timeout`
+    向主实例发起的长轮询等待时间 (秒, 最大 60)
+    '''
+
+    retry: float = 5
+    '''
+    `replica.retry`
+    同步出错后的重试间隔 (秒, 连续出错时逐次翻倍, 最长 60 秒)
+    '''
+
+
+class _AggregatorConfigModel(BaseModel):
+    '''
+    聚合模式配置 (`aggregator`) \n
+    同时订阅多个 Sleepy 实例 (如每人一个), 合并为一个状态页 / `/api/status/query` / SSE
+    '''
+
+    upstreams: dict[str, str] = {}
+    '''
+    `aggregator.upstreams`
+    上游实例 (名称 -> 地址, 为空则不使用聚合模式), 如: \n
+    ```yaml
+    aggregator:
+      upstreams:
+        Alice: https://alice.example.com
+        Bob: https://sleepy.bob.example.com
+    ```
+    - 每个上游显示为一个设备 (id 为名称, 状态为该实例的手动状态), 其设备的 id 为 `名称/设备 id`
+    - *名称不能包含 `/`*
+    '''
+
+    timeout: float = 5
+    '''
+    `aggregator.timeout`
+    每个上游的连接 / 响应超时 (秒, 长轮询时另加等待时间)
+    '''
+
+    wait: int = 30
+    '''
+    `aggregator.wait`
+    向上游发起的长轮询等待时间 (秒, 最大 60)
+    '''
+
+    interval: float = 10
+    '''
+    `aggregator.interval`
+    上游不支持长轮询 (旧版本) 时, 轮询 `/api/status/query` 的间隔 (秒)
+    '''
+
+    stale_after: float = 90
+    '''
+    `aggregator.stale_after`
+    多久未能从上游获取数据后标记为过期 (秒, 请大于 `aggregator.wait` + `aggregator.timeout`) \n
+    过期的上游仍显示最后一次获取到的状态, 其设备的 `fields.stale` 为 `true`
+    '''
+
+    breaker_failures: PositiveInt = 3
+    '''
+    `aggregator.breaker_failures`
+    连续失败多少次后暂停请求该上游 (熔断, 同时标记为过期)
+    '''
+
+    breaker_cooldown: float = 30
+    '''
+    `aggregator.breaker_cooldown`
+    熔断后多久再次尝试请求 (秒, 成功则恢复, 失败则继续熔断)
+    '''
+
+
+class _PublishConfigModel(BaseModel):
+    '''
+    静态发布配置 (`publish`) \n
+    状态变化时将主页 / `/api/status/query` / `/api/meta` 生成为静态文件, 由 nginx / CDN 直接提供, Sleepy 只处理写入和 SSE 等请求
+    '''
+
+    dir: str = ''
+    '''
+    `publish.dir`
+    输出目录 (相对于程序目录, 如 `data/public`, 为空则不生成) \n
+    生成的文件:
+    - `index.html`: `page.theme` 主题的主页
+    - `themes/<主题>/index.html`: 各主题的主页
+    - `query.json`: `/api/status/query` 的返回
+    - `meta.json`: `/api/meta` 的返回
+    '''
+
+    themes: list[str] = []
+    '''
+    `publish.themes`
+    生成主页的主题 (为空则生成所有已安装的主题)
+    '''
+
 
 class ConfigModel(BaseModel):
     '''
@@ -307,6 +746,11 @@ class ConfigModel(BaseModel):
     page: _PageConfigModel = _PageConfigModel()
     status: _StatusConfigModel = _StatusConfigModel()
     metrics: _MetricsConfigModel = _MetricsConfigModel()
+    diagnostics: _DiagnosticsConfigModel = _DiagnosticsConfigModel()
+    server: _ServerConfigModel = _ServerConfigModel()
+    replica: _ReplicaConfigModel = _ReplicaConfigModel()
+    aggregator: _AggregatorConfigModel = _AggregatorConfigModel()
+    publish: _PublishConfigModel = _PublishConfigModel()
 
     plugins_enabled: list[str] = [
         'v4_compatible', # 默认启用 v4 兼容
@@ -330,6 +774,11 @@ class ConfigModel(BaseModel):
 env_vaildate_json_keys = [
     'status_status_list',
     'metrics_allow_list',
+    'metrics_prometheus_allow_ips',
+    'metrics_query_budget',
+    'main_access_log_sample',
+    'aggregator_upstreams',
+    'publish_themes',
     'plugins_enabled',
     'plugin'
 ]
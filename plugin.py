@@ -6,7 +6,10 @@ from functools import wraps
 from contextlib import contextmanager
 from traceback import format_exc
 from collections import defaultdict
+from copy import deepcopy
 from datetime import datetime
+from threading import Lock, Thread
+from time import time, perf_counter
 
 import flask
 from werkzeug.exceptions import HTTPException
@@ -15,6 +18,7 @@ from toml import loads as load_toml
 from models import ConfigModel, _StatusItemModel
 from data import Data, _DeviceStatusData
 import utils as u
+import instrument as ins
 
 l = getLogger(__name__)
 
@@ -360,6 +364,75 @@ class VersionNotMatchException(BaseException):
     def __str__(self):
         return self.message
 
+class _CachedContent:
+    '''
+    带缓存的卡片 / 注入内容 (见 `cache_ttl` 参数)
+    - 数据版本 (`Data.changes.version`, 不需要查询数据库) 变化时立即失效, 重新生成期间其他请求等待结果
+    - 超过 ttl 后先返回旧内容, 并在后台刷新 (同一时间只有一个刷新)
+    '''
+
+    def __init__(self, func: t.Callable, ttl: float):
+        self.func = func
+        self.ttl = ttl
+        self._lock = Lock()
+        self._value: str | None = None
+        self._time: float = 0
+        self._version: int | None = None
+        wraps(func)(self)
+
+    def _refresh(self, version: int | None):
+        value = str(self.func())
+        self._value, self._time, self._version = value, time(), version
+        return value
+
+    def _refresh_background(self, version: int | None):
+        try:
+            self._refresh(version)
+        except Exception as e:
+            l.warning(f'[plugin] Error when refreshing cached content {self.func}: {e}\n{format_exc()}')
+        finally:
+            self._lock.release()
+
+    def get(self, version: int | None) -> str:
+        '''
+        获取内容
+
+        :param version: 当前数据版本
+        '''
+        value = self._value
+        if value is not None and self._version == version:
+            if time() - self._time < self.ttl:
+                ins.cache_requests.inc(cache='card', result='hit')
+                return value
+            # 已过期 -> 返回旧内容, 后台刷新
+            ins.cache_requests.inc(cache='card', result='stale')
+            if self._lock.acquire(blocking=False):
+                func = self._refresh_background
+                if flask.has_request_context():
+                    func = flask.copy_current_request_context(func)
+                Thread(target=func, args=(version,), daemon=True).start()
+            return value
+
+        # 无内容 / 版本变化 -> 等待刷新
+        ins.cache_requests.inc(cache='card', result='miss')
+        with self._lock:
+            if self._value is not None and self._version == version:
+                return self._value
+            return self._refresh(version)
+
+    def __call__(self) -> str:
+        return self.get(PluginInit.instance.d.changes.version)
+
+
+def _cached(content: str | t.Callable, cache_ttl: float | None) -> str | t.Callable:
+    '''
+    按需将卡片 / 注入内容包装为 `_CachedContent`
+    '''
+    if cache_ttl and callable(content):
+        return _CachedContent(content, cache_ttl)
+    return content
+
+
 class Plugin:
     '''
     Sleepy 插件接口
@@ -450,8 +523,9 @@ class Plugin:
         ```
         '''
         data = self.data
+        original = deepcopy(data)
         yield data
-        if data != self.data:
+        if data != original:
             self.data = data
 
     def set_data(self, key, value):
@@ -466,7 +540,50 @@ class Plugin:
         '''
         获取数据值
         '''
-        return self.data.get(key, default)
+        # 只复制需要的值, 不复制整个数据
+        return deepcopy(PluginInit.instance.d.get_plugin_data(self.name, copy=False).get(key, default))
+
+    def kv_get(self, key: str, default: t.Any = None) -> t.Any:
+        '''
+        获取键值存储中的值 (按键读取, 经过缓存)
+
+        :param key: 键
+        :param default: 不存在 / 已过期时返回的默认值
+        '''
+        return PluginInit.instance.d.plugin_kv_get(self.name, key, default)
+
+    def kv_set(self, key: str, value: t.Any, ttl: float | None = None):
+        '''
+        设置键值存储中的值 (只写入单个键)
+
+        :param key: 键
+        :param value: 值 (需可被 json 序列化)
+        :param ttl: 过期时间 (秒, 为空则永不过期)
+        '''
+        PluginInit.instance.d.plugin_kv_set(self.name, key, value, ttl)
+
+    def kv_incr(self, key: str, amount: int | float = 1, ttl: float | None = None) -> int | float:
+        '''
+        原子地增加键值存储中的值 (不存在则视为 0, 多个 worker 并发增加也不会丢失)
+
+        ```
+        views = plugin.kv_incr('views')
+        ```
+
+        :param key: 键
+        :param amount: 增加量
+        :param ttl: 过期时间 (秒, 为空则保留原过期时间)
+        :return: 增加后的值
+        '''
+        return PluginInit.instance.d.plugin_kv_incr(self.name, key, amount, ttl)
+
+    def kv_delete(self, key: str):
+        '''
+        删除键值存储中的值
+
+        :param key: 键
+        '''
+        PluginInit.instance.d.plugin_kv_delete(self.name, key)
 
     @property
     def global_config(self) -> ConfigModel:
@@ -586,20 +703,23 @@ class Plugin:
 
     # region plugin-api-cards
 
-    def add_index_card(self, card_id: str, content: str | t.Callable):
+    def add_index_card(self, card_id: str, content: str | t.Callable, cache_ttl: float | None = None):
         '''
         注册 index.html 卡片 (如已有则追加到末尾)
 
         :param card_id: 用于区分不同卡片
         :param content: 卡片 HTML 内容
+        :param cache_ttl: 缓存时间 (秒, 仅对函数生效, 为空则每次访问都重新生成)
         '''
-        PluginInit.instance.index_cards[card_id].append(content)
+        PluginInit.instance.index_cards[card_id].append(_cached(content, cache_ttl))
+        PluginInit.instance._compiled = None
 
-    def index_card(self, card_id: str):
+    def index_card(self, card_id: str, cache_ttl: float | None = None):
         '''
         [装饰器] 注册 index.html 卡片 (如已有则追加到末尾)
 
         :param card_id: 用于区分不同卡片
+        :param cache_ttl: 缓存时间 (秒, 为空则每次访问都重新生成)
         '''
         def decorator(f):
             @wraps(f)
@@ -608,30 +728,34 @@ class Plugin:
 
             self.add_index_card(
                 card_id=card_id,
-                content=wrapper
+                content=wrapper,
+                cache_ttl=cache_ttl
             )
             return wrapper
         return decorator
 
-    def add_panel_card(self, card_id: str, card_title: str, content: str | t.Callable):
+    def add_panel_card(self, card_id: str, card_title: str, content: str | t.Callable, cache_ttl: float | None = None):
         '''
         注册管理面板卡片 (唯一, 不可追加)
 
         :param card_id: 用于区分不同卡片
         :param content: 卡片 HTML 内容
+        :param cache_ttl: 缓存时间 (秒, 仅对函数生效, 为空则每次访问都重新生成)
         '''
         PluginInit.instance.panel_cards[card_id] = {
             'title': card_title,
             'plugin': self.name,
-            'content': content
+            'content': _cached(content, cache_ttl)
         }
+        PluginInit.instance._compiled = None
         return card_id
 
-    def panel_card(self, card_id: str, card_title: str):
+    def panel_card(self, card_id: str, card_title: str, cache_ttl: float | None = None):
         '''
         [装饰器] 注册管理面板卡片 (唯一, 不可追加)
 
         :param card_id: 用于区分不同卡片
+        :param cache_ttl: 缓存时间 (秒, 为空则每次访问都重新生成)
         '''
         def decorator(f):
             @wraps(f)
@@ -641,7 +765,8 @@ class Plugin:
             self.add_panel_card(
                 card_id=card_id,
                 card_title=card_title,
-                content=wrapper
+                content=wrapper,
+                cache_ttl=cache_ttl
             )
             return wrapper
         return decorator
@@ -650,45 +775,53 @@ class Plugin:
 
     # region plugin-api-injects
 
-    def add_index_inject(self, content: str | t.Callable):
+    def add_index_inject(self, content: str | t.Callable, cache_ttl: float | None = None):
         '''
         主页注入 (不显示卡片)
 
         :param content: 注入 HTML 内容
+        :param cache_ttl: 缓存时间 (秒, 仅对函数生效, 为空则每次访问都重新生成)
         '''
-        PluginInit.instance.index_injects.append(content)
+        PluginInit.instance.index_injects.append(_cached(content, cache_ttl))
+        PluginInit.instance._compiled = None
 
-    def index_inject(self):
+    def index_inject(self, cache_ttl: float | None = None):
         '''
         [装饰器] 主页注入 (不显示卡片)
+
+        :param cache_ttl: 缓存时间 (秒, 为空则每次访问都重新生成)
         '''
         def decorator(f):
             @wraps(f)
             def wrapper(*args, **kwargs):
                 return f(*args, **kwargs)
 
-            self.add_index_inject(wrapper)
+            self.add_index_inject(wrapper, cache_ttl=cache_ttl)
             return wrapper
         return decorator
 
-    def add_panel_inject(self, content: str | t.Callable):
+    def add_panel_inject(self, content: str | t.Callable, cache_ttl: float | None = None):
         '''
         管理面板注入 (不显示卡片)
 
         :param content: 注入 HTML 内容
+        :param cache_ttl: 缓存时间 (秒, 仅对函数生效, 为空则每次访问都重新生成)
         '''
-        PluginInit.instance.panel_injects.append(content)
+        PluginInit.instance.panel_injects.append(_cached(content, cache_ttl))
+        PluginInit.instance._compiled = None
 
-    def panel_inject(self):
+    def panel_inject(self, cache_ttl: float | None = None):
         '''
         [装饰器] 管理面板注入 (不显示卡片)
+
+        :param cache_ttl: 缓存时间 (秒, 为空则每次访问都重新生成)
         '''
         def decorator(f):
             @wraps(f)
             def wrapper(*args, **kwargs):
                 return f(*args, **kwargs)
 
-            self.add_panel_inject(wrapper)
+            self.add_panel_inject(wrapper, cache_ttl=cache_ttl)
             return wrapper
         return decorator
 
@@ -755,6 +888,8 @@ class PluginInit:
     '''管理面板注入'''
     events: defaultdict[str, list[t.Callable]] = defaultdict(list)
     '''事件注册表'''
+    _compiled: tuple[dict[str, list[str | t.Callable]], list[str | t.Callable], list[str | t.Callable], bool] | None = None
+    '''预处理后的 (主页卡片, 主页注入, 管理面板注入, 是否有缓存内容), 注册卡片 / 注入时重置'''
 
     def __init__(self, version: tuple[int, int, int], config: ConfigModel, data: Data, app: flask.Flask):
         self.version = version
@@ -798,6 +933,101 @@ class PluginInit:
         loaded_names = ", ".join([n.name for n in self.plugins_loaded])
         l.info(f'{loaded_count} plugin{"s" if loaded_count > 1 else ""} enabled: {loaded_names}' if loaded_count > 0 else f'No plugins enabled.')
 
+    @staticmethod
+    def _merge_static(items: list[str | t.Callable], sep: str) -> list[str | t.Callable]:
+        '''
+        合并相邻的静态内容 (每项末尾追加 `sep`)
+        '''
+        merged: list[str | t.Callable] = []
+        for i in items:
+            if callable(i):
+                merged.append(i)
+            elif merged and isinstance(merged[-1], str):
+                merged[-1] += f'{i}{sep}'
+            else:
+                merged.append(f'{i}{sep}')
+        return merged
+
+    def _compile(self):
+        '''
+        预处理卡片 / 注入: 静态内容只拼接一次
+        '''
+        if self._compiled is None:
+            index_cards = {name: self._merge_static(values, '<br/>\n') for name, values in self.index_cards.items()}
+            index_injects = [i.removesuffix('\n') if isinstance(i, str) else i for i in self._merge_static(self.index_injects, '\n')]
+            panel_injects = self._merge_static(self.panel_injects, '\n')
+            has_cached = any(
+                isinstance(i, _CachedContent)
+                for i in [*(v for values in self.index_cards.values() for v in values), *self.index_injects, *self.panel_injects, *(c['content'] for c in self.panel_cards.values())]
+            )
+            self._compiled = (index_cards, index_injects, panel_injects, has_cached)
+        return self._compiled
+
+    def _render(self, content: str | t.Callable, version: int | None) -> str:
+        '''
+        生成单个卡片 / 注入内容
+        '''
+        if isinstance(content, _CachedContent):
+            return content.get(version)
+        elif callable(content):
+            return str(content())
+        else:
+            return content
+
+    def _version(self, has_cached: bool) -> int | None:
+        '''
+        获取数据版本 (仅在存在缓存内容时使用)
+        '''
+        return self.d.changes.version if has_cached else None
+
+    def render_index_cards(self) -> dict[str, str]:
+        '''
+        生成主页插件卡片
+        '''
+        index_cards, _, _, has_cached = self._compile()
+        version = self._version(has_cached)
+        cards: dict[str, str] = {}
+        for name, values in index_cards.items():
+            cards[name] = ''.join(
+                v if isinstance(v, str) else f'{self._render(v, version)}<br/>\n'
+                for v in values
+            )
+        return cards
+
+    def render_index_injects(self) -> list[str]:
+        '''
+        生成主页注入 (相邻的静态注入已合并)
+        '''
+        _, index_injects, _, has_cached = self._compile()
+        version = self._version(has_cached)
+        return [self._render(i, version) for i in index_injects]
+
+    def render_panel_cards(self) -> dict[str, dict[str, str]]:
+        '''
+        生成管理面板插件卡片
+        '''
+        _, _, _, has_cached = self._compile()
+        version = self._version(has_cached)
+        cards = {}
+        for name, card in self.panel_cards.items():
+            if callable(card['content']):
+                cards[name] = card.copy()
+                cards[name]['content'] = self._render(card['content'], version)
+            else:
+                cards[name] = card
+        return cards  # type: ignore
+
+    def render_panel_inject(self) -> str:
+        '''
+        生成管理面板注入
+        '''
+        _, _, panel_injects, has_cached = self._compile()
+        version = self._version(has_cached)
+        return ''.join(
+            i if isinstance(i, str) else f'{self._render(i, version)}\n'
+            for i in panel_injects
+        )
+
     def _register_route(self, rule: str, endpoint: str, view_func: t.Callable, options: dict[str, t.Any]):
         '''
         注册路由
@@ -816,13 +1046,22 @@ class PluginInit:
 
         :param event: 事件实例 (不可只使用 id)
         '''
-        for e in self.events[event.id]:
+        handlers = self.events[event.id]
+        if not handlers:
+            return event
+        event_id = event.id
+        start = perf_counter()
+        for e in handlers:
             try:
                 event = e(event=event, request=event.request)
                 if event and event.interception:
+                    if flask.has_request_context():
+                        flask.g.intercepted = event_id  # 记录到访问日志
                     break
             except Exception as err:
+                ins.plugin_event_errors.inc(event=event_id)
                 l.warning(f'[plugin] Error when trigging event {event.id} with function {e}: {err}\n{format_exc()}')
+        ins.plugin_event_duration.observe(perf_counter() - start, event=event_id)
         return event
 
 # endregion plugin-init
@@ -0,0 +1,151 @@
+# coding: utf-8
+
+'''
+静态发布: 状态变化时将主页 / `/api/status/query` / `/api/meta` 写入目录, 由 nginx / CDN 直接提供 (见 `publish` 配置项)
+'''
+
+import os
+import tempfile
+from logging import getLogger
+from threading import Thread
+from time import time, perf_counter, sleep
+import typing as t
+
+import utils as u
+import instrument as ins
+from models import ConfigModel
+
+l = getLogger(__name__)
+
+
+class StaticPublisher:
+    '''
+    静态发布
+    - 后台线程等待数据变更 (`Data.changes`, 合并窗口内的多次变更只生成一次), 每次变更后重新生成所有文件
+    - 每个文件先写入同目录下的临时文件再重命名, 读取方不会看到写了一半的文件
+    - 多个 worker 时只由执行全局任务的进程生成
+    '''
+
+    def __init__(self, config: ConfigModel, data: t.Any):
+        '''
+        :param config: 配置
+        :param data: `data.Data` 实例
+        :raises u.SleepyException: `publish.themes` 中有不存在的主题
+        '''
+        self.dir = u.get_path(config.publish.dir, is_dir=True)
+        '''输出目录 (绝对路径)'''
+        for theme in config.publish.themes:
+            if theme not in u.themes_available():
+                raise u.SleepyException(f'Invaild theme in publish.themes: {theme!r}, available: {", ".join(u.themes_available())}')
+        self.default_theme = config.page.theme
+        self.themes = list(dict.fromkeys([self.default_theme, *(config.publish.themes or u.themes_available())]))
+        '''生成主页的主题 (包含 `page.theme`, 用于 `index.html`)'''
+        self._d = data
+        self._render_index: t.Callable[[str], str | None] = lambda theme: None
+        self._render_json: dict[str, t.Callable[[], str]] = {}
+
+        self.published = 0
+        '''已生成的次数'''
+        self.last_published: float | None = None
+        '''最近一次生成的时间 (unix)'''
+        self.duration: float | None = None
+        '''最近一次生成的耗时 (秒)'''
+        self.errors = 0
+        self.last_error: str | None = None
+
+    def start(self, render_index: t.Callable[[str], str | None], render_json: dict[str, t.Callable[[], str]]):
+        '''
+        启动后台生成线程 (启动后立即生成一次)
+
+        :param render_index: 生成指定主题的主页 (返回 html, 为空则跳过)
+        :param render_json: 文件名 -> 生成 json 文本的函数 (如 `query.json`)
+        '''
+        self._render_index = render_index
+        self._render_json = render_json
+        Thread(target=self._loop, daemon=True, name='publish').start()
+        l.info(f'[publish] Publishing static pages to {self.dir} (themes: {", ".join(self.themes)})')
+
+    def _loop(self):
+        version: int | None = None
+        while not self._d.changes.stopping:
+            if not self._d.is_leader:
+                # 由其他进程生成, 成为 leader 后立即生成一次
+                version = None
+                sleep(1)
+                continue
+            if version is not None:
+                # 定期检查 leader 状态
+                new = self._d.changes.wait(version, timeout=30)
+                if new == version or self._d.changes.stopping:
+                    continue
+            version = self._d.changes.version
+            self.publish()
+
+    def publish(self):
+        '''
+        生成所有文件 (出错时记录并保留上一次的文件)
+        '''
+        start = perf_counter()
+        try:
+            files: dict[str, str] = {}
+            for name, render in self._render_json.items():
+                files[name] = render()
+            for theme in self.themes:
+                html = self._render_index(theme)
+                if html is None:
+                    continue
+                if theme == self.default_theme:
+                    files['index.html'] = html
+                files[os.path.join('themes', theme, 'index.html')] = html
+            for name, content in files.items():
+                self._write(name, content)
+        except Exception as e:
+            self.errors += 1
+            self.last_error = f'{type(e).__name__}: {e}'
+            ins.publish_runs.inc(result='error')
+            l.warning(f'[publish] Publish static pages failed: {self.last_error}')
+            return
+        self.duration = perf_counter() - start
+        self.published += 1
+        self.last_published = time()
+        ins.publish_runs.inc(result='ok')
+        ins.publish_duration.observe(self.duration)
+        l.debug(f'[publish] Published {len(files)} file(s) in {self.duration * 1000:.1f}ms')
+
+    def _write(self, name: str, content: str):
+        '''
+        原子写入文件 (临时文件 + 重命名)
+
+        :param name: 相对于输出目录的路径
+        :param content: 文件内容
+        '''
+        path = os.path.join(self.dir, name)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            # mkstemp 创建的文件只有当前用户可读, 需要让 nginx 等读取
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def stats(self) -> dict[str, t.Any]:
+        '''
+        生成状态
+        '''
+        return {
+            'dir': self.dir,
+            'themes': self.themes,
+            'published': self.published,
+            'last_published': self.last_published,
+            'duration': self.duration,
+            'errors': self.errors,
+            'last_error': self.last_error
+        }
@@ -0,0 +1,268 @@
+# coding: utf-8
+
+'''
+只读副本: 从主实例同步状态 (见 `replica` 配置项)
+- `JSONClient` 也用于聚合模式 (`aggregator.py`) 请求上游实例
+'''
+
+import json
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from logging import getLogger
+from threading import Thread
+from time import time, sleep
+from urllib.parse import urlsplit, urlencode
+import typing as t
+
+import utils as u
+import instrument as ins
+from models import ConfigModel
+
+l = getLogger(__name__)
+
+WRITE_MODES = ('reject', 'redirect')
+'''`replica.writes` 可选的值'''
+RETRY_MAX = 60
+'''同步连续出错时的最长重试间隔 (秒)'''
+
+
+class UpstreamError(Exception):
+    '''
+    其他实例返回了无法处理的响应
+    '''
+
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+        '''HTTP 状态码 (非 200 时)'''
+
+
+class JSONClient:
+    '''
+    请求其他 Sleepy 实例的 GET 接口 (复用 keep-alive 连接, 返回 json), 供只读副本 / 聚合模式使用
+    - 非线程安全, 每个同步线程使用自己的实例
+    '''
+
+    def __init__(self, base: str, timeout: float, name: str = 'config'):
+        '''
+        :param base: 实例地址 (如 `https://sleepy.example.com`)
+        :param timeout: 默认的连接 / 读取超时 (秒)
+        :param name: 出错时提示的配置项名称
+        :raises u.SleepyException: 地址无效
+        '''
+        self.base = base.rstrip('/')
+        url = urlsplit(self.base)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise u.SleepyException(f'Invaild {name}: {base!r}, it must be a http(s) url')
+        self.timeout = timeout
+        self._https = url.scheme == 'https'
+        self._host = url.hostname
+        self._port = url.port
+        self._path = url.path.rstrip('/')
+        self._conn: HTTPConnection | None = None
+
+    def get(self, path: str, params: dict[str, t.Any] | None = None, timeout: float | None = None) -> dict[str, t.Any]:
+        '''
+        发起请求
+
+        :param path: 接口路径
+        :param params: 查询参数
+        :param timeout: 本次请求的超时 (秒, 如长轮询需加上等待时间)
+        :raises UpstreamError: 返回非 200 / 无法解析
+        :raises OSError: 连接失败 / 超时
+        '''
+        timeout = timeout or self.timeout
+        if not self._conn:
+            cls = HTTPSConnection if self._https else HTTPConnection
+            self._conn = cls(self._host, self._port, timeout=timeout)  # type: ignore
+        elif self._conn.sock:
+            self._conn.sock.settimeout(timeout)
+        self._conn.timeout = timeout
+        url = f'{self._path}{path}' + (f'?{urlencode(params)}' if params else '')
+        try:
+            self._conn.request('GET', url, headers={'Accept': 'application/json', 'User-Agent': 'sleepy-sync'})
+            resp = self._conn.getresponse()
+            body = resp.read()
+        except (OSError, HTTPException):
+            self.close()
+            raise
+        if resp.status != 200:
+            raise UpstreamError(f'{path} returned {resp.status}', resp.status)
+        try:
+            ret = json.loads(body)
+        except ValueError:
+            raise UpstreamError(f'{path} returned invaild json')
+        if not isinstance(ret, dict):
+            raise UpstreamError(f'{path} returned unexpected data')
+        return ret
+
+    def close(self):
+        '''
+        关闭连接 (下次请求时重新连接)
+        '''
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class Replicator:
+    '''
+    只读副本同步
+    - 对主实例的 `/api/status/wait` 发起长轮询 (`delta=true`, 复用 keep-alive 连接), 按顺序应用变更 (`Data.apply_changes()`)
+    - 首次启动 / 序号出现缺口 (主实例的记录已被清理 / 数据库重建) / 变更无法应用时, 获取完整状态重新同步 (`Data.load_state()`)
+    - 同步的数据写入本地数据库 (及变更日志), 本地的 SSE / 长轮询 / WebSocket 订阅与普通实例相同
+    - 多个 worker 共用数据库时只由执行全局任务的进程同步
+    '''
+
+    def __init__(self, config: ConfigModel, data: t.Any):
+        '''
+        :param config: 配置
+        :param data: `data.Data` 实例
+        '''
+        r = config.replica
+        self.timeout = min(r.timeout, 60)
+        self.retry = max(r.retry, 0.1)
+        self._client = JSONClient(r.primary, self.timeout + 10, 'replica.primary')
+        self.primary = self._client.base
+        '''主实例地址'''
+        if r.writes not in WRITE_MODES:
+            raise u.SleepyException(f'Invaild replica.writes: {r.writes!r}, it must be one of {", ".join(WRITE_MODES)}')
+        self.writes = r.writes
+        '''写入请求的处理方式 (`reject` / `redirect`)'''
+        self._d = data
+
+        self.seq: int | None = None
+        '''已同步到的主实例变更序号 (为空时需获取完整状态)'''
+        self.connected = False
+        '''最近一次请求主实例是否成功'''
+        self.lag: float | None = None
+        '''最近一次应用的变更从主实例写入到本地应用的延迟 (秒)'''
+        self.last_sync: float | None = None
+        '''最近一次成功请求主实例的时间 (unix)'''
+        self.resyncs = 0
+        self.errors = 0
+        self.last_error: str | None = None
+
+    def start(self):
+        '''
+        启动后台同步线程
+        '''
+        Thread(target=self._loop, daemon=True, name='replica').start()
+        l.info(f'[replica] Running as a read-only replica of {self.primary}')
+
+    # region sync
+
+    def _loop(self):
+        delay = self.retry
+        while True:
+            if not self._d.is_leader:
+                # 由其他进程同步
+                self._client.close()
+                self.seq = None
+                sleep(1)
+                continue
+            try:
+                self._sync()
+            except Exception as e:
+                self._fail(e)
+                sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+            else:
+                delay = self.retry
+
+    def _sync(self):
+        '''
+        同步一次 (长轮询直到主实例有变化 / 超时)
+        '''
+        if self.seq is None:
+            self._resync('start')
+            return
+        resp = self._get('/api/status/wait', {'seq': self.seq, 'delta': 'true', 'timeout': self.timeout})
+        if not resp.get('changed'):
+            self.seq = resp['seq']
+            return
+        if 'changes' not in resp:
+            # 主实例无法补发 (记录已被清理 / 数据库重建), 已返回完整状态
+            self._load(resp, 'gap')
+            return
+        changes: list[dict[str, t.Any]] = resp['changes']
+        if changes:
+            complete = self._d.apply_changes(changes)
+            self.lag = max(time() - changes[-1]['time'], 0)
+            ins.replica_lag.set(self.lag)
+            ins.replica_changes.inc(len(changes))
+        else:
+            complete = True
+        self.seq = resp['seq']
+        if not complete and not self._d.private_mode:
+            # 有无法应用的变更 (如隐藏了设备信息)
+            self._resync('incomplete')
+        elif any(i['type'] == 'private_mode' and i.get('data') is False for i in changes):
+            # 主实例关闭隐私模式: 补上期间被隐藏的设备变更
+            self._resync('private_mode')
+
+    def _resync(self, reason: str):
+        '''
+        获取主实例的完整状态, 替换本地状态
+        '''
+        self._load(self._get('/api/status/wait'), reason)
+
+    def _load(self, resp: dict[str, t.Any], reason: str):
+        status = resp.get('status') or {}
+        changed = self._d.load_state(
+            status_id=status.get('id', -1),
+            devices=resp.get('device') or {},
+            last_updated=resp.get('last_updated') or time()
+        )
+        self.seq = resp['seq']
+        self.resyncs += 1
+        ins.replica_resyncs.inc(reason=reason)
+        (l.info if reason != 'incomplete' else l.debug)(f'[replica] Resynced full state from primary ({reason}), {changed} item(s) changed, seq: {self.seq}')
+
+    # endregion sync
+
+    # region http
+
+    def _get(self, path: str, params: dict[str, t.Any] | None = None) -> dict[str, t.Any]:
+        '''
+        请求主实例
+
+        :raises UpstreamError: 返回非 200 / 无法解析
+        '''
+        ret = self._client.get(path, params)
+        if 'seq' not in ret:
+            raise UpstreamError(f'{path} returned unexpected data (is the primary running an older version?)')
+        self.last_sync = time()
+        ins.replica_last_sync.set(self.last_sync)
+        if not self.connected:
+            self.connected = True
+            l.info(f'[replica] Connected to primary {self.primary}')
+        return ret
+
+    def _fail(self, e: Exception):
+        self.errors += 1
+        self.last_error = f'{type(e).__name__}: {e}'
+        ins.replica_errors.inc()
+        if self.connected or self.errors == 1:
+            self.connected = False
+            l.warning(f'[replica] Sync from primary {self.primary} failed, retrying: {self.last_error}')
+        else:
+            l.debug(f'[replica] Sync failed: {self.last_error}')
+        # 恢复后从 `seq` 继续同步 (错过的变更已被清理时主实例会返回完整状态)
+
+    # endregion http
+
+    def stats(self) -> dict[str, t.Any]:
+        '''
+        同步状态
+        '''
+        return {
+            'primary': self.primary,
+            'connected': self.connected,
+            'seq': self.seq,
+            'lag': self.lag,
+            'last_sync': self.last_sync,
+            'since_sync': round(time() - self.last_sync, 3) if self.last_sync else None,
+            'resyncs': self.resyncs,
+            'errors': self.errors,
+            'last_error': self.last_error
+        }
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+生产环境启动器: 使用 gunicorn (gthread worker, 多进程 + 多线程) 运行 Sleepy, 配置见 `server` 配置项
+
+- 需要安装 gunicorn: `pip install gunicorn` (或 `pip install .[server]`), 仅支持 Linux / macOS 等 (Windows 请使用 `main.py`)
+- 平滑重启 (重新加载代码 / 配置): 向主进程发送 `SIGHUP`, 会启动新的 worker 并等待旧 worker 处理完请求
+- 停止: `SIGTERM` (通知 SSE / WebSocket 客户端稍后重连, 等待正在处理的请求并写回缓冲的数据, 最多 `server.graceful_timeout` 秒) / `SIGINT` (立即停止)
+'''
+
+import logging
+import os
+import signal
+import sys
+from threading import Thread
+from traceback import format_exc
+import typing as t
+
+import utils as u
+from config import Config as config_init
+from models import ConfigModel
+
+l = logging.getLogger(__name__)
+
+
+def _post_worker_init(worker):
+    '''
+    (gunicorn hook) worker 收到 SIGTERM 时先通知长连接重连 (否则 gunicorn 会一直等待 SSE 等长连接, 直到超时)
+    '''
+    handler = signal.getsignal(signal.SIGTERM)
+
+    def on_term(signum, frame):
+        main = sys.modules.get('main')
+        if main:
+            # 信号处理函数中不做 IO
+            Thread(target=main.begin_shutdown, daemon=True, name='shutdown').start()
+        if callable(handler):
+            handler(signum, frame)
+
+    signal.signal(signal.SIGTERM, on_term)
+
+
+def _worker_exit(server, worker):
+    '''
+    (gunicorn hook) worker 退出时写回缓冲的数据并触发插件的 AppStoppedEvent (`main.shutdown()`), 然后关闭变更通知 socket
+    '''
+    main = sys.modules.get('main')
+    if main:
+        main.shutdown(0)
+        main.d.changes.close()
+
+
+def options(c: ConfigModel) -> dict[str, t.Any]:
+    '''
+    由配置生成 gunicorn 配置项
+    '''
+    s = c.server
+    host = f'[{c.main.host}]' if ':' in c.main.host else c.main.host
+    opts = {
+        'bind': f'{host}:{c.main.port}',
+        'workers': s.workers or os.cpu_count() or 1,
+        'worker_class': 'gthread',
+        'threads': s.threads,
+        'keepalive': s.keepalive,
+        'timeout': s.worker_timeout,
+        'graceful_timeout': s.graceful_timeout,
+        'max_requests': s.max_requests,
+        'max_requests_jitter': s.requests_jitter,
+        'backlog': s.backlog,
+        # 每个 worker 单独导入 main.py (定时任务 / 日志等后台线程无法跨 fork 使用)
+        'preload_app': False,
+        'accesslog': None,
+        'loglevel': 'debug' if c.main.debug else 'info',
+        'proc_name': 'sleepy',
+        'post_worker_init': _post_worker_init,
+        'worker_exit': _worker_exit
+    }
+    if c.main.https:
+        opts['certfile'] = c.main.ssl_cert
+        opts['keyfile'] = c.main.ssl_key
+    return opts
+
+
+def main():
+    root = logging.getLogger()
+    root.handlers.clear()
+    handler = logging.StreamHandler()
+    handler.setFormatter(u.CustomFormatter(colorful=False))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        l.critical('gunicorn is not installed (or not supported on this platform), install it with `pip install gunicorn`, or use main.py instead')
+        exit(1)
+
+    try:
+        c = config_init().config
+    except u.SleepyException as e:
+        l.critical(e)
+        exit(2)
+    except:
+        l.critical(f'Unexpected Error!\n{format_exc()}')
+        exit(3)
+
+    opts = options(c)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for k, v in opts.items():
+                self.cfg.set(k, v)  # type: ignore
+
+        def load(self):
+            # 由实际的 worker 数决定是否与其他进程共享数据库 (需在导入 main 前设置)
+            from data import Data
+            Data.workers = opts['workers']
+            from main import app
+            return app
+
+    l.info(f'Starting {opts["workers"]} worker(s) x {opts["threads"]} thread(s) on {"https" if c.main.https else "http"}://{opts["bind"]}')
+    Application().run()
+
+
+if __name__ == '__main__':
+    main()
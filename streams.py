@@ -0,0 +1,292 @@
+# coding: utf-8
+
+'''
+长连接 (SSE / WebSocket) 管理: 连接数限制 / 发送缓冲区限制 / 慢客户端驱逐 (见 `server.stream_*` 配置项)
+'''
+
+import socket
+from collections import Counter
+from logging import getLogger
+from random import uniform
+import select
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+import typing as t
+
+import instrument as ins
+from models import ConfigModel
+
+l = getLogger(__name__)
+
+_POLL_ERROR = getattr(select, 'POLLERR', 0) | getattr(select, 'POLLHUP', 0) | getattr(select, 'POLLNVAL', 0)
+
+
+def _wait_writable(sock: socket.socket, timeout: float) -> bool:
+    '''
+    等待 socket 可写
+    - 优先使用 `poll()` (`select()` 不支持 fd >= 1024, 连接数较多时会出错), 不支持时 (如 Windows) 使用 `select()`
+
+    :param timeout: 最多等待的时间 (秒)
+    :return: 是否可写
+    :raises OSError: 连接已关闭 / 出错
+    :raises ValueError: socket 已关闭 (fd 为 -1)
+    '''
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        events = poller.poll(timeout * 1000)
+        if any(ev & _POLL_ERROR for _, ev in events):
+            raise OSError('connection closed')
+        return bool(events)
+    _, w, _ = select.select([], [sock], [], timeout)
+    return bool(w)
+
+
+class Stream:
+    '''
+    单个长连接
+    - 发送前检查连接是否可写 (`writable()`), 不可写时调用方应跳过中间的更新, 之后直接发送最新的完整状态
+    - 发送期间 (`sending()` ~ `sent()`) 阻塞超过 `server.stream_send_timeout` 的连接会被强制关闭
+    '''
+
+    def __init__(self, limiter: 'StreamLimiter', kind: str, client: str, sock: socket.socket | None):
+        self._limiter = limiter
+        self.kind = kind
+        '''连接类型: `sse` / `ws`'''
+        self.client = client
+        '''客户端 (ip)'''
+        self.sock = sock
+        '''底层 socket (服务器未提供时为空, 此时不检查是否可写 / 无法驱逐)'''
+        self.opened = monotonic()
+        self.evicted: str | None = None
+        '''被驱逐的原因'''
+        self.reconnect: float | None = None
+        '''服务端正在停止时, 建议客户端重连前等待的时间 (秒, 连接应发送后关闭)'''
+        self.on_drain: t.Callable[[float], t.Any] | None = None
+        '''服务端停止时的回调 (参数为 `reconnect`, 用于主动通知并关闭连接, 为空则由连接自己检查 `reconnect`)'''
+        self._sending_since: float | None = None
+        self._stalled_since: float | None = None
+        self._closed = False
+
+    def writable(self, timeout: float = 0) -> bool:
+        '''
+        连接的发送缓冲区是否可写 (不可写即客户端接收缓慢, 之前发送的数据仍在排队)
+        - 持续不可写超过 `server.stream_send_timeout` 时驱逐连接
+        - 连接已关闭 / 出错时驱逐连接 (`evicted` 为 `closed`), 调用方应结束连接
+
+        :param timeout: 不可写时最多等待的时间 (秒)
+        '''
+        if self.evicted:
+            return False
+        if not self.sock:
+            return True
+        try:
+            w = _wait_writable(self.sock, timeout)
+        except (OSError, ValueError):
+            self.evict('closed')
+            return False
+        now = monotonic()
+        if w:
+            self._stalled_since = None
+            return True
+        if self._stalled_since is None:
+            self._stalled_since = now
+            ins.stream_stalls.inc(kind=self.kind)
+        elif self._limiter.send_timeout > 0 and now - self._stalled_since > self._limiter.send_timeout:
+            self.evict('stalled')
+        return False
+
+    def sending(self):
+        '''
+        开始发送 (在 yield / send 前调用)
+        '''
+        self._sending_since = monotonic()
+
+    def sent(self):
+        '''
+        发送完成
+        '''
+        self._sending_since = None
+
+    def blocked_for(self, now: float) -> float:
+        '''
+        当前发送已阻塞的时间 (秒)
+        '''
+        since = self._sending_since
+        return now - since if since is not None else 0
+
+    def evict(self, reason: str):
+        '''
+        驱逐连接 (关闭底层 socket, 阻塞在发送中的线程会立即出错返回)
+
+        :param reason: 原因 (`stalled` / `blocked` / `shutdown` / `closed`)
+        '''
+        if self.evicted:
+            return
+        self.evicted = reason
+        if reason == 'closed':
+            # 客户端已断开, 不计入驱逐
+            l.debug(f'[streams] {self.kind} client {self.client} disconnected')
+        else:
+            ins.stream_evictions.inc(kind=self.kind, reason=reason)
+            l.info(f'[streams] Evicted slow {self.kind} client {self.client} ({reason})')
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        '''
+        连接已结束 (释放连接数)
+        '''
+        if not self._closed:
+            self._closed = True
+            self._limiter._release(self)
+
+
+class StreamLimiter:
+    '''
+    长连接限制
+    - 全局 / 每个客户端的连接数上限 (超出时拒绝, SSE 返回 503 + `Retry-After`)
+    - 限制每个连接的发送缓冲区大小, 接收缓慢的客户端不会积压大量数据
+    - 后台线程定期检查, 驱逐发送阻塞过久的连接 (释放占用的线程)
+    - 停止时 (`drain()`) 拒绝新连接, 通知现有连接在随机延迟后重连 (分散重连)
+    '''
+
+    def __init__(self, config: ConfigModel):
+        s = config.server
+        self.limit = s.stream_limit
+        '''全局连接数上限 (0 为不限制)'''
+        self.ip_limit = s.stream_ip_limit
+        '''每个客户端的连接数上限 (0 为不限制)'''
+        self.send_timeout = s.stream_send_timeout
+        '''发送阻塞 / 缓冲区持续已满多久后驱逐 (秒)'''
+        self.send_buffer = s.stream_send_buffer
+        '''每个连接的发送缓冲区大小 (字节, 0 为系统默认)'''
+        self.retry_after = s.stream_retry_after
+        '''拒绝连接时建议客户端等待的时间 (秒)'''
+
+        self._lock = Lock()
+        self._released = Condition(self._lock)
+        self._streams: set[Stream] = set()
+        self._clients: Counter[str] = Counter()
+        self._reaper: Thread | None = None
+        self.draining = False
+        '''是否正在停止 (不再接受新连接)'''
+
+    def open(self, kind: str, client: str, environ: dict[str, t.Any]) -> Stream | None:
+        '''
+        登记新的长连接
+
+        :param kind: 连接类型 (`sse` / `ws`)
+        :param client: 客户端 (ip)
+        :param environ: WSGI environ (用于获取底层 socket)
+        :return: 超出连接数上限时返回 `None`
+        '''
+        with self._lock:
+            if self.draining:
+                reason = 'shutdown'
+            elif self.limit and len(self._streams) >= self.limit:
+                reason = 'global'
+            elif self.ip_limit and self._clients[client] >= self.ip_limit:
+                reason = 'client'
+            else:
+                reason = None
+                stream = Stream(self, kind, client, self._socket(environ))
+                self._streams.add(stream)
+                self._clients[client] += 1
+                if not self._reaper and self.send_timeout > 0:
+                    self._reaper = Thread(target=self._reap_loop, daemon=True, name='stream-reaper')
+                    self._reaper.start()
+        if reason:
+            ins.stream_rejections.inc(kind=kind, reason=reason)
+            l.info(f'[streams] Rejected {kind} client {client}: {"server is stopping" if reason == "shutdown" else f"too many connections ({reason})"}')
+            return None
+        return stream
+
+    def _socket(self, environ: dict[str, t.Any]) -> socket.socket | None:
+        sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+        if not isinstance(sock, socket.socket):
+            return None
+        if self.send_buffer > 0:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+            except OSError as e:
+                l.debug(f'[streams] Cannot set send buffer size: {e}')
+        return sock
+
+    def _release(self, stream: Stream):
+        with self._lock:
+            self._streams.discard(stream)
+            self._clients[stream.client] -= 1
+            if self._clients[stream.client] <= 0:
+                del self._clients[stream.client]
+            self._released.notify_all()
+
+    def drain(self):
+        '''
+        开始停止: 拒绝新连接, 通知现有连接在 1 ~ `server.stream_retry_after` 秒的随机延迟后重连
+        - 有 `on_drain` 回调的连接 (WebSocket) 直接调用回调, 其他连接 (SSE) 需唤醒后自行检查 `reconnect`
+        - 发送缓冲区已满的连接直接驱逐
+        '''
+        with self._lock:
+            self.draining = True
+            streams = [i for i in self._streams if i.reconnect is None]
+            for stream in streams:
+                stream.reconnect = uniform(1, max(self.retry_after, 1))
+        if streams:
+            l.info(f'[streams] Asking {len(streams)} stream(s) to reconnect')
+        for stream in streams:
+            if not stream.on_drain:
+                continue
+            if not stream.writable():
+                stream.evict('shutdown')
+                continue
+            try:
+                stream.on_drain(stream.reconnect)
+            except Exception as e:
+                l.debug(f'[streams] Drain {stream.kind} client {stream.client} failed: {e}')
+                stream.evict('shutdown')
+
+    def wait_closed(self, timeout: float) -> int:
+        '''
+        等待所有连接关闭
+
+        :param timeout: 最长等待时间 (秒)
+        :return: 超时后仍未关闭的连接数
+        '''
+        deadline = monotonic() + timeout
+        with self._lock:
+            while self._streams:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._released.wait(remaining)
+            return len(self._streams)
+
+    def _reap_loop(self):
+        interval = max(min(self.send_timeout / 4, 5), 0.1)
+        while True:
+            sleep(interval)
+            now = monotonic()
+            with self._lock:
+                streams = list(self._streams)
+            for stream in streams:
+                if stream.blocked_for(now) > self.send_timeout:
+                    stream.evict('blocked')
+
+    def stats(self) -> dict[str, t.Any]:
+        '''
+        当前连接统计
+        '''
+        with self._lock:
+            kinds = Counter(i.kind for i in self._streams)
+            return {
+                'total': len(self._streams),
+                'kinds': dict(kinds),
+                'clients': len(self._clients),
+                'limit': self.limit,
+                'ip_limit': self.ip_limit,
+                'draining': self.draining
+            }
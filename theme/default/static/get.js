@@ -220,6 +220,14 @@ function setupEventSource() {
         lastEventTime = Date.now(); // 更新最后收到消息的时间
     });
 
+    // 监听重连事件 (服务端正在重启, 按服务端给出的延迟重连)
+    evtSource.addEventListener('reconnect', function (event) {
+        const data = JSON.parse(event.data);
+        console.log(`[SSE] [#${event.lastEventId}] 服务端正在重启, ${data.retry}ms 后重连`);
+        evtSource.close();
+        reconnectWithDelay(data.retry);
+    });
+
     // 错误处理 (定时重连 / 回退)
     evtSource.onerror = async function (e) {
         console.error(`[SSE] 连接错误: ${e}`);
@@ -238,7 +246,7 @@ function setupEventSource() {
                     clearTimeout(connectionCheckTimer);
                     connectionCheckTimer = null;
                 }
-                update();
+                update(8); // Vercel 函数有最长执行时间限制, 缩短长轮询等待时间
                 return;
             } else if (isVercel === 0) {
                 // 如不是 (非错误), 以后错误跳过检查
@@ -317,40 +325,38 @@ document.addEventListener('DOMContentLoaded', function () {
     
 });
 
-// 原始轮询函数 (仅作为后备方案)
-async function update() {
+// 长轮询函数 (仅作为后备方案)
+// 请求 /api/status/wait, 服务端在状态变化 (或超时) 时才返回, 之后立即发起下一次请求
+async function update(waitTimeout = 25) {
     let refresh_time = metadata.status.refresh_interval || 5000;
+    let seq = null; // 已知的变更序号 (为空则获取当前状态)
     while (true) {
         if (document.visibilityState == 'visible') {
-            console.log('[Update] 页面可见，更新中...');
-            let success_flag = true;
-            let errorinfo = '';
             const statusElement = document.getElementById('status');
-            // --- show updating
-            document.getElementById('last-updated').innerHTML = `正在更新状态, 请稍候... <a href="javascript:location.reload();" target="_self" style="color: rgb(0, 255, 0);">刷新页面</a>`;
-            // fetch data
-            fetch('/api/status/query', { timeout: 10000 })
-                .then(response => response.json())
-                .then(async (data) => {
-                    console.log(`[Update] 返回: ${data}`);
-                    if (data.success) {
-                        updateDeviceStatus(data);
-                    } else {
-                        errorinfo = data.details || '未知错误';
-                        success_flag = false;
-                    }
-                })
-                .catch(error => {
-                    errorinfo = error;
-                    success_flag = false;
-                });
-            // 出错时显示
-            if (!success_flag) {
-                statusElement.textContent = '[!错误!]';
-                document.getElementById('additional-info').textContent = errorinfo;
-                last_status = statusElement.classList.item(0);
-                statusElement.classList.remove(last_status);
-                statusElement.classList.add('error');
+            try {
+                const url = seq === null ? '/api/status/wait' : `/api/status/wait?seq=${seq}&timeout=${waitTimeout}`;
+                const response = await fetch(url);
+                const data = await response.json();
+                if (!data.success) {
+                    throw data.details || '未知错误';
+                }
+                if (data.changed) {
+                    console.log(`[Update] 状态已更新 (#${data.seq}):`, data);
+                    updateDeviceStatus(data);
+                }
+                seq = data.seq;
+                continue;
+            } catch (error) {
+                // 出错时显示, 稍后重新获取完整状态
+                console.error(`[Update] 更新失败: ${error}`);
+                seq = null;
+                if (statusElement) {
+                    statusElement.textContent = '[!错误!]';
+                    document.getElementById('additional-info').textContent = error;
+                    let last_status = statusElement.classList.item(0);
+                    statusElement.classList.remove(last_status);
+                    statusElement.classList.add('error');
+                }
             }
         } else {
             console.log('[Update] 页面不可见，跳过更新');
@@ -358,4 +364,4 @@ async function update() {
 
         await sleep(refresh_time);
     }
-}
\ No newline at end of file
+}
@@ -1,10 +1,16 @@
 # coding: utf-8
 import os
 import time
+import ipaddress
+import gzip
+import shutil
+from io import TextIOWrapper
+from queue import Queue, Full
 from datetime import datetime, timezone
 from pathlib import Path
-from logging import Formatter, getLogger, DEBUG
-from functools import wraps
+from logging import Formatter, LogRecord, getLogger, DEBUG, WARNING
+from logging.handlers import QueueHandler, RotatingFileHandler
+from functools import wraps, lru_cache
 from typing import Any
 
 import flask
@@ -51,9 +57,22 @@ class CustomFormatter(Formatter):
             self.symbols = {}
             self.default_symbol = ''
         self.timezone = timezone
+        self._tz = pytz.timezone(timezone) if timezone else None
+        self._last_timestamp: tuple[int, str] = (-1, '')
+
+    def _format_time(self, created: float) -> str:
+        '''
+        格式化时间 (同一秒内复用结果)
+        '''
+        second = int(created)
+        cached = self._last_timestamp
+        if cached[0] != second:
+            cached = (second, datetime.fromtimestamp(second, self._tz).strftime('[%Y-%m-%d %H:%M:%S]'))
+            self._last_timestamp = cached
+        return cached[1]
 
     def format(self, record):
-        timestamp = (datetime.now(pytz.timezone(self.timezone)) if self.timezone else datetime.now()).strftime('[%Y-%m-%d %H:%M:%S]')  # 格式化时间
+        timestamp = self._format_time(record.created)  # 格式化时间 (使用日志产生时间, 而非写入时间)
         symbol = f' {self.symbols.get(record.levelname, self.default_symbol)}'  # 表情符号
         level = self.replaces.get(record.levelname, f'[{record.levelname}]')  # 日志等级
         file = relative_path(record.pathname)  # 源文件名
@@ -64,6 +83,200 @@ class CustomFormatter(Formatter):
         return formatted_message
 
 
+class DropQueueHandler(QueueHandler):
+    '''
+    有界队列的 QueueHandler: 队列满时丢弃日志并计数, 而不是阻塞请求线程
+    '''
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__(Queue(maxsize))
+        self.dropped: int = 0
+        '''已丢弃的日志条数'''
+        self._reported: int = 0
+
+    def enqueue(self, record: LogRecord):
+        try:
+            if self.dropped > self._reported:
+                # 队列恢复后, 补充一条丢弃提示
+                dropped = self.dropped
+                self.queue.put_nowait(LogRecord(
+                    name=__name__, level=WARNING, pathname=__file__, lineno=0,
+                    msg=f'[log] {dropped - self._reported} log records dropped (queue full)', args=None, exc_info=None
+                ))
+                self._reported = dropped
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class FileLock:
+    '''
+    跨进程文件锁 (Unix: `fcntl.flock`, Windows: `msvcrt.locking`)
+    - 锁由打开的文件持有, 进程退出时自动释放
+    - 可用作上下文管理器 (阻塞获取)
+    - 持有锁时可通过 `read()` / `write()` 在锁文件中存放少量数据 (如上次执行时间)
+    '''
+
+    def __init__(self, path: str):
+        '''
+        :param path: 锁文件路径 (不存在则创建)
+        '''
+        self.path = path
+        self._file: TextIOWrapper | None = None
+
+    @property
+    def locked(self) -> bool:
+        '''
+        当前是否持有锁
+        '''
+        return self._file is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        '''
+        获取锁
+
+        :param blocking: 是否等待其他进程释放
+        :return: 是否成功获取
+        '''
+        if self._file:
+            return True
+        f = open(self.path, 'a+')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+                        time.sleep(0.1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        '''
+        释放锁
+        '''
+        if not self._file:
+            return
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def read(self) -> str:
+        '''
+        (需持有锁) 读取锁文件内容
+        '''
+        assert self._file, 'lock not acquired'
+        self._file.seek(0)
+        return self._file.read()
+
+    def write(self, text: str):
+        '''
+        (需持有锁) 替换锁文件内容
+        '''
+        assert self._file, 'lock not acquired'
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(text)
+        self._file.flush()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
+class LogFileHandler(RotatingFileHandler):
+    '''
+    按大小 / 按天切割的日志文件 handler (可压缩旧日志)
+    - 切割后的文件为 `<文件名>.1[.gz]`, `<文件名>.2[.gz]`, ...
+    - 多个进程写入同一文件时 (多 worker 部署), 切割由文件锁保护, 只有一个进程执行切割, 其他进程重新打开新文件
+    '''
+
+    def __init__(self, filename: str, max_bytes: int = 0, backup_count: int = 0, daily: bool = False, compress: bool = False, timezone: str | None = None):
+        '''
+        :param filename: 日志文件路径
+        :param max_bytes: 单个文件最大字节数 (0 为不按大小切割)
+        :param backup_count: 保留的旧日志数量
+        :param daily: 是否在每天 0 点切割
+        :param compress: 是否使用 gzip 压缩旧日志
+        :param timezone: 判断日期使用的时区
+        '''
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', errors='ignore')
+        self.daily = daily
+        self._tz = pytz.timezone(timezone) if timezone else None
+        self._date = self._today()
+        if compress:
+            self.namer = lambda name: name + '.gz'
+            self.rotator = self._gzip_rotator
+
+    def _today(self):
+        return datetime.now(self._tz).date()
+
+    @staticmethod
+    def _gzip_rotator(source: str, dest: str):
+        with open(source, 'rb') as sf, gzip.open(dest, 'wb') as df:
+            shutil.copyfileobj(sf, df)
+        os.remove(source)
+
+    def shouldRollover(self, record: LogRecord) -> bool:
+        if self.daily and self._today() != self._date:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def _open(self):
+        self._opened_at = time.time()
+        return super()._open()
+
+    def doRollover(self):
+        self._date = self._today()
+        with FileLock(self.baseFilename + '.lock') as lock:
+            try:
+                last = float(lock.read() or 0)
+            except ValueError:
+                last = 0
+            if self.stream and last > self._opened_at:
+                # 打开文件后已有其他进程完成切割, 重新打开即可
+                self.stream.close()
+                self.stream = self._open()
+                return
+            # 记录切割时间 (先于重新打开文件, 本进程之后不会误判)
+            now = time.time()
+            self._rollover()
+            lock.write(str(now))
+
+    def _rollover(self):
+        if self.backupCount <= 0:
+            # 不保留旧日志时 RotatingFileHandler 不会切割, 直接清空
+            if self.stream:
+                self.stream.close()
+                self.stream = None  # type: ignore
+            open(self.baseFilename, 'w').close()
+            self.stream = self._open()
+            return
+        super().doRollover()
+
+
 def cache_response(*args):
     '''
     给返回添加缓存标头
@@ -85,6 +298,44 @@ def no_cache_response(*args):
     return resp
 
 
+def verify_secret() -> str | None:
+    '''
+    检查当前请求是否带有正确的 secret (结果同时记录到 `flask.g.auth`)
+
+    :return: 验证成功时返回 secret 来源 (`Body` / `Param` / ...), 否则返回 `None`
+    '''
+    source = _verify_secret()
+    flask.g.auth = source or 'failed'
+    return source
+
+
+def _verify_secret() -> str | None:
+    # 1. body
+    body: dict = flask.request.get_json(silent=True) or {}
+    if body and body.get('secret') == flask.g.secret:
+        return 'Body'
+
+    # 2. param
+    elif flask.request.args.get('secret') == flask.g.secret:
+        return 'Param'
+
+    # 3. header (Sleepy-Secret)
+    elif flask.request.headers.get('Sleepy-Secret') == flask.g.secret:
+        return 'Header (Sleepy-Secret)'
+
+    # 4. header (Authorization)
+    auth_header = flask.request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer ') and auth_header[7:] == flask.g.secret:
+        return 'Header (Authorization)'
+
+    # 5. cookie (sleepy-secret)
+    elif flask.request.cookies.get('sleepy-secret') == flask.g.secret:
+        return 'Cookie (sleepy-secret)'
+
+    # -1. no any secret
+    return None
+
+
 def require_secret(redirect_to: str | None = None):
     '''
     (装饰器) require_secret, 用于指定函数需要 secret 鉴权
@@ -95,45 +346,42 @@ def require_secret(redirect_to: str | None = None):
     def decorator(view_func):
         @wraps(view_func)
         def wrapper(*args, **kwargs):
-            # 1. body
-            body: dict = flask.request.get_json(silent=True) or {}
-            if body and body.get('secret') == flask.g.secret:
-                l.debug('[Auth] Verify secret Success from Body')
-                return view_func(*args, **kwargs)
-
-            # 2. param
-            elif flask.request.args.get('secret') == flask.g.secret:
-                l.debug('[Auth] Verify secret Success from Param')
-                return view_func(*args, **kwargs)
-
-            # 3. header (Sleepy-Secret)
-            elif flask.request.headers.get('Sleepy-Secret') == flask.g.secret:
-                l.debug('[Auth] Verify secret Success from Header (Sleepy-Secret)')
-                return view_func(*args, **kwargs)
-
-            # 4. header (Authorization)
-            auth_header = flask.request.headers.get('Authorization', '')
-            if auth_header.startswith('Bearer ') and auth_header[7:] == flask.g.secret:
-                l.debug('[Auth] Verify secret Success from Header (Authorization)')
-                return view_func(*args, **kwargs)
-
-            # 5. cookie (sleepy-secret)
-            elif flask.request.cookies.get('sleepy-secret') == flask.g.secret:
-                l.debug('[Auth] Verify secret Success from Cookie (sleepy-secret)')
+            source = verify_secret()
+            if source:
+                l.debug(f'[Auth] Verify secret Success from {source}')
                 return view_func(*args, **kwargs)
-
-            # -1. no any secret
+            elif redirect_to:
+                l.debug(f'[Auth] Verify secret failed, redirect to {redirect_to}')
+                return flask.redirect(redirect_to, 302)
             else:
-                if redirect_to:
-                    l.debug(f'[Auth] Verify secret failed, redirect to {redirect_to}')
-                    return flask.redirect(redirect_to, 302)
-                else:
-                    l.debug('[Auth] Verify secret Failed')
-                    raise APIUnsuccessful(401, 'Wrong Secret')
+                l.debug('[Auth] Verify secret Failed')
+                raise APIUnsuccessful(401, 'Wrong Secret')
         return wrapper
     return decorator
 
 
+def ip_allowed(ip: str | None, allow_list: list[str]) -> bool:
+    '''
+    检查 IP 是否在允许列表中
+
+    :param ip: IP 地址
+    :param allow_list: 允许的 IP / 网段列表 (如 `127.0.0.1`, `10.0.0.0/8`)
+    '''
+    if not ip:
+        return False
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    for i in allow_list:
+        try:
+            if addr in ipaddress.ip_network(i, strict=False):
+                return True
+        except ValueError:
+            l.warning(f'Invaild IP / network in allow list: {i}')
+    return False
+
+
 class SleepyException(Exception):
     '''
     Custom Exception for sleepy
@@ -378,6 +626,7 @@ def get_path(path: str, create_dirs: bool = True, is_dir: bool = False) -> str:
     return full_path
 
 
+@lru_cache(maxsize=512)
 def relative_path(path: str) -> str:
     '''
     绝对路径 -> 相对路径